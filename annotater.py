@@ -1,34 +1,127 @@
 #!/usr/bin/env python3
-import re, argparse, json
+import re, argparse, bisect, csv, json, os
+import profile_io
+from disasm import index_file
 
 # Regex for the line of instruction:
 # 1: 48 89 e5  movq %rsp, %rbp
 inst_regex = re.compile(r'\s*([0-9a-f]+):\s+(?:[0-9a-f]{2}(?:\s|$))+(.*)')
 
+# Regex for the first line of a function:
+# 0000000000001139 <main>:
+function_regex = re.compile(r'[0-9a-f]+ <(.*)>:$')
+
 def ratio_number(k, n):
     return '{:.2f}%'.format(k / n * 100)
 
-def annotate(disasm, perf):
-    with open(disasm, 'r') as disasm_file, open(perf, 'r') as perf_file, open(perf[:-5] + '.annotated', 'w') as annotated:
-        json_data = json.load(perf_file)
-        global_icount = int(json_data['global'][0]['total'])
-        insn_count = json_data['insn']
-        icounts = {pc_execution['pc']: int(pc_execution['execution']) for pc_execution in insn_count}
-        print('Total dynamic icount: ' + format(global_icount, ','), file=annotated)
+def sim_file_of(perf):
+    """Return the SDE file whose profile perf (*.json, *.npz or *.<table>.csv) is."""
+    return perf[:-len('.json')] if perf.endswith('.json') else profile_io.sim_file_of(perf)
+
+def load_icounts(perf):
+    """Return the global icount and a dict of icounts by pc of perf, read only from the insn and global tables of
+    its profile, or from perf if it is a JSON file without them."""
+    sim_file = sim_file_of(perf)
+    if perf.endswith('.json') and profile_io.read_format(sim_file) == 'csv' and not os.path.isfile(profile_io.csv_file(sim_file, 'insn')):
+        with open(perf, 'r') as perf_file:
+            json_data = json.load(perf_file)
+        return int(json_data['global'][0]['total']), {int(row['pc'], 16): int(row['execution'] or 0) for row in json_data['insn']}
+
+    fmt = profile_io.read_format(sim_file, profile_io.table_format(perf))
+    with profile_io.open_table(sim_file, 'global', fmt) as reader:
+        global_icount = int(next(iter(reader))['total'])
+    if fmt == 'npz':
+        _, columns = profile_io.load_columns(sim_file, 'insn', fmt)
+        return global_icount, dict(zip(columns['pc'].tolist(), columns['execution'].tolist())) if columns else {}
+    with profile_io.open_table(sim_file, 'insn', fmt) as reader:
+        return global_icount, {int(row['pc'], 16): int(row['execution'] or 0) for row in reader}
+
+def annotate_line(line, icounts, global_icount):
+    """Return line with the icount of its instruction if it has one, and that icount."""
+    if matches := inst_regex.match(line):
+        execution = icounts.get(int(matches.group(1), 16), 0)
+        if execution:
+            return line + ' | ' + format(execution, ',') + '({})'.format(ratio_number(execution, global_icount)), execution
+    return line, 0
+
+def read_index(disasm):
+    """Return the rows of the index of disasm, or None if there is none or it is not the one of disasm."""
+    index = index_file(disasm)
+    if not os.path.isfile(index):
+        return None
+    with open(index, 'r') as f:
+        rows = list(csv.DictReader(f))
+    size = int(rows[-1]['offset']) + int(rows[-1]['length']) if rows else 0
+    return rows if size == os.path.getsize(disasm) else None
+
+def annotate_hot_functions(disasm, index, icounts, global_icount, hot_threshold, annotated):
+    """Write the text of disasm out of the functions, and the functions whose icount is at least hot_threshold percent
+    of the total, seeking to them by index."""
+    pcs = sorted(icounts)
+    sums = [0]
+    for pc in pcs:
+        sums.append(sums[-1] + icounts[pc])
+    with open(disasm, 'rb') as disasm_file:
+        for row in index:
+            if row['name']:
+                start, end = (int(row['start'], 16), int(row['end'], 16)) if row['start'] else (0, -1)
+                function_icount = sums[bisect.bisect_right(pcs, end)] - sums[bisect.bisect_left(pcs, start)] if start <= end else 0
+                if function_icount < hot_threshold / 100 * global_icount:
+                    continue
+            disasm_file.seek(int(row['offset']))
+            lines = [annotate_line(line.rstrip(), icounts, global_icount)[0]
+                     for line in disasm_file.read(int(row['length'])).decode().split('\n')[:-1]]
+            if row['name']:
+                lines[0] += ' | ' + format(function_icount, ',') + '({})'.format(ratio_number(function_icount, global_icount))
+            for line in lines:
+                print(line, file=annotated)
+
+def annotate_stream(disasm, icounts, global_icount, hot_threshold, annotated):
+    """Write disasm annotated, reading it line by line."""
+    with open(disasm, 'r') as disasm_file:
+        # Lines of the current function, held back until its icount is known if there is a threshold
+        function, function_icount = [], 0
+        def flush():
+            if function and function_icount >= hot_threshold / 100 * global_icount:
+                function[0] += ' | ' + format(function_icount, ',') + '({})'.format(ratio_number(function_icount, global_icount))
+                for function_line in function:
+                    print(function_line, file=annotated)
         for line in disasm_file:
-            line = line.rstrip()
-            if matches := inst_regex.match(line):
-                pc = matches.group(1).lstrip('0')
-                execution = icounts[pc] if pc in icounts else 0
-                if execution:
-                    line += ' | ' + format(execution, ',') + '({})'.format(ratio_number(execution, global_icount))
-            print(line, file=annotated)
+            line, execution = annotate_line(line.rstrip(), icounts, global_icount)
+            function_icount += execution
+            if hot_threshold is None:
+                print(line, file=annotated)
+                continue
+            if function_regex.match(line) or line.startswith('Disassembly of section'):
+                flush()
+                function, function_icount = [], 0
+            if function or function_regex.match(line):
+                function.append(line)
+            else:
+                print(line, file=annotated)
+        if hot_threshold is not None:
+            flush()
+
+def annotate(disasm, perf, hot_threshold=None):
+    """Write disasm annotated with the icounts of perf to *.annotated, keeping only the functions whose icount is at
+    least hot_threshold percent of the total if it is given, which are read by the index of disasm if it has one, and
+    return the global icount and the dict of icounts by pc it annotated with."""
+    global_icount, icounts = load_icounts(perf)
+    index = read_index(disasm) if hot_threshold is not None else None
+    with open(sim_file_of(perf) + '.annotated', 'w') as annotated:
+        print('Total dynamic icount: ' + format(global_icount, ','), file=annotated)
+        if index is not None:
+            annotate_hot_functions(disasm, index, icounts, global_icount, hot_threshold, annotated)
+        else:
+            annotate_stream(disasm, icounts, global_icount, hot_threshold, annotated)
+    return global_icount, icounts
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Annotate disam with icount info.')
     parser.add_argument('disasm', help='disasm file generated by [llvm-]objdump')
-    parser.add_argument('perf', help='SDE perf data of JSON format')
+    parser.add_argument('perf', help='SDE perf data: *.json, *.insn.csv or *.npz (only the insn and global tables are read)')
+    parser.add_argument('--hot-threshold', type=float, help='only keep the functions whose icount is at least this percent of the total, with their icount')
     args = parser.parse_args()
-    annotate(args.disasm, args.perf)
+    annotate(args.disasm, args.perf, args.hot_threshold)
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
-import argparse, csv, subprocess
+import argparse, bisect, csv, os, subprocess, sys
 from collections import defaultdict
 from subprocess import PIPE
+import profile_io, symcache
+from profile_io import np
+from symbolizer import Symbolizer
 
 def batch_addr2line(addr2line, binary, addresses):
     """Batch process addresses to improve efficiency."""
@@ -10,74 +13,209 @@ def batch_addr2line(addr2line, binary, addresses):
     result = subprocess.run(cmd, input='\n'.join(addresses), stdout=PIPE, stderr=PIPE, text=True)
     return result.stdout.strip().splitlines()
 
-def bb_to_fline(bb_csv, binary, addr2line):
-    assert bb_csv.endswith('bb.csv'), 'not normalized name'
-    f_csv = bb_csv[:-6] + 'f.csv'
-    line_csv = bb_csv[:-6] + 'line.csv'
-
-    with open(bb_csv, 'r') as bb_csv_file:
-        bb_reader = csv.DictReader(bb_csv_file)
-        fieldnames = bb_reader.fieldnames.copy()
-        for name in ['entry', 'execution', 'exit']:
-            fieldnames.remove(name)
-
-        f_fieldnames = fieldnames.copy()
-        line_fieldnames = fieldnames.copy()
-        f_fieldnames.insert(0, 'name')
-        line_fieldnames.insert(0, 'source_line')
-
-        fs_metrics = defaultdict(lambda: defaultdict(int))
-        lines_metrics = defaultdict(lambda: defaultdict(int))
-
-        # Collect addresses for batch processing
-        addresses = []
-        bb_entries = []
-        for bb in bb_reader:
-            entry = bb['entry']
-            addresses.append(entry)
-            bb_entries.append(bb)
-
-        # Batch process addresses with addr2line
-        addr2line_output = batch_addr2line(addr2line, binary, addresses)
-        addr2line_lines = iter(addr2line_output)
-
-        for bb in bb_entries:
-            entry = bb['entry']
-            # Assume output looks like:
-            #
-            # main
-            # a.c:11
-            name = next(addr2line_lines).strip()
-            source_line = next(addr2line_lines).strip()
-            f_metrics = fs_metrics[name]
-            line_metrics = lines_metrics[source_line]
-            f_metrics['name'] = name
-            line_metrics['source_line'] = source_line
-
-            for key, val in bb.items():
-                if key in f_fieldnames:
-                    f_metrics[key] += int(val or 0)
-                if key in line_fieldnames:
-                    line_metrics[key] += int(val or 0)
+# The symbolizers of the last binaries, kept open with their interval tables for the next calls of the process (e.g. of
+# a worker of for_each.py), by path, size and modification time of the binary
+symbolizers = {}
+max_symbolizers = 4
+
+def symbolizer_of(binary):
+    stat = os.stat(binary)
+    key = (os.path.realpath(binary), stat.st_size, stat.st_mtime_ns)
+    if key not in symbolizers:
+        if len(symbolizers) >= max_symbolizers:
+            symbolizers.pop(next(iter(symbolizers))).close()
+        symbolizers[key] = Symbolizer(binary)
+    return symbolizers[key]
+
+def fline_of(addresses, binary, addr2line=None, cache=None):
+    """Return the function names and the source lines of addresses, from cache if given, with the built-in
+    symbolizer or with addr2line if it is given."""
+    def resolve(addresses):
+        if addr2line is None:
+            return symbolizer_of(binary).lookup(addresses)
+        # Assume output looks like:
+        #
+        # main
+        # a.c:11
+        output = [line.strip() for line in batch_addr2line(addr2line, binary, addresses)]
+        return output[0::2], output[1::2]
+    return cache.lookup(binary, addresses, resolve, addr2line) if cache else resolve(addresses)
+
+def group_ids(keys):
+    """Return the id of each key, numbered by first appearance, and the distinct keys in that order."""
+    ids = {}
+    return [ids.setdefault(key, len(ids)) for key in keys], list(ids)
+
+def aggregate_rows(bb_reader, metrics, binary, addr2line, cache):
+    """Sum metrics of the bb rows by function and by source line, row by row."""
+    bbs = list(bb_reader)
+    names, source_lines = fline_of([bb['entry'] for bb in bbs], binary, addr2line, cache)
+    sums = []
+    for keys in [names, source_lines]:
+        key_metrics = defaultdict(lambda: defaultdict(int))
+        for key, bb in zip(keys, bbs):
+            for metric in metrics:
+                key_metrics[key][metric] += int(bb[metric] or 0)
+        sums.append(key_metrics)
+    return sums
+
+def aggregate_columns(columns, metrics, binary, addr2line, cache):
+    """Sum metrics of the bb columns by function and by source line, with grouped sums over a 2-D counter array."""
+    # Symbolize each distinct entry once, in order of first appearance so that the groups are too
+    entries, first, inverse = np.unique(columns['entry'], return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    names, source_lines = fline_of(['{:x}'.format(entry) for entry in entries[order].tolist()], binary, addr2line, cache)
+
+    counters = np.stack([columns[metric] for metric in metrics], axis=1) if metrics else np.zeros((len(inverse), 0), dtype=np.int64)
+    sums = []
+    for keys in [names, source_lines]:
+        entry_ids, groups = group_ids(keys)
+        ids = np.asarray(entry_ids, dtype=np.int64)[rank[inverse.reshape(-1)]]
+        group_sums = np.zeros((len(groups), len(metrics)), dtype=np.int64)
+        np.add.at(group_sums, ids, counters)
+        sums.append({key: dict(zip(metrics, row)) for key, row in zip(groups, group_sums.tolist())})
+    return sums
+
+def sum_by_ids(ids, keys, values):
+    """Sum values by ids into a dict of keys, in order of first appearance of the ids."""
+    if np is not None:
+        ids = np.asarray(ids, dtype=np.int64)
+        sums = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(sums, ids, values)
+        distinct, first = np.unique(ids, return_index=True)
+        return {keys[i]: sums[i] for i in distinct[np.argsort(first)].tolist()}
+    sums = {}
+    for i, value in zip(ids, values):
+        sums[i] = sums.get(i, 0) + value
+    return {keys[i]: value for i, value in sums.items()}
+
+def insn_fline_ids(pcs, binary, addr2line, cache):
+    """Return the function name ids and source line ids of pcs, and the names and lines they index."""
+    if addr2line is None and cache is None:
+        # Look up pcs in the intervals of constant function name and source line of the binary
+        starts, names, source_lines = symbolizer_of(binary).interval_table(min(pcs), max(pcs) + 1)
+        if np is not None:
+            intervals = np.searchsorted(np.asarray(starts, dtype=np.uint64), pcs, side='right') - 1
+        else:
+            intervals = [bisect.bisect_right(starts, pc) - 1 for pc in pcs]
+    else:
+        intervals, distinct = group_ids(pcs.tolist() if np is not None else pcs)
+        names, source_lines = fline_of(['{:x}'.format(pc) for pc in distinct], binary, addr2line, cache)
+    ids = []
+    for keys in [names, source_lines]:
+        key_ids, keys[:] = group_ids(keys)
+        ids.append(np.asarray(key_ids, dtype=np.int64)[intervals] if np is not None else [key_ids[i] for i in intervals])
+    return ids[0], names, ids[1], source_lines
+
+def insn_to_fline(insn_csv, binary, addr2line=None, cache=None):
+    """Attribute the execution of each instruction, rather than of each block, to its function and source line, written
+    to *.insn.f.csv and *.insn.line.csv, and return the two sums as dicts of executions by name and by source line."""
+    sim_file = profile_io.sim_file_of(insn_csv)
+    fmt = profile_io.table_format(insn_csv)
+    f_csv = sim_file + '.insn.f.csv'
+    line_csv = sim_file + '.insn.line.csv'
+
+    if np is not None:
+        _, columns = profile_io.load_columns(sim_file, 'insn', fmt)
+        pcs, executions = (columns['pc'], columns['execution']) if columns else ([], [])
+    else:
+        with profile_io.open_table(sim_file, 'insn', fmt) as insn_reader:
+            rows = [(int(insn['pc'], 16), int(insn['execution'] or 0)) for insn in insn_reader]
+        pcs, executions = [pc for pc, _ in rows], [execution for _, execution in rows]
+
+    fs_total, lines_total = {}, {}
+    if len(pcs):
+        name_ids, names, line_ids, source_lines = insn_fline_ids(pcs, binary, addr2line, cache)
+        fs_total = sum_by_ids(name_ids, names, executions)
+        lines_total = sum_by_ids(line_ids, source_lines, executions)
+
+    with open(f_csv, 'w') as f_csv_file, open(line_csv, 'w') as line_csv_file:
+        for out_file, first, keys_total in [(f_csv_file, 'name', fs_total), (line_csv_file, 'source_line', lines_total)]:
+            writer = csv.writer(out_file)
+            writer.writerow([first, 'total'])
+            for key, total in keys_total.items():
+                writer.writerow([key, total])
+    return fs_total, lines_total
+
+def bb_to_fline(bb_csv, binary, addr2line=None, cache=None, table=None):
+    """Write the metrics of the blocks of bb_csv summed by function to *.f.csv and by source line to *.line.csv,
+    and return the two sums as dicts of metrics by name and by source line. The blocks are those of table, the header
+    and columns of TableWriter.table() (e.g. of the bb writer sde2csv.convert_sde_perf_to_csv() returns), if given,
+    rather than read again."""
+    assert bb_csv.endswith(('bb.csv', '.npz')), 'not normalized name'
+    sim_file = profile_io.sim_file_of(bb_csv)
+    fmt = profile_io.table_format(bb_csv)
+    f_csv = sim_file + '.f.csv'
+    line_csv = sim_file + '.line.csv'
+
+    if table is not None:
+        header, columns = table
+    elif np is not None:
+        header, columns = profile_io.load_columns(sim_file, 'bb', fmt)
+    else:
+        header = None
+    fieldnames = header.copy() if header else None
+    if fieldnames is None:
+        with profile_io.open_table(sim_file, 'bb', fmt) as bb_reader:
+            fieldnames = bb_reader.fieldnames.copy()
+    for name in ['entry', 'execution', 'exit']:
+        fieldnames.remove(name)
+    metrics = list(dict.fromkeys(fieldnames))
+
+    if header and np is not None:
+        fs_metrics, lines_metrics = aggregate_columns(columns, metrics, binary, addr2line, cache)
+    elif header:
+        rows = [{name: '{:x}'.format(val) if name in profile_io.address_columns else val for name, val in zip(header, values)}
+                for values in zip(*[columns[name] for name in header])]
+        fs_metrics, lines_metrics = aggregate_rows(rows, metrics, binary, addr2line, cache)
+    else:
+        with profile_io.open_table(sim_file, 'bb', fmt) as bb_reader:
+            fs_metrics, lines_metrics = aggregate_rows(bb_reader, metrics, binary, addr2line, cache)
 
     # Write output files
     with open(f_csv, 'w') as f_csv_file, open(line_csv, 'w') as line_csv_file:
-        f_writer = csv.DictWriter(f_csv_file, fieldnames=f_fieldnames)
-        f_writer.writeheader()
-        for key, val in fs_metrics.items():
-            f_writer.writerow(val)
+        for out_file, first, keys_metrics in [(f_csv_file, 'name', fs_metrics), (line_csv_file, 'source_line', lines_metrics)]:
+            writer = csv.writer(out_file)
+            writer.writerow([first] + fieldnames)
+            for key, key_metrics in keys_metrics.items():
+                writer.writerow([key] + [key_metrics[name] for name in fieldnames])
+    return fs_metrics, lines_metrics
 
-        line_writer = csv.DictWriter(line_csv_file, fieldnames=line_fieldnames)
-        line_writer.writeheader()
-        for key, val in lines_metrics.items():
-            line_writer.writerow(val)
+def bb_file_to_fline(bb_csv, binary, addr2line=None, cache_dir=None, per_insn=False, all_images=False):
+    """Run bb_to_fline, and insn_to_fline if per_insn, with the symbol cache of cache_dir if given, and if all_images,
+    on the tables of each image of sde2csv.py --all-images too, with the file of the image."""
+    cache = symcache.SymbolCache(cache_dir) if cache_dir else None
+    sums = bb_to_fline(bb_csv, binary, addr2line, cache)
+    if per_insn:
+        insn_to_fline(bb_csv, binary, addr2line, cache)
+    if all_images:
+        sim_file = profile_io.sim_file_of(bb_csv)
+        for image in profile_io.read_images(sim_file):
+            if not image['file']:
+                print(f'{image["name"]}: no file of {image["path"]} to symbolize with', file=sys.stderr)
+                continue
+            # The tables of the image are read in the format of bb_csv
+            image_sim_file = profile_io.image_file(sim_file, image['name'])
+            image_bb_csv = profile_io.npz_file(image_sim_file) if bb_csv.endswith('.npz') else profile_io.csv_file(image_sim_file, 'bb')
+            bb_to_fline(image_bb_csv, image['file'], addr2line, cache)
+            if per_insn:
+                insn_to_fline(image_bb_csv, image['file'], addr2line, cache)
+    if cache:
+        print(cache.stats(), file=sys.stderr)
+        cache.close()
+    return sums
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Get function & line profiling info from basic block info (CSV format), where entry, execution, exit are required')
-    parser.add_argument('bb_csv', help='input bb CSV file')
+    parser.add_argument('bb_csv', help='input bb CSV file, or npz file')
     parser.add_argument('binary', help='profiled binary')
-    parser.add_argument('--addr2line', default='addr2line', help='path of addr2line (this is needed if dwarf format of binary is not supported by system addr2line)')
+    parser.add_argument('--addr2line', help='path of addr2line to use instead of the built-in symbolizer (this is needed if dwarf format of binary is not supported by it)')
+    parser.add_argument('--cache-dir', help='directory of a symbol cache shared by the runs on the same binary')
+    parser.add_argument('--all-images', action='store_true', help='also write *.image.<NAME>.f.csv and *.image.<NAME>.line.csv of each image of sde2csv.py --all-images, symbolized with the file of the image')
+    parser.add_argument('--per-insn', action='store_true', help='also write *.insn.f.csv and *.insn.line.csv, where the icount of each instruction of the insn table is attributed to its own function and source line')
     args = parser.parse_args()
-    bb_to_fline(args.bb_csv, args.binary, args.addr2line)
+    bb_file_to_fline(args.bb_csv, args.binary, args.addr2line, args.cache_dir, args.per_insn, args.all_images)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import argparse, os, shutil, tempfile, threading, time
+import sde2csv
+
+# A block in the shape SDE emits with -top_blocks -1 -dynamic_stats_per_block: the BLOCK line,
+# the XDIS of every instruction, then the per-block counts of every mix category.
+block_template = '''\
+BLOCK: {num:>8}   PC: {pc:x}   ICOUNT: {icount:>12}   EXECUTIONS: {execution:>10}   #BYTES: 32   %: 0.0123   cumltv%: 12.3456  FN: main  IMG: {image}  OFFSET: {offset:x}
+{xdis}#
+*isa-ext-BASE                                      {icount}
+*isa-set-I86                                       {icount}
+*category-DATAXFER                                 {half}
+*category-BINARY                                   {half}
+*category-COND_BR                                  {execution}
+*iform-MOV_GPRv_MEMv                               {half}
+*iform-ADD_GPRv_IMMb                               {half}
+*mem-read                                          {execution}
+*mem-write                                         {execution}
+*mem-atomic                                        0
+*ilen-3                                            {half}
+*ilen-4                                            {half}
+*total                                             {icount}
+MOV                                                {half}
+ADD                                                {half}
+JNZ                                                {execution}
+PUSH                                               {execution}
+POP                                                {execution}
+'''
+
+def write_synthetic_mix(path, binary, size, distinct=False):
+    """Write a mix file of about size bytes of the same 1000 blocks over and over, all in the first executable LOAD
+    segment of binary, or if distinct, of blocks all at different addresses of the image of binary, which make the
+    largest tables a file of that size can have."""
+    image = os.path.basename(binary)
+    image_low = 0x555555554000
+    text_low = image_low + 0x1000
+    insns_per_block = 8
+
+    def chunk(first):
+        blocks = []
+        for num in range(first, first + 1000):
+            pc = text_low + (num if distinct else num % 64) * insns_per_block * 4
+            execution = (num - 1) % 1000 * 7 + 7
+            xdis = ''.join(f'XDIS {pc + i * 4:x}: BASE       4889E5                   mov rbp, rsp\n' for i in range(insns_per_block))
+            blocks.append(block_template.format(num=num, pc=pc, icount=execution * insns_per_block, execution=execution,
+                                                half=execution * insns_per_block // 2, image=image, offset=pc - image_low, xdis=xdis))
+        return ''.join(blocks).encode()
+    first = 1
+    blocks = chunk(first)
+
+    with open(path, 'wb') as prof:
+        prof.write(b'# EMIT_IMAGE_ADDRESSES\n')
+        prof.write(f'{os.path.abspath(binary)} {image_low:x} {image_low + 0x3fffffff:x}\n'.encode())
+        prof.write(b'/lib/x86_64-linux-gnu/libc.so.6 7ffff7d80000 7ffff7f95fff\n')
+        prof.write(b'# END_IMAGE_ADDRESSES\n')
+        prof.write(b'# EMIT_GLOBAL_TOP_BLOCK_STATS\n')
+        written = prof.tell()
+        while written < size:
+            prof.write(blocks)
+            written += len(blocks)
+            if distinct:
+                first += 1000
+                blocks = chunk(first)
+        prof.write(b'# END_TOP_BLOCK_STATS\n')
+        prof.write(b'# EMIT_GLOBAL_DYNAMIC_STATS\n# $global-dynamic-counts\n')
+        prof.write(b'*total 123456789\n*mem-read 2345678\n*mem-write 1234567\n')
+        prof.write(b'# END_GLOBAL_DYNAMIC_STATS\n')
+
+def anonymous_memory():
+    """Return the anonymous memory of this process in bytes, which leaves out the pages of the mapped sim file that
+    the kernel can reclaim, or 0 if unknown."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def sample_peak(peak, stop):
+    while not stop.wait(0.01):
+        peak[0] = max(peak[0], anonymous_memory())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the parsing throughput of sde2csv.py on a synthetic SDE mix file')
+    parser.add_argument('--size', type=int, default=2048, help='size of the synthetic mix file in MB')
+    parser.add_argument('--binary', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_files', 'a.out'), help='binary the synthetic blocks belong to')
+    parser.add_argument('--sim-file', help='existing SDE file to parse instead of a synthetic one')
+    parser.add_argument('--items', help='extra interesting items in perf data')
+    parser.add_argument('--repeat', type=int, default=1, help='number of timed runs')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to parse the top blocks with')
+    parser.add_argument('--distinct-blocks', action='store_true', help='make every block of the synthetic file distinct, the worst case of the memory of the tables')
+    args = parser.parse_args()
+
+    items = [s.strip() for s in args.items.split(',')] if args.items else None
+
+    tmp_dir = None
+    sim_file = args.sim_file
+    if not sim_file:
+        tmp_dir = tempfile.mkdtemp(prefix='bench_sde2csv.')
+        sim_file = os.path.join(tmp_dir, 'bench.err')
+        start = time.perf_counter()
+        write_synthetic_mix(sim_file, args.binary, args.size << 20, args.distinct_blocks)
+        print(f'generated {sim_file} in {time.perf_counter() - start:.1f}s')
+
+    try:
+        size = os.path.getsize(sim_file)
+        for _ in range(args.repeat):
+            # The memory of the parse in this process, over that before it, is what for_each.py --memory-ratio
+            # estimates per byte of the sim file (with --jobs, the workers parsing the chunks are not counted)
+            base, peak, stop = anonymous_memory(), [0], threading.Event()
+            sampler = threading.Thread(target=sample_peak, args=(peak, stop))
+            sampler.start()
+            start = time.perf_counter()
+            sde2csv.convert_sde_perf_to_csv(sim_file, args.binary, args.jobs, items=items)
+            elapsed = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+            peak[0] = max(peak[0], anonymous_memory())
+            print(f'parsed {size / 2**20:.1f} MB in {elapsed:.2f}s: {size / 2**20 / elapsed:.1f} MB/s, '
+                  f'peak memory {(peak[0] - base) / 2**20:.0f} MB over {base / 2**20:.0f} MB ({(peak[0] - base) / size:.2f} per byte)')
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse, csv, os, subprocess, glob
 from subprocess import PIPE
+import profile_io
 
 
 if __name__ == '__main__':
@@ -23,9 +24,7 @@ if __name__ == '__main__':
             sub_dir = os.path.join(dir_path, name)
             for sim_file_name in sim_file_names:
                 sim_file_abspath = os.path.join(sub_dir, sim_file_name)
-                global_csv_file_abspath = f'{sim_file_abspath}.global.csv'
-                with open(global_csv_file_abspath, 'r') as global_csv_file:
-                    global_csv_file_reader = csv.DictReader(global_csv_file)
+                with profile_io.open_table(sim_file_abspath, 'global') as global_csv_file_reader:
                     if not writer:
                         extra_fieldnames = ['name']
                         if workload_class:
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
-import os, argparse, csv, shutil
+import os, argparse, csv
+from concurrent.futures import ThreadPoolExecutor
+import profile_io
+from pipeline import Pipeline, Stage
+from staging import stage_file
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -7,35 +11,52 @@ if __name__ == '__main__':
     parser.add_argument('dst', help='destination directory')
     parser.add_argument('--csv', required=True, help='input CSV file describing the mappings')
     parser.add_argument('-o', '--output', required=True, help='simplified CSV file by removing the dir name of files')
+    parser.add_argument('--compress', choices=list(profile_io.compressions), help='compress the sim files while copying them (sde2csv.py reads them compressed)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of files to copy at once (default: number of cpus)')
+    parser.add_argument('--link', action='store_true', help='make reflinks, or else hard links, of the sources rather than byte copies when the file system allows it (a hard link shares later changes of the source)')
+    parser.add_argument('--force', action='store_true', help='copy the files even if they are up to date')
     args = parser.parse_args()
+    suffix = profile_io.compressions[args.compress] if args.compress else ''
 
+    # (source, destination, compression) of each file, in the order of the CSV
+    copies = []
     with open(args.csv, 'r') as csv_file, open(args.output, 'w') as output_file:
         csv_reader = csv.DictReader(csv_file)
         for f in ['name', 'exe', 'sim_files']:
             assert f in csv_reader.fieldnames, f'cannot find field {f}'
         csv_writer = csv.DictWriter(output_file, fieldnames=csv_reader.fieldnames)
         csv_writer.writeheader()
-        exe_from_to = {}
         for row in csv_reader:
             new_row = row.copy()
             sim_files = row['sim_files'].split(',')
             exe = row['exe']
             new_row['exe'] = os.path.basename(exe)
-            new_row['sim_files'] = ','.join([os.path.basename(sim_file) for sim_file in sim_files])
+            # The sim files already compressed are copied as they are
+            to_sim_files = [os.path.basename(sim_file) + ('' if profile_io.is_compressed(sim_file) else suffix) for sim_file in sim_files]
+            new_row['sim_files'] = ','.join(to_sim_files)
 
+            # The directory is kept, so that the files and the outputs of for_each.py that are up to date stay
             sub_dir = os.path.join(args.dst, new_row['name'])
-            if os.path.isdir(sub_dir):
-                 shutil.rmtree(sub_dir)
-            os.mkdir(sub_dir)
-            to_exe = os.path.join(sub_dir, os.path.basename(exe))
-            # Avoid duplicated copies
-            if exe in exe_from_to:
-                os.link(exe_from_to[exe], to_exe)
-            else:
-                shutil.copyfile(exe, to_exe)
-                exe_from_to[exe] = to_exe
-
-            for sim_file in sim_files:
-                shutil.copy(sim_file, sub_dir)
+            os.makedirs(sub_dir, exist_ok=True)
+            copies.append((exe, os.path.join(sub_dir, new_row['exe']), None))
+            for sim_file, to_sim_file in zip(sim_files, to_sim_files):
+                copies.append((sim_file, os.path.join(sub_dir, to_sim_file), None if to_sim_file == os.path.basename(sim_file) else args.compress))
 
             csv_writer.writerow(new_row)
+
+    pipeline = Pipeline(os.path.join(args.dst, '.copy_files.stamps.json'), args.jobs, args.force)
+    # Hashing the sources is cached by size and mtime in the stamps, so it is only done again for the changed ones
+    with ThreadPoolExecutor(max_workers=pipeline.max_workers) as executor:
+        hashes = dict(zip(copies, executor.map(lambda copy: pipeline.stamps.file_hash(os.path.abspath(copy[0])), copies)))
+    # Each content is copied once, and the other destinations of the same content link to that copy, which is
+    # theirs alone
+    first_copies = {}
+    for copy in copies:
+        src, dst, compress = copy
+        first_copy = first_copies.setdefault((hashes[copy], compress), dst)
+        if first_copy == dst:
+            pipeline.add(Stage(os.path.relpath(dst, args.dst), [stage_file, src, dst, compress, args.link], [src], [dst]))
+        else:
+            pipeline.add(Stage(os.path.relpath(dst, args.dst), [stage_file, first_copy, dst], [first_copy], [dst], weight=[src]))
+    failed = pipeline.run()
+    assert not failed, f'failed: {", ".join(failed)}'
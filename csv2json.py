@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse, csv, json, os
-from collections import defaultdict
+import profile_io
 
 def remove_prefix(text, prefix):
     if text.startswith(prefix):
@@ -13,25 +13,70 @@ def remove_suffix(text, suffix):
         return text[:-len(suffix)]
     return text
 
-def covert_csv_to_json(csv_files):
+def write_json(tables, out, compact=False):
+    """Write the (name, rows) pairs of tables to out as the JSON of a dict of the lists of rows of each name, row by
+    row, in the same bytes as json.dump(..., indent=2) (or with no whitespace if compact). The rows of the same name
+    are consecutive, and a name without rows is left out."""
+    newline, item_sep, key_sep = ('', ',', ':') if compact else ('\n', ',', ': ')
+    indent = None if compact else 2
+    pad = '' if compact else '  '
+    name_sep, opened = '', None
+    out.write('{')
+    for name, rows in tables:
+        for row in rows:
+            if name != opened:
+                if opened is not None:
+                    out.write(newline + pad + ']')
+                out.write(name_sep + newline + pad + json.dumps(name) + key_sep + '[')
+                name_sep, row_sep, opened = item_sep, '', name
+            out.write(row_sep + newline + pad * 2 + json.dumps(row, indent=indent, separators=(item_sep, key_sep)).replace('\n', '\n' + pad * 2))
+            row_sep = item_sep
+    out.write(newline + pad + ']' + newline + '}' if opened is not None else '}')
+    out.write('\n')
+
+def json_file_of(prefix, compress=None):
+    return prefix + '.json' + (profile_io.compressions[compress] if compress else '')
+
+def read_csv_tables(csv_files, common_prefix):
+    for csv_file in sorted(csv_files):
+        name = remove_prefix(csv_file, common_prefix)
+        name = remove_suffix(name, '.csv')
+        if name not in ['bb', 'insn', 'global']:
+            continue
+        with open(csv_file, 'r') as f:
+            yield name, csv.DictReader(f)
+
+def read_npz_tables(sim_file):
+    for name in sorted(profile_io.tables):
+        with profile_io.open_table(sim_file, name, 'npz') as reader:
+            yield name, reader
+
+def covert_csv_to_json(csv_files, compact=False, compress=None):
     common_prefix = os.path.commonprefix(csv_files)
-    with open(common_prefix.rstrip('.')+'.json', 'w') as json_file:
-        json_dict = defaultdict(list)
-        for csv_file in sorted(csv_files):
-            name = remove_prefix(csv_file, common_prefix)
-            name = remove_suffix(name, '.csv')
-            if name not in ['bb', 'insn', 'global']:
-                continue
-            with open(csv_file, 'r') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    json_dict[name].append(row)
-        json.dump(json_dict, json_file, indent=2)
-        json_file.write('\n')
+    json_file = json_file_of(common_prefix.rstrip('.'), compress)
+    with profile_io.open_text(json_file, 'w') as out:
+        write_json(read_csv_tables(csv_files, common_prefix), out, compact)
+    return json_file
+
+def covert_npz_to_json(npz_file, compact=False, compress=None):
+    sim_file = profile_io.sim_file_of(npz_file)
+    json_file = json_file_of(sim_file, compress)
+    with profile_io.open_text(json_file, 'w') as out:
+        write_json(read_npz_tables(sim_file), out, compact)
+    return json_file
+
+def convert_to_json(files, compact=False, compress=None):
+    """Combine the CSV files, or the npz file if it is the only one, to a single file *.json (*.json.gz or
+    *.json.zst, *.json.xz if compressed), and return its path."""
+    if len(files) == 1 and files[0].endswith('.npz'):
+        return covert_npz_to_json(files[0], compact, compress)
+    return covert_csv_to_json(files, compact, compress)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Combine *.bb/insn/global.csv files to a single file *.json.')
-    parser.add_argument('csv_file', nargs='+', help='input CSV files')
+        description='Combine *.bb/insn/global.csv files (or the tables of a *.npz file) to a single file *.json.')
+    parser.add_argument('csv_file', nargs='+', help='input CSV files, or a npz file')
+    parser.add_argument('--compact', action='store_true', help='write the JSON without indentation or spaces')
+    parser.add_argument('--compress', choices=list(profile_io.compressions), help='write *.json.gz, *.json.zst (requires zstandard) or *.json.xz instead of *.json')
     args = parser.parse_args()
-    covert_csv_to_json(args.csv_file)
+    convert_to_json(args.csv_file, args.compact, args.compress)
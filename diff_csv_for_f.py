@@ -2,42 +2,137 @@
 
 import argparse, csv, os, json
 from collections import defaultdict
+import name_match
+from profile_io import np
 
-def extract_items(csv_reader, to_dict, items):
-    for row in csv_reader:
-        name = row['name']
-        for key, val in row.items():
-            if key in items:
-                to_dict[name][key] = val
-
-def diff_csv(ref, exp, items, output):
-    with open(ref, 'r') as ref_file, open(exp, 'r') as exp_file, open(output, 'w') as json_file:
-        ref_reader = csv.DictReader(ref_file)
-        exp_reader = csv.DictReader(exp_file)
-        ref_dict = defaultdict(lambda:defaultdict(str))
-        exp_dict = defaultdict(lambda:defaultdict(str))
-        extract_items(ref_reader, ref_dict, items)
-        extract_items(exp_reader, exp_dict, items)
-
-        json_dict = defaultdict(lambda:defaultdict(lambda:defaultdict(str)))
-        for name, _ in ref_dict.items():
-            for key in _.keys():
-                ref_val = ref_dict[name][key]
-                exp_val = exp_dict[name][key]
-                if exp_val != ref_val:
-                    json_dict[name]['ref'][key] = ref_val
-                    json_dict[name]['exp'][key] = exp_val
-
-        json.dump(json_dict, json_file, indent=2)
-        json_file.write('\n')
+def read_table(path, items):
+    """Return the key column name (the first one, e.g. name, source_line or pc), the keys, and the columns of the
+    items present in the header, as strings, of the CSV file path."""
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or ['name']
+        rows = list(reader)
+    keys = [row[0] for row in rows]
+    columns = {name: [row[i] if i < len(row) else '' for row in rows] for i, name in enumerate(header) if name in items and i > 0}
+    return header[0], keys, columns
+
+def fold_rows(keys, columns, key_of):
+    """Return the keys mapped by key_of and the columns with the values of the rows of the same mapped key summed."""
+    rows = {}
+    for row, key in enumerate(keys):
+        rows.setdefault(key_of[key], []).append(row)
+    columns = {item: [column[group[0]] if len(group) == 1 else str(sum(int(column[row] or 0) for row in group)) for group in rows.values()]
+               for item, column in columns.items()}
+    return list(rows), columns
+
+def join_tables(ref, exp, items, normalize=False, cache_dir=None):
+    """Join the rows of ref and exp of the same key, keys of ref first, with the function names matched by name_match
+    if normalize. Return the keys, the items of both, and for each side the row of each key on that side (or -1 if
+    the key is missing there) and the columns of the items."""
+    key_name, ref_keys, ref_columns = read_table(ref, items)
+    _, exp_keys, exp_columns = read_table(exp, items)
+    if normalize and key_name == 'name':
+        ref_key_of, exp_key_of = name_match.match_names(ref_keys, exp_keys, cache_dir)
+        ref_keys, ref_columns = fold_rows(ref_keys, ref_columns, ref_key_of)
+        exp_keys, exp_columns = fold_rows(exp_keys, exp_columns, exp_key_of)
+    index = {key: i for i, key in enumerate(dict.fromkeys(ref_keys + exp_keys))}
+    common = [item for item in ref_columns if item in exp_columns]
+    sides = []
+    for side_keys, columns in [(ref_keys, ref_columns), (exp_keys, exp_columns)]:
+        rows = [-1] * len(index)
+        for row, key in enumerate(side_keys):
+            rows[index[key]] = row
+        sides.append((rows, [columns[item] for item in common]))
+    return list(index), common, sides[0], sides[1]
+
+def value_of(side, i, j):
+    """Return the string of item j of key i on side, '' if the key is missing there."""
+    rows, columns = side
+    return columns[j][rows[i]] if rows[i] >= 0 else ''
+
+def deltas(ref, exp):
+    """Return the numeric ref values, exp values and exp - ref by key and item, as arrays if numpy is available."""
+    if not ref[1]:
+        # No item in both, whose matrix has no column to reshape by
+        empty = np.zeros((len(ref[0]), 0), dtype=np.int64) if np is not None else [[] for _ in ref[0]]
+        return empty, empty, empty
+    matrices = []
+    for rows, columns in [ref, exp]:
+        ints = [[int(value or 0) for value in column] + [0] for column in columns]
+        if np is not None:
+            # row -1 picks the 0 appended to each column
+            matrices.append(np.array(ints, dtype=np.int64).reshape(len(columns), -1)[:, rows].T)
+        else:
+            matrices.append([[column[row] for column in ints] for row in rows])
+    ref_ints, exp_ints = matrices
+    if np is not None:
+        return ref_ints, exp_ints, exp_ints - ref_ints
+    return ref_ints, exp_ints, [[e - r for r, e in zip(ref_row, exp_row)] for ref_row, exp_row in zip(ref_ints, exp_ints)]
+
+def ranked_diff(ref, exp, items, min_delta=0, normalize=False, cache_dir=None):
+    """Return (key, item, ref, exp, delta, relative delta) of the items whose |exp - ref| is at least min_delta (and
+    not 0), largest first. The relative delta is None when ref is 0."""
+    keys, common, ref_side, exp_side = join_tables(ref, exp, items, normalize, cache_dir)
+    ref_ints, exp_ints, delta = deltas(ref_side, exp_side)
+    threshold = max(min_delta, 1)
+    if np is not None:
+        rows, cols = np.nonzero(np.abs(delta) >= threshold)
+        order = np.argsort(-np.abs(delta[rows, cols]), kind='stable')
+        cells = zip(rows[order].tolist(), cols[order].tolist())
+    else:
+        cells = sorted(((i, j) for i, row in enumerate(delta) for j, d in enumerate(row) if abs(d) >= threshold),
+                       key=lambda cell: -abs(delta[cell[0]][cell[1]]))
+    result = []
+    for i, j in cells:
+        r, e = int(ref_ints[i][j]), int(exp_ints[i][j])
+        result.append((keys[i], common[j], r, e, e - r, (e - r) / r if r else None))
+    return result
+
+def diff_csv(ref, exp, items, output=None, min_delta=0, normalize=False, cache_dir=None):
+    """Return the values of items that differ by at least min_delta (and 0) between the rows of the same key of ref
+    and exp, the keys of ref first, and also write them to output as JSON if it is given."""
+    keys, common, ref_side, exp_side = join_tables(ref, exp, items, normalize, cache_dir)
+    _, _, delta = deltas(ref_side, exp_side)
+    threshold = max(min_delta, 1)
+    if np is not None:
+        cells = zip(*[index.tolist() for index in np.nonzero(np.abs(delta) >= threshold)])
+    else:
+        cells = ((i, j) for i, row in enumerate(delta) for j, d in enumerate(row) if abs(d) >= threshold)
+    json_dict = defaultdict(lambda:defaultdict(lambda:defaultdict(str)))
+    for i, j in cells:
+        json_dict[keys[i]]['ref'][common[j]] = value_of(ref_side, i, j)
+        json_dict[keys[i]]['exp'][common[j]] = value_of(exp_side, i, j)
+
+    if output:
+        with open(output, 'w') as json_file:
+            json.dump(json_dict, json_file, indent=2)
+            json_file.write('\n')
+    return json_dict
+
+def write_report(rows, report, key):
+    with open(report, 'w') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow([key, 'item', 'ref', 'exp', 'delta', 'relative'])
+        for row in rows:
+            writer.writerow(list(row[:5]) + ['' if row[5] is None else '{:.2f}%'.format(row[5] * 100)])
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Show difference between *.f.csv for interesting items')
+        description='Show difference between *.f.csv (or *.line.csv, *.insn.csv) for interesting items, joining the rows on their first column')
     parser.add_argument('ref', help='reference *.f.csv')
     parser.add_argument('exp', help='experiment *.f.csv')
     parser.add_argument('--items', required=True, help='items to compare')
-    parser.add_argument('-o', '--output', required=True, help='output json file')
+    parser.add_argument('-o', '--output', help='output json file')
+    parser.add_argument('--min-delta', type=int, default=0, help='only report the values differing by at least this much')
+    parser.add_argument('--report', help='output csv file of the differences ranked by absolute delta, with their relative delta')
+    parser.add_argument('--normalize', action='store_true', help='match the function names of both sides demangled and with their clone suffixes (.constprop.0, .isra.0, .cold, ...) folded, see name_match.py')
+    parser.add_argument('--cache-dir', help='directory of the cache of the name matches of --normalize')
+    parser.add_argument('--top', type=int, help='only keep this many differences in the report')
     args = parser.parse_args()
-    diff_csv(args.ref, args.exp, args.items.split(','), args.output)
+    assert args.output or args.report, 'no output'
+    items = args.items.split(',')
+    if args.output:
+        diff_csv(args.ref, args.exp, items, args.output, args.min_delta, args.normalize, args.cache_dir)
+    if args.report:
+        write_report(ranked_diff(args.ref, args.exp, items, args.min_delta, args.normalize, args.cache_dir)[:args.top], args.report, read_table(args.ref, [])[0])
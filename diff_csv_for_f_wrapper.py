@@ -1,6 +1,33 @@
 #!/usr/bin/env python3
 
-import argparse, csv, os, json, tempfile, subprocess
+import argparse, csv, os, json, sys
+from concurrent.futures import ProcessPoolExecutor
+from diff_csv_for_f import diff_csv
+
+def read_mapping(mapping_csv):
+    """Return the rows of mapping_csv by workload name."""
+    with open(mapping_csv, 'r') as csv_file:
+        return {row['name']: row for row in csv.DictReader(csv_file)}
+
+def diff_pairs(ref_dir, exp_dir, ref_rows, exp_rows):
+    """Yield the workload name and the ref and exp *.f.csv of each sim file of the workloads of both sides, pairing
+    the workloads by name and their sim files by position."""
+    for name, ref_row in ref_rows.items():
+        if name not in exp_rows:
+            print(f'{name}: not in exp, skipped', file=sys.stderr)
+            continue
+        ref_sim_files = ref_row['sim_files'].split(',')
+        exp_sim_files = exp_rows[name]['sim_files'].split(',')
+        assert len(ref_sim_files) == len(exp_sim_files), 'sim_files mismatch'
+        for ref_sim_file, exp_sim_file in zip(ref_sim_files, exp_sim_files):
+            workload_name = name if len(ref_sim_files) == 1 else '{}.{}'.format(name, ref_sim_file.split('.')[0])
+            yield workload_name, os.path.join(ref_dir, name, f'{ref_sim_file}.f.csv'), os.path.join(exp_dir, name, f'{exp_sim_file}.f.csv')
+    for name in [name for name in exp_rows if name not in ref_rows]:
+        print(f'{name}: not in ref, skipped', file=sys.stderr)
+
+def diff_entry(ref_f_file_path, exp_f_file_path, items, min_delta, normalize, cache_dir):
+    """Return the JSON of the diff of a pair, indented to be an entry of the output."""
+    return json.dumps(diff_csv(ref_f_file_path, exp_f_file_path, items, None, min_delta, normalize, cache_dir), indent=2).replace('\n', '\n  ')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -10,31 +37,22 @@ if __name__ == '__main__':
     parser.add_argument('--ref_csv', required=True, help='csv file to describe the mappings for ref')
     parser.add_argument('--exp_csv', required=True, help='csv file to describe the mappings for exp')
     parser.add_argument('--items', required=True, help='items to compare')
+    parser.add_argument('--min-delta', type=int, default=0, help='only report the values differing by at least this much')
+    parser.add_argument('--normalize', action='store_true', help='match the function names across builds (see diff_csv_for_f.py --normalize)')
+    parser.add_argument('--cache-dir', help='directory of the cache of the name matches of --normalize')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes to diff with (default: number of cpus)')
     parser.add_argument('-o', '--output', required=True, help='output json file')
     args = parser.parse_args()
 
-    repo = os.path.dirname(os.path.realpath(__file__))
-    out_dict = {}
-    with open(args.ref_csv, 'r') as ref_csv_file, open(args.exp_csv, 'r') as exp_csv_file:
-        ref_reader = csv.DictReader(ref_csv_file)
-        exp_reader = csv.DictReader(exp_csv_file)
-        for ref_row, exp_row in zip(ref_reader, exp_reader):
-            name = ref_row['name']
-            assert name == exp_row['name'], 'name mismatch'
-            ref_sim_files = ref_row['sim_files'].split(',')
-            exp_sim_files = exp_row['sim_files'].split(',')
-            assert len(ref_sim_files) == len(exp_sim_files), 'sim_files mismatch'
-            for ref_sim_file, exp_sim_file in zip(ref_sim_files, exp_sim_files):
-                ref_f_file_path = os.path.join(args.ref, name, f'{ref_sim_file}.f.csv')
-                exp_f_file_path = os.path.join(args.exp, name, f'{exp_sim_file}.f.csv')
-                tmp = tempfile.NamedTemporaryFile(delete=False)
-                subprocess.run([os.path.join(repo, 'diff_csv_for_f.py'), ref_f_file_path, exp_f_file_path, f'--items={args.items}', '-o', tmp.name], check=True)
-                with open(tmp.name, 'r') as tmp_file:
-                    json_dict = json.load(tmp_file)
-                    workload_name = name if len(ref_sim_files) == 1 else '{}.{}'.format(name, ref_sim_file.split('.')[0])
-                    out_dict[workload_name] = json_dict
-                os.unlink(tmp.name)
-
-    with open(args.output, 'w') as out_file:
-        json.dump(out_dict, out_file, indent=2)
-        out_file.write('\n')
+    pairs = list(diff_pairs(args.ref, args.exp, read_mapping(args.ref_csv), read_mapping(args.exp_csv)))
+    items = args.items.split(',')
+    # The diffs run in parallel, and each is written, in the order of the mappings, as soon as it and the ones
+    # before it are done, in the same bytes as json.dump(..., indent=2) of the dict of all of them
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor, open(args.output, 'w') as out_file:
+        futures = [executor.submit(diff_entry, ref_f_file_path, exp_f_file_path, items, args.min_delta, args.normalize, args.cache_dir)
+                   for _, ref_f_file_path, exp_f_file_path in pairs]
+        out_file.write('{')
+        for i, ((workload_name, _, _), future) in enumerate(zip(pairs, futures)):
+            out_file.write(('' if i == 0 else ',') + f'\n  {json.dumps(workload_name)}: {future.result()}')
+            out_file.flush()
+        out_file.write('\n}\n' if pairs else '}\n')
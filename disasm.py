@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import argparse, csv, hashlib, json, os, re, subprocess
+from subprocess import PIPE
+from staging import stage_file
+from symcache import binary_key
+
+# Lines starting a chunk of the index: the first line of a function, e.g. "0000000000001139 <main>:", or of a section
+function_header = re.compile(rb'[0-9a-f]+ <(.*)>:$')
+section_header = b'Disassembly of section'
+# Address of the line of an instruction
+inst_address = re.compile(rb'\s*([0-9a-f]+):\s')
+
+# The index has a row per function, and per text out of the functions (name is empty), with its byte range in the
+# disassembly and the addresses of its first and last instructions
+index_fields = ['offset', 'length', 'name', 'start', 'end']
+
+def index_file(disasm):
+    return disasm + '.index.csv'
+
+def run_objdump(binary, disasm, objdump='objdump'):
+    """Stream the disassembly of binary by objdump to disasm, and write its index. The binary is named by its base
+    name only, so that the disassembly of the same binary is the same wherever it is."""
+    # Processes filling the same cache entry at once write their own files
+    tmp = f'.{os.getpid()}.tmp'
+    tmp_files = [disasm + tmp, index_file(disasm) + tmp]
+    # objdump runs in the directory of binary, so a path of it (rather than a name looked up in PATH) is made absolute
+    if os.sep in objdump or (os.altsep and os.altsep in objdump):
+        objdump = os.path.abspath(objdump)
+    rows = []
+    try:
+        with open(tmp_files[0], 'wb') as disasm_file, \
+             subprocess.Popen([objdump, '-d', os.path.basename(binary)], cwd=os.path.dirname(binary) or None, stdout=PIPE) as process:
+            offset, row = 0, [0, 0, '', '', '']
+            for raw_line in process.stdout:
+                disasm_file.write(raw_line)
+                line = raw_line.rstrip()
+                if (matches := function_header.match(line)) or line.startswith(section_header):
+                    row[1] = offset - row[0]
+                    if row[1]:
+                        rows.append(row)
+                    row = [offset, 0, matches.group(1).decode() if matches else '', '', '']
+                elif row[2] and (matches := inst_address.match(line)):
+                    row[3] = row[3] or matches.group(1).decode()
+                    row[4] = matches.group(1).decode()
+                offset += len(raw_line)
+            row[1] = offset - row[0]
+            if row[1]:
+                rows.append(row)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        with open(tmp_files[1], 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(index_fields)
+            writer.writerows(rows)
+        os.replace(tmp_files[0], disasm)
+        os.replace(tmp_files[1], index_file(disasm))
+    finally:
+        # Left behind only when objdump or the writes failed
+        for path in tmp_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+def copy_disasm(src, dst, index=False):
+    """Copy the disassembly src to dst, with its index if index, as links when the file system allows it."""
+    stage_file(src, dst)
+    if index:
+        stage_file(index_file(src), index_file(dst))
+    elif os.path.isfile(index_file(dst)):
+        os.remove(index_file(dst))
+
+def disassemble(binary, disasm, objdump='objdump', cache_dir=None, index=False):
+    """Write the disassembly of binary by objdump to disasm, with its index if index. With cache_dir, the
+    disassemblies are kept there by the content and name of the binary, and objdump only runs on new binaries."""
+    if not cache_dir:
+        run_objdump(binary, disasm, objdump)
+        if not index:
+            os.remove(index_file(disasm))
+        return
+    key = hashlib.sha256(json.dumps([binary_key(binary), os.path.basename(binary), objdump]).encode()).hexdigest()
+    cached = os.path.join(cache_dir, 'disasm', key + '.disasm')
+    # The index is written last, so the disassembly is complete if it exists
+    if not os.path.isfile(index_file(cached)):
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        run_objdump(binary, cached, objdump)
+    copy_disasm(cached, disasm, index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Disassemble a binary with objdump, streaming its output to a file, with an index of its functions for annotater.py --hot-threshold to seek to the hot ones.')
+    parser.add_argument('binary', help='binary to disassemble')
+    parser.add_argument('-o', '--output', help='disassembly file (default: BINARY.disasm)')
+    parser.add_argument('--objdump', default='objdump', help='path to objdump')
+    parser.add_argument('--cache-dir', help='directory of the cache of the disassemblies')
+    parser.add_argument('--index', action='store_true', help='also write the index of the functions to OUTPUT.index.csv')
+    args = parser.parse_args()
+    disassemble(args.binary, args.output or args.binary + '.disasm', args.objdump, args.cache_dir, args.index)
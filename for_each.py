@@ -1,60 +1,138 @@
 #!/usr/bin/env python3
-import argparse, csv, os, subprocess, glob
-from subprocess import PIPE
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse, ast, csv, functools, glob, os
+import annotater, bb2fline, csv2json, disasm, profile_io, sde2csv
+from pipeline import Pipeline, Stage, available_memory
 
-def process_file(repo, sub_dir, sim_file, exe_path, items, disasm, args):
+@functools.lru_cache(maxsize=None)
+def script_files(repo, name):
+    """Return the script name of repo with the modules of repo it imports, directly or not, whose changes change what
+    its stage makes."""
+    files, names = [], [name]
+    while names:
+        path = os.path.join(repo, names.pop())
+        if path in files or not os.path.isfile(path):
+            continue
+        files.append(path)
+        with open(path, 'r') as f:
+            for node in ast.walk(ast.parse(f.read())):
+                if isinstance(node, ast.Import):
+                    names += [alias.name + '.py' for alias in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.module:
+                    names.append(node.module + '.py')
+    return files
+
+def add_stages(pipeline, repo, sub_dir, sim_file, exe_path, items, disasm_file, args):
     # X -> Y means X relies on Y
-    # annotater -> csv2json -> sde2csv
-    #           -> objdump
+    # annotater -> sde2csv
+    #           -> disasm
+    #
+    # csv2json -> sde2csv
     #
     # bb2fline -> sde2csv
+    #
+    # Each script and the modules it imports are inputs of its stage, so that the stage runs again after they change.
+    # All the stages of a sim file are weighted by its size, which orders them and estimates their memory. On a sim
+    # file whose blocks are all distinct, the worst case, sde2csv.py and bb2fline.py peak at 0.8-0.9 bytes of
+    # anonymous memory per byte of it (bench_sde2csv.py --distinct-blocks), the other steps at less, hence the
+    # default --memory-ratio of 1; the pages of the mapped sim file are not counted, as the kernel can reclaim them.
     sim_file_path = os.path.join(sub_dir, sim_file)
-    subprocess.run([os.path.join(repo, 'sde2csv.py'), sim_file_path, exe_path, f'--items={items}'], check=True)
-    csv_files = glob.glob(f'{sim_file_path}.*.csv')
-    subprocess.run([os.path.join(repo, 'csv2json.py')] + csv_files, check=True)
-    annotater_popen = subprocess.Popen([os.path.join(repo, 'annotater.py'), disasm, f'{sim_file_path}.json'])
-    bb2fline_popen = subprocess.Popen([os.path.join(repo, 'bb2fline.py'), f'{sim_file_path}.bb.csv', exe_path, '--addr2line', args.addr2line])
-    return [annotater_popen, bb2fline_popen]
+    script = lambda name: script_files(repo, name)
+    formats = args.format.split(',')
+    csv_files = [f'{sim_file_path}.{table}.csv' for table in ['bb', 'insn', 'global']]
+    npz_file = f'{sim_file_path}.npz'
+    def table_files(prefix, tables=profile_io.tables):
+        return ([profile_io.csv_file(prefix, table) for table in tables] if 'csv' in formats else []) + \
+               ([profile_io.npz_file(prefix)] if 'npz' in formats else []) + ([profile_io.mix_file(prefix)] if args.full_mix else [])
+    tables = table_files(sim_file_path)
+    tables += [profile_io.images_file(sim_file_path)] if args.all_images else []
+    # The section index is only kept for an uncompressed sim file
+    tables += [sim_file_path + '.idx'] if not profile_io.is_compressed(sim_file_path) else []
+    # The threads and the images are only known once the sim file is read
+    prefix = glob.escape(sim_file_path)
+    patterns = table_files(profile_io.thread_file(prefix, '[0-9]*')) if args.threads else []
+    patterns += table_files(profile_io.image_file(prefix, '*'), ['bb', 'insn']) if args.all_images else []
+    pipeline.add(Stage(f'sde2csv {sim_file_path}',
+                       [sde2csv.convert_sde_perf_to_csv, sim_file_path, exe_path, 1, formats, items, args.threads, args.all_images, args.full_mix],
+                       script('sde2csv.py') + [sim_file_path, exe_path], tables, weight=[sim_file_path], output_patterns=patterns))
+
+    json_inputs = csv_files if 'csv' in formats else [npz_file]
+    json_file = csv2json.json_file_of(sim_file_path, args.compress_json)
+    pipeline.add(Stage(f'csv2json {sim_file_path}', [csv2json.convert_to_json, json_inputs, args.compact_json, args.compress_json],
+                       script('csv2json.py') + json_inputs, [json_file], weight=[sim_file_path]))
+
+    bb_file = csv_files[0] if 'csv' in formats else npz_file
+    insn_file = csv_files[1] if 'csv' in formats else npz_file
+    global_file = csv_files[2] if 'csv' in formats else npz_file
+    index = [disasm.index_file(disasm_file)] if args.disasm_index else []
+    pipeline.add(Stage(f'annotater {sim_file_path}', [annotater.annotate, disasm_file, insn_file, args.hot_threshold],
+                       script('annotater.py') + [disasm_file, insn_file, global_file] + index, [f'{sim_file_path}.annotated'], weight=[sim_file_path]))
+    fline_files = lambda prefix: [f'{prefix}.f.csv', f'{prefix}.line.csv'] + ([f'{prefix}.insn.f.csv', f'{prefix}.insn.line.csv'] if args.per_insn else [])
+    images = [profile_io.images_file(sim_file_path)] if args.all_images else []
+    pipeline.add(Stage(f'bb2fline {sim_file_path}',
+                       [bb2fline.bb_file_to_fline, bb_file, exe_path, args.addr2line, args.cache_dir, args.per_insn, args.all_images],
+                       script('bb2fline.py') + [bb_file, exe_path] + ([insn_file] if args.per_insn else []) + images, fline_files(sim_file_path),
+                       weight=[sim_file_path], output_patterns=fline_files(profile_io.image_file(prefix, '*')) if args.all_images else []))
+
+def add_disasm_stage(pipeline, repo, exe_path, disasm_files, args):
+    """Add the stage making the disassembly of exe_path and return it. The binaries of the same content and name
+    are disassembled once, and the other ones get a copy of it."""
+    disasm_file = exe_path + '.disasm'
+    index = lambda path: [disasm.index_file(path)] if args.disasm_index else []
+    key = (pipeline.stamps.file_hash(os.path.abspath(exe_path)), os.path.basename(exe_path))
+    first_disasm = disasm_files.setdefault(key, disasm_file)
+    if first_disasm == disasm_file:
+        pipeline.add(Stage(f'disasm {disasm_file}', [disasm.disassemble, exe_path, disasm_file, args.objdump, args.cache_dir, args.disasm_index],
+                           script_files(repo, 'disasm.py') + [exe_path], [disasm_file] + index(disasm_file)))
+    else:
+        pipeline.add(Stage(f'disasm {disasm_file}', [disasm.copy_disasm, first_disasm, disasm_file, args.disasm_index],
+                           script_files(repo, 'disasm.py') + [first_disasm] + index(first_disasm), [disasm_file] + index(disasm_file), weight=[exe_path]))
+    return disasm_file
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Process all the files in the directory by running sde2csv, csv2json, annotater, bb2fline on them. The mapping from workloads to files is described by a csv file, where name, exe, sim_files are required.')
+        description='Process all the files in the directory by running sde2csv, csv2json, annotater, bb2fline on them. The mapping from workloads to files is described by a csv file, where name, exe, sim_files are required. A step is skipped when its command and the content of its inputs are unchanged since it last ran and its outputs are untouched.')
     parser.add_argument('dir', help='directory of the inputs')
     parser.add_argument('--csv', required=True, help='csv file to describe the mappings')
     parser.add_argument('--items', help='extra interesting items in sim_files')
+    parser.add_argument('--format', default='csv', help='output formats of sde2csv (csv,npz)')
     parser.add_argument('--objdump', default='objdump', help='path to objdump (this is needed if instruction in binary is not supported by system objdump)')
-    parser.add_argument('--addr2line', default='addr2line', help='path of addr2line (this is needed if dwarf format of binary is not supported by system addr2line)')
+    parser.add_argument('--addr2line', help='path of addr2line for bb2fline to use instead of its built-in symbolizer (this is needed if dwarf format of binary is not supported by it)')
+    parser.add_argument('--cache-dir', help='directory of the symbol cache of bb2fline and of the cache of the disassemblies')
+    parser.add_argument('--disasm-index', action='store_true', help='also write the index of the functions of the disassemblies, which annotater --hot-threshold seeks by (see disasm.py --index)')
+    parser.add_argument('--all-images', action='store_true', help='also profile every image, such as the shared libraries, each symbolized with its own file (see sde2csv.py --all-images)')
+    parser.add_argument('--threads', action='store_true', help='also write the tables of each thread (see sde2csv.py --threads)')
+    parser.add_argument('--full-mix', action='store_true', help='also write the counts of all the records of the blocks to *.mix.npz (see sde2csv.py --full-mix)')
+    parser.add_argument('--per-insn', action='store_true', help='also attribute the icount of each instruction to its function and source line (see bb2fline.py --per-insn)')
+    parser.add_argument('--compact-json', action='store_true', help='write the JSON files without indentation (see csv2json.py --compact)')
+    parser.add_argument('--compress-json', choices=list(profile_io.compressions), help='compress the JSON files (see csv2json.py --compress)')
+    parser.add_argument('--hot-threshold', type=float, help='only annotate the functions whose icount is at least this percent of the total (see annotater.py --hot-threshold)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of steps to run at once (default: number of cpus)')
+    parser.add_argument('--memory', type=float, help='memory budget of the steps running at once in GiB (default: available memory)')
+    parser.add_argument('--memory-ratio', type=float, default=1.0, help='estimated memory of a step per byte of its sim file (the default bounds the peak of the largest steps on a sim file of distinct blocks)')
+    parser.add_argument('--force', action='store_true', help='run all the steps even if they are up to date')
     args = parser.parse_args()
 
     repo = os.path.dirname(os.path.realpath(__file__))
     dir_path = args.dir
-    items = args.items if args.items else ''
+    items = [s.strip() for s in args.items.split(',')] if args.items else None
 
+    # The stamps of the steps that ran are kept in the directory of the inputs
+    memory = args.memory * (1 << 30) if args.memory else available_memory()
+    pipeline = Pipeline(os.path.join(dir_path, '.for_each.stamps.json'), args.jobs, args.force, memory, args.memory_ratio)
+    # Disassemblies by the content and name of their binaries
+    disasm_files = {}
     with open(args.csv, 'r') as csv_file:
         reader = csv.DictReader(csv_file)
-        futures = []
-        popen_objs = []
-
-        with ThreadPoolExecutor() as executor:
-            for row in reader:
-                name = row['name']
-                exe = row['exe']
-                sim_files = row['sim_files'].split(',')
-                sub_dir = os.path.join(dir_path, name)
-                exe_path = os.path.join(sub_dir, exe)
-
-                disasm = exe_path + '.disasm'
-                dump = subprocess.run([f'{args.objdump}', '-d', exe_path], stdout=PIPE, check=True)
-                with open(disasm, 'w') as disasm_file:
-                    disasm_file.write(dump.stdout.decode('utf-8'))
-                    os.fsync(disasm_file.fileno())
-
-                for sim_file in sim_files:
-                    future = executor.submit(process_file, repo, sub_dir, sim_file, exe_path, items, disasm, args)
-                    futures.append(future)
-
-            for future in as_completed(futures):
-                popen_objs.extend(future.result())
-
-        [obj.wait() for obj in popen_objs]
+        for row in reader:
+            name = row['name']
+            exe = row['exe']
+            sim_files = row['sim_files'].split(',')
+            sub_dir = os.path.join(dir_path, name)
+            exe_path = os.path.join(sub_dir, exe)
+
+            disasm_file = add_disasm_stage(pipeline, repo, exe_path, disasm_files, args)
+            for sim_file in sim_files:
+                add_stages(pipeline, repo, sub_dir, sim_file, exe_path, items, disasm_file, args)
+
+    failed = pipeline.run()
+    assert not failed, f'failed: {", ".join(failed)}'
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import argparse, csv, heapq, math, os, sys
+import profile_io
+from profile_io import np
+
+# Values are also counted in buckets of ratio 2^(1/16), so that the number of blocks covering a share of the total
+# can be estimated, in bounded memory, when it is beyond the top k.
+buckets_per_octave = 16
+
+def bucket_of(value):
+    return math.floor(math.log2(value) * buckets_per_octave)
+
+class HotRows:
+    """Top k rows by the metric of a stream of rows, with the number of rows, their total and a histogram of it."""
+
+    def __init__(self, metric, k):
+        self.metric = metric
+        self.k = k
+        self.heap = []
+        self.count = 0
+        self.total = 0
+        self.buckets = {}
+
+    def add(self, row):
+        value = int(row[self.metric] or 0)
+        self.count += 1
+        self.total += value
+        if value > 0:
+            bucket = self.buckets.setdefault(bucket_of(value), [0, 0])
+            bucket[0] += 1
+            bucket[1] += value
+        # Ties keep the first rows, as a stable sort would
+        item = (value, -self.count, row)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        elif item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def top(self):
+        """Return the top rows with their values, largest first."""
+        return [(value, row) for value, _, row in sorted(self.heap, key=lambda item: item[:2], reverse=True)]
+
+    def coverage(self, percent):
+        """Return the number of the largest rows making up percent of the total, and whether it is exact."""
+        target = self.total * percent / 100
+        covered = 0
+        for n, (value, _) in enumerate(self.top(), 1):
+            covered += value
+            if covered >= target:
+                return n, True
+        if target <= 0:
+            return 0, True
+        # Beyond the top k, assume the values of a bucket are all its mean
+        n, covered = 0, 0
+        for bucket in sorted(self.buckets, reverse=True):
+            count, total = self.buckets[bucket]
+            if covered + total >= target:
+                n += math.ceil((target - covered) / (total / count))
+                break
+            n += count
+            covered += total
+        return max(n, len(self.heap) + 1), False
+
+def hot_rows(reader, metric, k):
+    hot = HotRows(metric, k)
+    for row in reader:
+        hot.add(row)
+    return hot
+
+def top_indices(values, k):
+    """Return the indices of the k largest values, largest first, the first ones first among equal values."""
+    if k >= len(values):
+        return np.argsort(-values, kind='stable')
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # The values above the k-th largest, and the first of the ones equal to it
+    kth = values[np.argpartition(values, len(values) - k)[len(values) - k]]
+    above = np.flatnonzero(values > kth)
+    candidates = np.concatenate([above, np.flatnonzero(values == kth)[:k - len(above)]])
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+def hot_columns(columns, metric, key, k):
+    """Return the HotRows of the columns of load_columns() (or None), with rows of only key, whole-column at once."""
+    hot = HotRows(metric, k)
+    if columns is None or not len(columns[metric]):
+        return hot
+    values = columns[metric]
+    hot.count, hot.total = len(values), int(values.sum())
+    positive = values[values > 0]
+    buckets, inverse = np.unique(np.floor(np.log2(positive) * buckets_per_octave).astype(np.int64), return_inverse=True)
+    counts, totals = np.bincount(inverse, minlength=len(buckets)), np.zeros(len(buckets), dtype=np.int64)
+    np.add.at(totals, inverse, positive)
+    hot.buckets = {bucket: [count, total] for bucket, count, total in zip(buckets.tolist(), counts.tolist(), totals.tolist())}
+    top = top_indices(values, k)
+    keys = ['{:x}'.format(val) for val in columns[key][top].tolist()] if key in profile_io.address_columns else columns[key][top].tolist()
+    hot.heap = [(value, -(i + 1), {key: key_value}) for i, value, key_value in zip(top.tolist(), values[top].tolist(), keys)]
+    heapq.heapify(hot.heap)
+    return hot
+
+def hot_table(sim_file, table, metric, k, fmt=None):
+    """Return the HotRows of table of sim_file, read in the format of profile_io.read_format(sim_file, fmt): only the
+    key and metric columns of npz, or the rows of CSV one by one."""
+    key = 'entry' if table == 'bb' else 'pc'
+    if profile_io.read_format(sim_file, fmt) == 'npz':
+        _, columns = profile_io.load_columns(sim_file, table, 'npz', [key, metric])
+        return hot_columns(columns, metric, key, k)
+    with profile_io.open_table(sim_file, table, fmt) as reader:
+        return hot_rows(reader, metric, k)
+
+def ratio_number(k, n):
+    return '{:.2f}%'.format(k / n * 100 if n else 0)
+
+def report(hot, title, key, percents, out):
+    print(f'{title}: {format(hot.count, ",")}, {hot.metric} {format(hot.total, ",")}', file=out)
+    for percent in percents:
+        n, exact = hot.coverage(percent)
+        print(f'  {percent:g}% of {hot.metric} in {"" if exact else "~"}{format(n, ",")} ({ratio_number(n, hot.count)} of them)', file=out)
+    cumulative = 0
+    for rank, (value, row) in enumerate(hot.top(), 1):
+        cumulative += value
+        print(f'  {rank:>4} {row[key]:<24} {format(value, ","):>16} {ratio_number(value, hot.total):>8} {ratio_number(cumulative, hot.total):>8}', file=out)
+
+def report_threads(sim_file, table, metric, k, percents, out, fmt=None):
+    """Report the icount of each thread of sim_file with the imbalance between them, then the top k rows of table of
+    each thread, read in the format fmt (see profile_io.read_format())."""
+    tids = profile_io.thread_ids(sim_file)
+    icounts = {}
+    for tid in tids:
+        with profile_io.open_table(profile_io.thread_file(sim_file, tid), 'global', fmt) as reader:
+            icounts[tid] = int(next(iter(reader), {}).get('total') or 0)
+    total = sum(icounts.values())
+    mean = total / len(tids) if tids else 0
+    # The imbalance is how much longer the busiest thread runs than if the work were evenly spread
+    print(f'threads: {len(tids)}, total {format(total, ",")}, max/mean {max(icounts.values(), default=0) / mean if mean else 0:.2f}', file=out)
+    for tid in tids:
+        print(f'  tid {tid:<4} {format(icounts[tid], ","):>16} {ratio_number(icounts[tid], total):>8}', file=out)
+    for tid in tids:
+        hot = hot_table(profile_io.thread_file(sim_file, tid), table, metric, k, fmt)
+        report(hot, f'thread {tid} {"blocks" if table == "bb" else "instructions"}', 'entry' if table == 'bb' else 'pc', percents, out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Report the top k blocks (or instructions) and functions by icount of a profile, and how many of them make up a share of the icount, in a single pass with memory bounded by k.')
+    parser.add_argument('profile', help='*.bb.csv, *.insn.csv or *.npz of sde2csv.py')
+    parser.add_argument('-k', type=int, default=20, help='number of top blocks and functions to show')
+    parser.add_argument('--table', choices=['bb', 'insn'], default='bb', help='rank the blocks of the bb table, or the instructions of the insn table')
+    parser.add_argument('--metric', help='column to rank by (default: total for bb, execution for insn)')
+    parser.add_argument('--percents', default='50,90,99', help='comma-separated shares of the metric to report the coverage of')
+    parser.add_argument('--threads', action='store_true', help='also report the icount of each thread and the imbalance between them, and the top blocks of each thread (see sde2csv.py --threads)')
+    args = parser.parse_args()
+
+    sim_file = profile_io.sim_file_of(args.profile)
+    metric = args.metric or ('total' if args.table == 'bb' else 'execution')
+    percents = [float(s) for s in args.percents.split(',')]
+    hot = hot_table(sim_file, args.table, metric, args.k, profile_io.table_format(args.profile))
+    report(hot, 'blocks' if args.table == 'bb' else 'instructions', 'entry' if args.table == 'bb' else 'pc', percents, sys.stdout)
+
+    # Functions come from the *.f.csv of bb2fline.py, when it has the metric
+    f_csv = sim_file + '.f.csv'
+    if os.path.isfile(f_csv):
+        with open(f_csv, 'r') as f:
+            reader = csv.DictReader(f)
+            if metric in (reader.fieldnames or []):
+                report(hot_rows(reader, metric, args.k), 'functions', 'name', percents, sys.stdout)
+    if args.threads:
+        report_threads(sim_file, args.table, metric, args.k, percents, sys.stdout, profile_io.table_format(args.profile))
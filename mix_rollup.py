@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse, csv, fnmatch, sys
+import profile_io, symcache
+from profile_io import np
+from bb2fline import fline_of, group_ids
+
+def select_keys(keys, patterns):
+    """Return the columns of the keys matching each of the shell-style patterns."""
+    return [np.flatnonzero([fnmatch.fnmatchcase(key, pattern) for key in keys]) for pattern in patterns]
+
+def rollup(mix, groups, group_count, patterns):
+    """Sum the counts of the records matching each of patterns by the group of the block of each row, groups being the
+    group of each row, and return the sums as an array of group_count x len(patterns)."""
+    keys = mix['keys'].tolist()
+    rows, columns, counts = mix['row'], mix['column'], mix['count']
+    sums = np.zeros((group_count, len(patterns)), dtype=np.int64)
+    for i, selected in enumerate(select_keys(keys, patterns)):
+        nonzeros = np.isin(columns, selected)
+        np.add.at(sums[:, i], groups[rows[nonzeros]], counts[nonzeros])
+    return sums
+
+def mix_to_fline(sim_file, binary, patterns, share=False, addr2line=None, cache_dir=None):
+    """Write the counts of the records of the full mix of sim_file matching each of patterns summed by function to
+    *.mix.f.csv and by source line to *.mix.line.csv, with the icount of each, as shares of it if share."""
+    mix = profile_io.load_mix(sim_file)
+    cache = symcache.SymbolCache(cache_dir) if cache_dir else None
+    # Symbolize each distinct entry once, in order of first appearance so that the groups are too
+    entries, first, inverse = np.unique(mix['entry'], return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    names, source_lines = fline_of(['{:x}'.format(entry) for entry in entries[order].tolist()], binary, addr2line, cache) if len(entries) else ([], [])
+    if cache:
+        print(cache.stats(), file=sys.stderr)
+        cache.close()
+
+    for suffix, first_column, keys in [('.mix.f.csv', 'name', names), ('.mix.line.csv', 'source_line', source_lines)]:
+        entry_ids, groups = group_ids(keys)
+        row_groups = np.asarray(entry_ids, dtype=np.int64)[rank[inverse.reshape(-1)]]
+        sums = rollup(mix, row_groups, len(groups), ['total'] + patterns)
+        with open(sim_file + suffix, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow([first_column, 'total'] + patterns)
+            for key, row in zip(groups, sums.tolist()):
+                total, counts = row[0], row[1:]
+                writer.writerow([key, total] + (['{:.6f}'.format(count / total) if total else '' for count in counts] if share else counts))
+
+def list_keys(sim_file, out=sys.stdout):
+    """Print the records of the full mix of sim_file with their global count and their count summed over the blocks."""
+    mix = profile_io.load_mix(sim_file)
+    block_counts = np.bincount(mix['column'], weights=mix['count'], minlength=len(mix['keys']))
+    print(f'{"key":<48} {"global":>16} {"blocks":>16}', file=out)
+    for key, global_count, block_count in zip(mix['keys'].tolist(), mix['global'].tolist(), block_counts.tolist()):
+        print(f'{key:<48} {format(global_count, ","):>16} {format(round(block_count), ","):>16}', file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sum any records of the full instruction mix of sde2csv.py --full-mix (e.g. isa-ext-AVX512*) by function and by source line, as a reduction of its sparse block x record matrix.')
+    parser.add_argument('sim_file', help='SDE file (or profile prefix, e.g. a.err.tid1 or a.err.image.libc.so.6) whose *.mix.npz to read')
+    parser.add_argument('binary', nargs='?', help='profiled binary (or file of the image)')
+    parser.add_argument('--keys', help='comma-separated shell-style patterns of records, each summed into a column of *.mix.f.csv and *.mix.line.csv, e.g. isa-ext-AVX512*,category-X87_ALU')
+    parser.add_argument('--share', action='store_true', help='write the sums as shares of the icount of each function or source line')
+    parser.add_argument('--list', action='store_true', help='list the records of the mix with their counts instead')
+    parser.add_argument('--addr2line', help='path of addr2line to use instead of the built-in symbolizer')
+    parser.add_argument('--cache-dir', help='directory of a symbol cache shared by the runs on the same binary')
+    args = parser.parse_args()
+    if args.list:
+        list_keys(args.sim_file)
+    else:
+        assert args.binary and args.keys, 'binary and --keys are required'
+        mix_to_fline(args.sim_file, args.binary, [s.strip() for s in args.keys.split(',')], args.share, args.addr2line, args.cache_dir)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import argparse, csv, hashlib, json, os, re, subprocess
+from subprocess import PIPE
+
+# Suffixes of the clones made by GCC/LLVM (foo.constprop.0, foo.isra.0, foo.cold, foo.lto_priv.0, foo.llvm.123, ...).
+# A bare number is not one: foo.1 and foo.2 are distinct local symbols of the same name (e.g. static variables of
+# different functions), not clones of foo.
+clone_suffix = re.compile(r'(?:\.(?:constprop|isra|part|cold|hot|lto_priv|llvm|clone|localalias|specialized|unlikely)(?:\.\d+)*)+$')
+
+# Version of the matching, part of the key of the cached matches, so that those of an older version are not reused
+version = 2
+
+def fold_clone(name):
+    return clone_suffix.sub('', name)
+
+def demangle(names, cxxfilt='c++filt'):
+    """Demangle names with a single c++filt, or return them as they are if there is no c++filt."""
+    if not names:
+        return []
+    try:
+        result = subprocess.run([cxxfilt], input='\n'.join(names), stdout=PIPE, stderr=PIPE, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return list(names)
+    demangled = result.stdout.splitlines()
+    return demangled if len(demangled) == len(names) else list(names)
+
+def base_name(name):
+    """Return name without its parameters, e.g. ns::foo<int> of ns::foo<int>(int) const."""
+    depth = 0
+    for i, c in enumerate(name):
+        if c == '<':
+            depth += 1
+        elif c == '>':
+            depth -= 1
+        elif c == '(' and depth == 0 and i > 0:
+            return name[:i]
+    return name
+
+def canonical_names(names, cxxfilt='c++filt'):
+    """Return the canonical name of each of names: demangled, with the clone suffixes folded."""
+    folded = [fold_clone(name) for name in names]
+    distinct = list(dict.fromkeys(folded))
+    canonical = dict(zip(distinct, demangle(distinct, cxxfilt)))
+    return [canonical[name] for name in folded]
+
+def match_names(ref_names, exp_names, cache_dir=None, cxxfilt='c++filt'):
+    """Return dicts of the key of each of ref_names and of exp_names, equal for the names of the same function of both
+    sides: the canonical names, and for the ones still unmatched, the canonical name of ref of the same unique base
+    name. The mapping of the same names is read from cache_dir if it was cached there."""
+    ref_names, exp_names = list(dict.fromkeys(ref_names)), list(dict.fromkeys(exp_names))
+    if cache_dir:
+        digest = hashlib.sha256(json.dumps([version, sorted(ref_names), sorted(exp_names)]).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, 'name_matches', digest + '.json')
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                ref_keys, exp_keys = json.load(f)
+            return ref_keys, exp_keys
+
+    canonical = canonical_names(ref_names + exp_names, cxxfilt)
+    ref_keys = dict(zip(ref_names, canonical[:len(ref_names)]))
+    exp_keys = dict(zip(exp_names, canonical[len(ref_names):]))
+
+    # Fuzzy match the functions whose parameters changed, when their base name is unique on both sides
+    ref_only = set(ref_keys.values()) - set(exp_keys.values())
+    exp_only = set(exp_keys.values()) - set(ref_keys.values())
+    bases = []
+    for keys in [ref_only, exp_only]:
+        by_base = {}
+        for key in keys:
+            by_base.setdefault(base_name(key), []).append(key)
+        bases.append({base: keys[0] for base, keys in by_base.items() if len(keys) == 1})
+    renames = {bases[1][base]: key for base, key in bases[0].items() if base in bases[1]}
+    exp_keys = {name: renames.get(key, key) for name, key in exp_keys.items()}
+
+    if cache_dir:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump([ref_keys, exp_keys], f)
+        os.replace(cache_file + '.tmp', cache_file)
+    return ref_keys, exp_keys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show how the function names of two *.f.csv are matched by diff_csv_for_f.py --normalize.')
+    parser.add_argument('ref', help='reference *.f.csv')
+    parser.add_argument('exp', help='experiment *.f.csv')
+    parser.add_argument('--cache-dir', help='directory of the cache of the matches')
+    args = parser.parse_args()
+    names = []
+    for path in [args.ref, args.exp]:
+        with open(path, 'r') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            names.append([row[0] for row in reader])
+    ref_keys, exp_keys = match_names(names[0], names[1], args.cache_dir)
+    for side, keys in [('ref', ref_keys), ('exp', exp_keys)]:
+        for name, key in keys.items():
+            if name != key:
+                print(f'{side}: {name} -> {key}')
@@ -0,0 +1,195 @@
+import glob, hashlib, heapq, json, multiprocessing, os, subprocess, sys, threading, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# A stage is skipped when it ran before with the same command on inputs of the same content and its outputs
+# are as it left them. The content of a file is hashed again only when its size or mtime changed.
+
+class Stage:
+    """A command making outputs from inputs, with its stdout written to the file stdout if given. The command is
+    either the arguments of a program, or a module-level function followed by its arguments, called in a worker
+    process of the pipeline. The files matching the glob patterns of output_patterns once it ran, which are not known
+    before, are outputs of it too. The size of the stage is the total size of the files of weight (all the inputs by
+    default) that exist when it is added."""
+
+    def __init__(self, name, cmd, inputs, outputs, stdout=None, weight=None, output_patterns=()):
+        self.name = name
+        self.cmd = list(cmd) if callable(cmd[0]) else [str(arg) for arg in cmd]
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.outputs = [os.path.abspath(path) for path in outputs]
+        self.output_patterns = [os.path.abspath(pattern) for pattern in output_patterns]
+        self.stdout = os.path.abspath(stdout) if stdout else None
+        self.size = sum(os.path.getsize(path) for path in (inputs if weight is None else weight) if os.path.isfile(path))
+
+class Stamps:
+    """Content hashes of files and signatures of the stages that ran, kept in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files, self.stages = {}, {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.files, self.stages = data['files'], data['stages']
+
+    def stat(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def file_hash(self, path):
+        stat = self.stat(path)
+        with self.lock:
+            known = self.files.get(path)
+        if known and known[:2] == stat:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.files[path] = stat + [digest.hexdigest()]
+        return digest.hexdigest()
+
+    def signature(self, stage):
+        cmd = [f'{arg.__module__}.{arg.__qualname__}' if callable(arg) else arg for arg in stage.cmd]
+        digest = hashlib.sha256(json.dumps([cmd, stage.stdout]).encode())
+        for path in stage.inputs:
+            digest.update(self.file_hash(path).encode())
+        return digest.hexdigest()
+
+    def is_up_to_date(self, stage, signature):
+        with self.lock:
+            known = self.stages.get(stage.name)
+        if not known or known['signature'] != signature:
+            return False
+        return all(os.path.exists(path) and self.stat(path) == stat for path, stat in known['outputs'].items())
+
+    def record(self, stage, signature):
+        paths = stage.outputs + sorted({path for pattern in stage.output_patterns for path in glob.glob(pattern)} - set(stage.outputs))
+        outputs = {path: self.stat(path) for path in paths}
+        for path in paths:
+            self.file_hash(path)
+        with self.lock:
+            self.stages[stage.name] = {'signature': signature, 'outputs': outputs}
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.files, 'stages': self.stages}, f)
+        os.replace(tmp, self.path)
+
+def call(function, *args):
+    """Call function, dropping its result, which is only for the callers in the same process."""
+    function(*args)
+
+def available_memory():
+    """Return the memory available for new processes in bytes, or None if unknown."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class Pipeline:
+    """Run at most max_workers stages at once, as soon as the stages making their inputs are done, largest first,
+    skipping the up-to-date ones. A stage is expected to need memory_ratio bytes of memory per byte of its size, and
+    no stage starts while that would exceed memory, unless no other stage runs."""
+
+    def __init__(self, stamp_file, max_workers=None, force=False, memory=None, memory_ratio=1.0):
+        self.stamps = Stamps(stamp_file)
+        self.max_workers = max_workers or os.cpu_count()
+        self.force = force
+        self.memory = memory
+        self.memory_ratio = memory_ratio
+        self.stages = {}
+
+    def add(self, stage):
+        """Add stage, unless a stage of the same name was added."""
+        self.stages.setdefault(stage.name, stage)
+        return self.stages[stage.name]
+
+    def run_stage(self, stage, processes):
+        """Run stage if it is not up to date, calling its function in processes, and return whether it ran."""
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        assert not missing, f'{stage.name}: missing inputs {missing}'
+        signature = self.stamps.signature(stage)
+        if not self.force and self.stamps.is_up_to_date(stage, signature):
+            return False
+        if callable(stage.cmd[0]):
+            processes.submit(call, *stage.cmd).result()
+        elif stage.stdout:
+            with open(stage.stdout, 'w') as f:
+                subprocess.run(stage.cmd, stdout=f, check=True)
+        else:
+            subprocess.run(stage.cmd, check=True)
+        self.stamps.record(stage, signature)
+        return True
+
+    def run(self):
+        """Run the pipeline and return the names of the stages that failed or depend on one that failed."""
+        producers = {path: stage.name for stage in self.stages.values() for path in stage.outputs}
+        deps = {name: {producers[path] for path in stage.inputs if path in producers} - {name}
+                for name, stage in self.stages.items()}
+        dependents = {name: [] for name in self.stages}
+        for name, names in deps.items():
+            for dep in names:
+                dependents[dep].append(name)
+
+        # Ready stages are kept in a heap, largest first, then in the order they were added
+        order = {name: i for i, name in enumerate(self.stages)}
+        ready = [(-self.stages[name].size, order[name], name) for name, names in deps.items() if not names]
+        heapq.heapify(ready)
+        waiting = {name: len(names) for name, names in deps.items()}
+        failed, ran, skipped = set(), 0, 0
+        used, running = 0, {}
+        total_size, done_size, ran_size = sum(stage.size for stage in self.stages.values()), 0, 0
+        start = time.time()
+        # The workers are spawned rather than forked from this multithreaded process, and are reused by the stages
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+             ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')) as processes:
+            while ready or running:
+                # Stages start strictly in order, so that a large stage waiting for memory is not starved by smaller ones
+                while ready and len(running) < self.max_workers:
+                    stage = self.stages[ready[0][2]]
+                    memory = stage.size * self.memory_ratio
+                    if running and self.memory is not None and used + memory > self.memory:
+                        break
+                    heapq.heappop(ready)
+                    used += memory
+                    running[executor.submit(self.run_stage, stage, processes)] = (stage, memory, time.time())
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, memory, stage_start = running.pop(future)
+                    used -= memory
+                    done_size += stage.size
+                    try:
+                        if future.result():
+                            ran += 1
+                            ran_size += stage.size
+                            status = 'done'
+                        else:
+                            skipped += 1
+                            status = 'up to date'
+                    except Exception as e:
+                        print(f'{stage.name}: {e}', file=sys.stderr)
+                        failed.add(stage.name)
+                        status = 'failed'
+                    else:
+                        for dependent in dependents[stage.name]:
+                            waiting[dependent] -= 1
+                            if waiting[dependent] == 0:
+                                heapq.heappush(ready, (-self.stages[dependent].size, order[dependent], dependent))
+                    # Estimate the remaining time from the bytes processed so far by the stages that ran
+                    elapsed = time.time() - start
+                    eta = f'{(total_size - done_size) * elapsed / ran_size:.0f}s' if ran_size else '?'
+                    print(f'[{ran + skipped + len(failed)}/{len(self.stages)}] {stage.name}: {status} in {time.time() - stage_start:.1f}s, '
+                          f'{elapsed:.0f}s elapsed, ETA {eta}', file=sys.stderr)
+
+        # The stages never started are downstream of a failure
+        blocked = [name for name, count in waiting.items() if count > 0]
+        print(f'{ran} stages ran, {skipped} up to date, {len(failed)} failed, {len(blocked)} blocked', file=sys.stderr)
+        return sorted(failed) + blocked
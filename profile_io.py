@@ -0,0 +1,292 @@
+import csv, gzip, io, lzma, os, re
+from array import array
+from contextlib import contextmanager
+
+# numpy is only needed for the columnar format
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# zstandard is only needed for *.zst files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A profile of a SDE file <sim_file> is made of the tables bb, insn and global, stored as
+# <sim_file>.<table>.csv and/or as the columns <table>/<column> of <sim_file>.npz, where
+# <table>/header keeps the order of the columns. Addresses are hex strings in CSV and uint64 in
+# npz, counters are int64 in npz and a missing counter (an empty cell in CSV) is 0 in npz, where
+# <table>/null/<column> marks the missing values so that they read back as empty cells.
+tables = ['bb', 'insn', 'global']
+address_columns = {'entry', 'exit', 'pc'}
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for the columnar (npz) profile format')
+
+def table_format(path):
+    """Return the format of the profile file path, 'npz' for <sim_file>.npz and 'csv' for <sim_file>.<table>.csv, or
+    None for a SDE file."""
+    if path.endswith('.npz'):
+        return 'npz'
+    if any(path.endswith(f'.{table}.csv') for table in tables):
+        return 'csv'
+    return None
+
+def read_format(sim_file, fmt=None):
+    """Return the format to read the tables of sim_file in: fmt if given, otherwise npz if <sim_file>.npz exists and
+    numpy is available, otherwise csv."""
+    if fmt == 'npz':
+        require_numpy()
+    if fmt:
+        return fmt
+    return 'npz' if np is not None and os.path.isfile(npz_file(sim_file)) else 'csv'
+
+def npz_file(sim_file):
+    return sim_file + '.npz'
+
+def csv_file(sim_file, table):
+    return f'{sim_file}.{table}.csv'
+
+# The profile of each thread of a SDE file, written by sde2csv.py --threads, is the profile of <sim_file>.tid<tid>
+def thread_file(sim_file, tid):
+    return f'{sim_file}.tid{tid}'
+
+def thread_ids(sim_file):
+    """Return the ids of the threads of sim_file that have a profile, in order."""
+    tid_regex = re.compile(re.escape(os.path.basename(sim_file)) + r'\.tid([0-9]+)\.(?:global\.csv|npz)$')
+    return sorted({int(matches.group(1)) for name in os.listdir(os.path.dirname(sim_file) or '.') if (matches := tid_regex.match(name))})
+
+# The bb and insn tables of each image of a SDE file, written by sde2csv.py --all-images, are those of
+# <sim_file>.image.<name>, and <sim_file>.images.csv describes the images: their address range in the run, the first
+# load address of their file, and the file if it was found
+image_fields = ['name', 'path', 'low', 'high', 'first_load_addr', 'file']
+
+def image_file(sim_file, name):
+    return f'{sim_file}.image.{name}'
+
+def images_file(sim_file):
+    return sim_file + '.images.csv'
+
+def read_images(sim_file):
+    """Return the rows of <sim_file>.images.csv."""
+    with open(images_file(sim_file), 'r') as f:
+        return list(csv.DictReader(f))
+
+# Suffixes of the files of the compressions open_compressed() supports
+compressions = {'gz': '.gz', 'zst': '.zst', 'xz': '.xz'}
+
+def is_compressed(path):
+    return path.endswith(tuple(compressions.values()))
+
+def open_compressed(path, mode='rb'):
+    """Open the binary file path, compressed with gzip, zstd or xz if it ends with .gz, .zst or .xz."""
+    if path.endswith('.gz'):
+        # no mtime in the header, so that the same data compresses to the same bytes
+        return gzip.GzipFile(path, mode, compresslevel=6, mtime=0)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is required for *.zst files')
+        return zstandard.open(path, mode)
+    if path.endswith('.xz'):
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+def open_text(path, mode='r'):
+    """Open the text file path, compressed according to its suffix as in open_compressed()."""
+    return io.TextIOWrapper(open_compressed(path, mode + 'b')) if is_compressed(path) else open(path, mode)
+
+class TableWriter:
+    """Write the rows of a table, whose addresses are hex strings, counters are ints and missing values are '',
+    as CSV to csv_file if it is not None, and as typed columns if columnar is true."""
+
+    def __init__(self, header, csv_file=None, columnar=False):
+        self.header = header
+        self.csv_file = csv_file
+        self.csv_writer = csv.writer(csv_file) if csv_file is not None else None
+        self.addresses = [name in address_columns for name in header]
+        self.columns = [array('Q' if address else 'q') for address in self.addresses] if columnar else None
+        self.nulls = [array('B') for _ in self.addresses] if columnar else None
+        self.has_header = False
+
+    def writeheader(self):
+        self.has_header = True
+        if self.csv_writer:
+            self.csv_writer.writerow(self.header)
+
+    def writerow(self, row):
+        if self.csv_writer:
+            self.csv_writer.writerow(row)
+        if self.columns is not None:
+            for column, null, address, val in zip(self.columns, self.nulls, self.addresses, row):
+                column.append(0 if val == '' else int(val, 16) if address else val)
+                null.append(val == '')
+
+    def table(self):
+        """Return the header and the columns by name of the rows written, which the writer must hold as typed columns,
+        as load_columns() returns them (arrays of ints without numpy), or (None, None) if the table has no header."""
+        if not self.has_header:
+            return None, None
+        if np is None:
+            return self.header, dict(zip(self.header, self.columns))
+        return self.header, {name: np.frombuffer(column, dtype=np.uint64 if address else np.int64)
+                             for name, address, column in zip(self.header, self.addresses, self.columns)}
+
+    def payload(self):
+        """Return what has been written, for merge() of another writer of the same table."""
+        return self.csv_file.getvalue() if self.csv_writer else None, self.columns, self.nulls
+
+    def merge(self, payload):
+        text, columns, nulls = payload
+        if text:
+            self.csv_file.write(text)
+        if columns:
+            for column, part in zip(self.columns, columns):
+                column.extend(part)
+            for null, part in zip(self.nulls, nulls):
+                null.extend(part)
+
+# The full instruction mix of a SDE file, written by sde2csv.py --full-mix, is the count of every record (category,
+# iform, ISA extension, opcode, ...) of each block of the bb table, as a sparse matrix stored in <sim_file>.mix.npz: the
+# nonzero counts are count[i] at (row[i], column[i]), the block of each row is entry[row] and the record of each
+# column is keys[column], whose global count is global[column] (0 for the tables of an image)
+def mix_file(sim_file):
+    return sim_file + '.mix.npz'
+
+class MixWriter:
+    """Collect the counts of the records of the blocks, a row per block in the order of its bb table, and the global
+    count of each record."""
+
+    def __init__(self):
+        self.keys = {}
+        self.rows = array('q')
+        self.columns = array('q')
+        self.counts = array('q')
+        self.entries = array('Q')
+        self.global_counts = {}
+
+    def add(self, key, count):
+        """Add the count of the record key to the current block."""
+        if count:
+            self.rows.append(len(self.entries))
+            self.columns.append(self.keys.setdefault(key, len(self.keys)))
+            self.counts.append(count)
+
+    def end_block(self, entry):
+        """End the current block, whose row of the bb table was written with entry. The counts of a block that is not
+        ended are dropped."""
+        self.entries.append(entry)
+
+    def payload(self):
+        """Return what has been written, for merge() of another writer."""
+        return list(self.keys), self.rows, self.columns, self.counts, self.entries
+
+    def merge(self, payload):
+        keys, rows, columns, counts, entries = payload
+        ids = [self.keys.setdefault(key, len(self.keys)) for key in keys]
+        offset = len(self.entries)
+        self.rows.extend(row + offset for row in rows)
+        self.columns.extend(ids[column] for column in columns)
+        self.counts.extend(counts)
+        self.entries.extend(entries)
+
+def save_mix(sim_file, writer):
+    """Save the mix collected by writer to <sim_file>.mix.npz."""
+    require_numpy()
+    keys = dict(writer.keys)
+    for key in writer.global_counts:
+        keys.setdefault(key, len(keys))
+    rows = np.frombuffer(writer.rows, dtype=np.int64)
+    ended = rows < len(writer.entries)
+    np.savez_compressed(mix_file(sim_file), keys=np.array([key.decode() for key in keys], dtype=str),
+                        entry=np.frombuffer(writer.entries, dtype=np.uint64), row=rows[ended].astype(np.uint32),
+                        column=np.frombuffer(writer.columns, dtype=np.int64)[ended].astype(np.uint32),
+                        count=np.frombuffer(writer.counts, dtype=np.int64)[ended],
+                        **{'global': np.array([writer.global_counts.get(key, 0) for key in keys], dtype=np.int64)})
+
+def load_mix(sim_file):
+    """Return the arrays of <sim_file>.mix.npz by name."""
+    require_numpy()
+    with np.load(mix_file(sim_file)) as data:
+        return {name: data[name] for name in data.files}
+
+def save_npz(sim_file, writers):
+    """Save the columns collected by the columnar TableWriter of each table in writers to <sim_file>.npz."""
+    require_numpy()
+    arrays = {}
+    for table, writer in writers.items():
+        if not writer.has_header:
+            continue
+        arrays[f'{table}/header'] = np.array(writer.header)
+        for name, address, column, null in zip(writer.header, writer.addresses, writer.columns, writer.nulls):
+            arrays[f'{table}/{name}'] = np.frombuffer(column, dtype=np.uint64 if address else np.int64)
+            arrays[f'{table}/null/{name}'] = np.frombuffer(null, dtype=np.bool_)
+    np.savez_compressed(npz_file(sim_file), **arrays)
+
+def load_columns(sim_file, table, fmt=None, names=None):
+    """Return the header and a dict of numpy arrays by column of table of sim_file, only of the columns of names if
+    given, read in the format of read_format(sim_file, fmt), or (None, None) if the table has no header."""
+    require_numpy()
+    if read_format(sim_file, fmt) == 'npz':
+        with np.load(npz_file(sim_file)) as data:
+            if f'{table}/header' not in data.files:
+                return None, None
+            header = [str(name) for name in data[f'{table}/header']]
+            return header, {name: data[f'{table}/{name}'] for name in header if names is None or name in names}
+
+    with open(csv_file(sim_file, table), 'r') as f:
+        reader = csv.reader(f)
+        if not (header := next(reader, None)):
+            return None, None
+        rows = list(reader)
+    columns = {}
+    for i, name in enumerate(header):
+        if names is not None and name not in names:
+            continue
+        if name in address_columns:
+            columns[name] = np.array([int(row[i] or '0', 16) for row in rows], dtype=np.uint64)
+        else:
+            columns[name] = np.array([int(row[i] or 0) for row in rows], dtype=np.int64)
+    return header, columns
+
+class NpzTableReader:
+    """csv.DictReader-like reader of a table stored in npz, with the missing values as empty cells (the zero ones
+    in a npz written before the null masks)."""
+
+    def __init__(self, data, table):
+        if f'{table}/header' in data.files:
+            self.fieldnames = [str(name) for name in data[f'{table}/header']]
+            self.columns = [data[f'{table}/{name}'].tolist() for name in self.fieldnames]
+            self.nulls = [data[f'{table}/null/{name}'].tolist() if f'{table}/null/{name}' in data.files else [val == 0 for val in column]
+                          for name, column in zip(self.fieldnames, self.columns)]
+        else:
+            self.fieldnames = None
+            self.columns = []
+            self.nulls = []
+
+    def __iter__(self):
+        hex_columns = [name in address_columns for name in self.fieldnames or []]
+        for values, nulls in zip(zip(*self.columns), zip(*self.nulls)):
+            yield {name: '' if null else '{:x}'.format(val) if address else str(val)
+                   for name, address, val, null in zip(self.fieldnames, hex_columns, values, nulls)}
+
+@contextmanager
+def open_table(sim_file, table, fmt=None):
+    """Yield a csv.DictReader-like reader of table of sim_file, read in the format of read_format(sim_file, fmt)."""
+    if read_format(sim_file, fmt) == 'npz':
+        with np.load(npz_file(sim_file)) as data:
+            yield NpzTableReader(data, table)
+    else:
+        with open(csv_file(sim_file, table), 'r') as f:
+            yield csv.DictReader(f)
+
+def sim_file_of(path):
+    """Return the SDE file whose profile path (<sim_file>.npz or <sim_file>.<table>.csv) is."""
+    if path.endswith('.npz'):
+        return path[:-len('.npz')]
+    for table in tables:
+        if path.endswith(f'.{table}.csv'):
+            return path[:-len(f'.{table}.csv')]
+    return path
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import argparse, csv, os, sqlite3, sys, time
+import profile_io
+
+# A run is the profile of a sim file of a workload for a build label. The metrics of a run are stored one per row,
+# since the columns of the profiles depend on --items.
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, label TEXT, workload TEXT, sim_file TEXT, ingested REAL,
+                                 UNIQUE (label, workload, sim_file));
+CREATE INDEX IF NOT EXISTS runs_workload ON runs (workload, sim_file);
+CREATE TABLE IF NOT EXISTS globals (run INTEGER, metric TEXT, value INTEGER, PRIMARY KEY (run, metric)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS functions (run INTEGER, name TEXT, metric TEXT, value INTEGER, PRIMARY KEY (run, name, metric)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS functions_name ON functions (name, metric);
+CREATE TABLE IF NOT EXISTS lines (run INTEGER, source_line TEXT, metric TEXT, value INTEGER, PRIMARY KEY (run, source_line, metric)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS lines_source_line ON lines (source_line, metric);
+CREATE TABLE IF NOT EXISTS insns (run INTEGER, pc INTEGER, execution INTEGER, PRIMARY KEY (run, pc)) WITHOUT ROWID;
+'''
+
+# Column of the key of the rows of each table of metrics
+table_keys = {'globals': 'metric', 'functions': 'name', 'lines': 'source_line'}
+
+def metric_rows(run, reader, key):
+    """Yield (run, key, metric, value) of each metric of each row of reader."""
+    for row in reader:
+        for metric, value in row.items():
+            if metric != key:
+                yield run, row[key], metric, int(value or 0)
+
+class ProfileStore:
+    """SQLite database of the global, function, source line and instruction profiles of runs."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def ingest_run(self, label, workload, sim_file, insns=True):
+        """Store the profile of sim_file (its global and insn tables, *.f.csv and *.line.csv) as the run of workload
+        for label, replacing the one stored before."""
+        with self.db:
+            key = (label, workload, os.path.basename(sim_file))
+            for old, in self.db.execute('SELECT id FROM runs WHERE label = ? AND workload = ? AND sim_file = ?', key).fetchall():
+                for table in ['globals', 'functions', 'lines', 'insns']:
+                    self.db.execute(f'DELETE FROM {table} WHERE run = ?', (old,))
+                self.db.execute('DELETE FROM runs WHERE id = ?', (old,))
+            run = self.db.execute('INSERT INTO runs (label, workload, sim_file, ingested) VALUES (?, ?, ?, ?)', key + (time.time(),)).lastrowid
+
+            with profile_io.open_table(sim_file, 'global') as reader:
+                row = next(iter(reader), {})
+                self.db.executemany('INSERT INTO globals VALUES (?, ?, ?)', [(run, metric, int(value or 0)) for metric, value in row.items()])
+            for suffix, table, key in [('.f.csv', 'functions', 'name'), ('.line.csv', 'lines', 'source_line')]:
+                if os.path.isfile(sim_file + suffix):
+                    with open(sim_file + suffix, 'r') as f:
+                        self.db.executemany(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)', metric_rows(run, csv.DictReader(f), key))
+            if insns:
+                with profile_io.open_table(sim_file, 'insn') as reader:
+                    self.db.executemany('INSERT OR REPLACE INTO insns VALUES (?, ?, ?)',
+                                        ((run, int(row['pc'], 16), int(row['execution'] or 0)) for row in reader))
+        return run
+
+    def ingest(self, dir_path, mapping_csv, label, insns=True):
+        """Store the runs of all the workloads of dir_path described by mapping_csv (name, sim_files) for label."""
+        with open(mapping_csv, 'r') as csv_file:
+            for row in csv.DictReader(csv_file):
+                for sim_file in row['sim_files'].split(','):
+                    self.ingest_run(label, row['name'], os.path.join(dir_path, row['name'], sim_file), insns)
+
+    def history(self, table, key, metric, workload=None, last=None):
+        """Return (label, workload, sim_file, value) of metric of key (a function name or source line, or None for
+        globals) in each run of workload (all by default), of the last builds (labels, by their latest ingestion) if
+        given, in the order of ingestion."""
+        where, params = ('g.metric = ?', [metric]) if key is None else (f'g.{table_keys[table]} = ? AND g.metric = ?', [key, metric])
+        labels, label_params = '', []
+        if workload:
+            where += ' AND r.workload = ?'
+            params.append(workload)
+        if last:
+            # A build has a run per workload and sim file, so the last builds are picked before joining their runs
+            labels = (f'JOIN (SELECT label FROM runs{" WHERE workload = ?" if workload else ""} GROUP BY label '
+                      f'ORDER BY MAX(id) DESC LIMIT ?) l ON l.label = r.label ')
+            label_params = ([workload] if workload else []) + [last]
+        return self.db.execute(f'SELECT r.label, r.workload, r.sim_file, g.value FROM {table} g JOIN runs r ON r.id = g.run '
+                               f'{labels}WHERE {where} ORDER BY r.id', label_params + params).fetchall()
+
+    def diff(self, table, ref_label, exp_label, metrics):
+        """Return (workload, sim_file, key, metric, ref value, exp value) of metrics differing between the runs of
+        ref_label and exp_label of the same workload and sim file, a key or metric missing in one of them being 0."""
+        key = table_keys[table]
+        runs = 'FROM runs r JOIN runs s ON s.workload = r.workload AND s.sim_file = r.sim_file AND s.label = ? '
+        metric_in = f'IN ({",".join("?" * len(metrics))})'
+        # The rows of ref joined to those of exp if any, then the rows of exp only, as SQLite before 3.39 has no
+        # FULL OUTER JOIN
+        return self.db.execute(
+            f'SELECT r.workload, r.sim_file, a.{key}, a.metric, a.value, COALESCE(b.value, 0) {runs}'
+            f'JOIN {table} a ON a.run = r.id LEFT JOIN {table} b ON b.run = s.id AND b.{key} = a.{key} AND b.metric = a.metric '
+            f'WHERE r.label = ? AND a.metric {metric_in} AND a.value != COALESCE(b.value, 0) UNION ALL '
+            f'SELECT r.workload, r.sim_file, b.{key}, b.metric, 0, b.value {runs}'
+            f'JOIN {table} b ON b.run = s.id LEFT JOIN {table} a ON a.run = r.id AND a.{key} = b.{key} AND a.metric = b.metric '
+            f'WHERE r.label = ? AND b.metric {metric_in} AND a.run IS NULL AND b.value != 0 '
+            f'ORDER BY 1, 2, 3, 4', ([exp_label, ref_label] + metrics) * 2).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Store the profiles of runs of workloads, tagged by build label, in an SQLite database, and query them.')
+    parser.add_argument('db', help='SQLite database file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='store the outputs of for_each.py in a directory')
+    ingest_parser.add_argument('dir', help='directory of the inputs')
+    ingest_parser.add_argument('--csv', required=True, help='csv file to describe the mappings')
+    ingest_parser.add_argument('--label', required=True, help='build label of the runs')
+    ingest_parser.add_argument('--no-insns', action='store_true', help='do not store the insn tables')
+    history_parser = subparsers.add_parser('history', help='show a metric of a function, a source line or the globals across the runs')
+    history_parser.add_argument('metric', help='metric to show')
+    history_parser.add_argument('--function', help='function name')
+    history_parser.add_argument('--line', help='source line')
+    history_parser.add_argument('--workload', help='only show this workload')
+    history_parser.add_argument('--last', type=int, help='only show the runs of the last N builds (labels)')
+    diff_parser = subparsers.add_parser('diff', help='show the metrics differing between the runs of two labels')
+    diff_parser.add_argument('ref', help='reference label')
+    diff_parser.add_argument('exp', help='experiment label')
+    diff_parser.add_argument('--items', required=True, help='items to compare')
+    diff_parser.add_argument('--table', choices=list(table_keys), default='functions', help='profile to compare')
+    args = parser.parse_args()
+
+    store = ProfileStore(args.db)
+    writer = csv.writer(sys.stdout)
+    if args.command == 'ingest':
+        store.ingest(args.dir, args.csv, args.label, not args.no_insns)
+    elif args.command == 'history':
+        table, key = ('functions', args.function) if args.function else ('lines', args.line) if args.line else ('globals', None)
+        writer.writerow(['label', 'workload', 'sim_file', args.metric, 'delta'])
+        prev = {}
+        for label, workload, sim_file, value in store.history(table, key, args.metric, args.workload, args.last):
+            delta = value - prev[workload, sim_file] if (workload, sim_file) in prev else ''
+            prev[workload, sim_file] = value
+            writer.writerow([label, workload, sim_file, value, delta])
+    else:
+        # The key of globals is the metric itself
+        keep = slice(3, None) if args.table == 'globals' else slice(2, None)
+        writer.writerow(['workload', 'sim_file'] + [table_keys[args.table], 'metric', 'ref', 'exp'][keep.start - 2:])
+        writer.writerows(row[:2] + row[keep] for row in store.diff(args.table, args.ref, args.exp, args.items.split(',')))
+    store.close()
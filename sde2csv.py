@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
-import re, argparse, csv, os, subprocess
-from subprocess import PIPE
+import re, argparse, csv, io, json, mmap, os, queue, sys, threading
 from collections import defaultdict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import profile_io
+from profile_io import TableWriter
+from symbolizer import Elf, IntervalIndex
 
 record_regex = re.compile(r'^\*?((?:\w|-)+)\s+([0-9]+)')
 block_regex = re.compile(r'^BLOCK:\s+([0-9]+)\s+PC:\s+([0-9a-f]+)\s+ICOUNT:\s+([0-9]+)\s+EXECUTIONS:\s+([0-9]+)')
-xdis_regex = re.compile(r'^XDIS\s+([0-9a-f]+):')
 imag_addr_regex = re.compile(r'(\S+)\s+([0-9a-f]+)\s+([0-9a-f]+)')
 
 ilen_sets = ['ilen-' + str(i) for i in range(1, 16)]
@@ -38,134 +41,666 @@ roi = ['total','mem-read', 'mem-write', 'category-COND_BR', 'category-UNCOND_BR'
 #
 # Hence an IP might be in more than one block, you need to add their execution count for the total execution of one IP.
 
-def collect_metrics(metrics, matches):
-    if matches and matches.group(1) in roi:
-        key = matches.group(1)
-        val = int(matches.group(2))
-        metrics[key] = val
-
-def update_bb_insn_info(line, metrics, icounts, image_addr_low, image_addr_high, image_first_load_addr, bb_writer):
-    if matches := block_regex.match(line):
-        if metrics:
-            bb_writer.writerow(metrics)
-            metrics.clear() # clear metrics for next bb
-        entry = int(matches.group(2), 16)
-        if entry < image_addr_low or entry > image_addr_high: # only collect interested data
-            return
-        metrics['entry'] = '{:x}'.format(entry - image_addr_low + image_first_load_addr)
-        metrics['execution'] = int(matches.group(4))
-    elif matches := xdis_regex.match(line):
-        if 'entry' not in metrics:
-            return
-        addr = int(matches.group(1), 16)
-        assert addr >= image_addr_low or addr <= image_addr_high, 'entry should be None'
-        addr = addr - image_addr_low + image_first_load_addr
-        icounts[f'{addr:x}'] += metrics['execution']
-        metrics['exit'] = f'{addr:x}'
-    elif matches := record_regex.match(line):
-        if 'entry' not in metrics:
-            return
-        collect_metrics(metrics, matches)
-
-def update_global_info(line, metrics):
-    if matches := record_regex.match(line):
-        collect_metrics(metrics, matches)
+# The SDE file is memory-mapped and split into lines a large buffer at a time, which keeps the
+# per-line cost down on multi-GB mix files.
+buffer_size = 1 << 24
+whitespace = frozenset(b' \t\n\r\x0b\x0c')
+hex_digits = b'0123456789abcdef'
+record_key_regex = re.compile(r'(?:\w|-)+')
+
+# Every section marker contains one of these, and the lines containing them are recorded in the
+# index of the SDE file, so that later runs can go straight to the sections they need.
+marker_keywords = [b'EMIT_', b'END_', b'global-dynamic-counts']
+thread_marker_regex = re.compile(rb'EMIT_(TOP_BLOCK|DYNAMIC)_STATS\s+FOR\s+TID\s+([0-9]+)')
+index_version = 1
+
+@contextmanager
+def map_file(path):
+    """Yield a read-only memory map of the file at path, or b'' if it is empty."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+def iter_lines(data, beg=0, end=None):
+    """Yield the lines of data[beg:end], a buffer-sized list at a time, without the trailing newline."""
+    end = len(data) if end is None else end
+    while beg < end:
+        stop = min(beg + buffer_size, end)
+        if stop < end:
+            stop = data.rfind(b'\n', beg, stop) + 1 or data.find(b'\n', stop, end) + 1 or end
+        yield data[beg:stop].split(b'\n')
+        beg = stop
+
+def iter_compressed_lines(path):
+    """Yield the lines of the compressed file path, a buffer-sized list at a time, without the trailing newline. The
+    file is decompressed in a thread ahead of the caller, which overlaps since the decompressors release the GIL."""
+    chunks = queue.Queue(maxsize=4)
+    def decompress():
+        try:
+            with profile_io.open_compressed(path) as f:
+                while chunk := f.read(buffer_size):
+                    chunks.put(chunk)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+    threading.Thread(target=decompress, daemon=True).start()
+    rest = b''
+    while (chunk := chunks.get()) is not None:
+        if isinstance(chunk, Exception):
+            raise chunk
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+def record_columns(keys):
+    """Map the first token of an interesting record line, with or without the leading '*', to the index of its key."""
+    table = {}
+    for i, key in reversed(list(enumerate(keys))):
+        if record_key_regex.fullmatch(key):
+            token = key.encode()
+            table[token] = table[b'*' + token] = i
+    return table
+
+def parse_record(line):
+    """Return the count of a record line, or None if record_regex does not match."""
+    if matches := record_regex.match(line.decode()):
+        return int(matches.group(2))
+    return None
+
+def parse_block(line):
+    """Return (pc, executions) of a BLOCK line, or None if block_regex does not match."""
+    parts = line.split(None, 8)
+    if len(parts) > 7 and parts[2] == b'PC:' and parts[4] == b'ICOUNT:' and parts[6] == b'EXECUTIONS:' and parts[1].isdigit() \
+            and not parts[3].translate(None, hex_digits) and parts[5].isdigit() and parts[7].isdigit():
+        return int(parts[3], 16), int(parts[7])
+    if matches := block_regex.match(line.decode()):
+        return int(matches.group(2), 16), int(matches.group(4))
+    return None
 
 def get_image_first_load_addr(binary):
-    pg_header = subprocess.run(['readelf', '-l', binary], stdout=PIPE, check=True)
-    # Assume the program headers looks like:
-    #
-    # Program Headers:
-    #   Type           Offset             VirtAddr           PhysAddr
-    #                  FileSiz            MemSiz              Flags  Align
-    #   PHDR           0x0000000000000040 0x0000000000400040 0x0000000000400040
-    #                  0x00000000000002d8 0x00000000000002d8  R      0x8
-    #   INTERP         0x0000000000000318 0x0000000000400318 0x0000000000400318
-    #                  0x000000000000001c 0x000000000000001c  R      0x1
-    #   LOAD           0x0000000000000000 0x0000000000400000 0x0000000000400000
-    #                  0x0000000000000660 0x0000000000000660  R      0x1000
-    #   LOAD           0x0000000000001000 0x0000000000401000 0x0000000000401000
-    #                  0x0000000000000215 0x0000000000000215  R E    0x1000
-    pg_header = pg_header.stdout.decode('utf-8').strip()
-    for line in pg_header.splitlines():
-        if 'LOAD' in line:
-            return int(line.strip().split()[2], 16)
+    elf = Elf(binary)
+    first_load_addr = elf.first_load_addr()
+    elf.close()
+    return first_load_addr
+
+def is_image_file(path, size):
+    """Return whether path is an ELF file whose loadable segments span size bytes, as its image did in the run,
+    both rounded up to pages. SDE records no build-id of the images, so their size is what tells another build of
+    the same library apart."""
+    if not os.path.isfile(path):
+        return False
+    try:
+        elf = Elf(path)
+    except (AssertionError, OSError, ValueError):
+        return False
+    load_size = elf.load_size()
+    elf.close()
+    page = 0x1000
+    return -(-load_size // page) == -(-size // page)
 
 def get_image_text_size(binary):
-    pg_header = subprocess.run(['readelf', '-S', binary], stdout=PIPE, check=True)
-    # Assume the section headers looks like:
-    #
-    # Section Headers:
-    #   [Nr] Name              Type             Address           Offset
-    #        Size              EntSize          Flags  Link  Info  Align
-    #   [13] .text             PROGBITS         0000000000087810  00086810
-    #        00000000001f8625  0000000000000000  AX       0     0     16
-
-    pg_header = pg_header.stdout.decode('utf-8').strip()
-    next_is_size = False
-    for line in pg_header.splitlines():
-        if next_is_size:
-            return int(line.strip().split()[0], 16)
-        elif ' .text ' in line:
-            next_is_size = True
-
-def convert_sde_perf_to_csv(sde_file, binary):
-    bb_header = ['entry', 'execution', 'exit'] + roi
+    elf = Elf(binary)
+    text_size = elf.section_size('.text')
+    elf.close()
+    return text_size
+
+class Image:
+    """The blocks of an image in [low, high], rebased to the addresses of its file, with the bb and insn writers, and
+    the mix writer if any, of each of writers to write them to."""
+
+    def __init__(self, low, high, first_load_addr, writers):
+        self.low = low
+        self.high = high
+        self.first_load_addr = first_load_addr
+        self.rebase = first_load_addr - low
+        self.writers = writers
+        self.mixes = [image_writers['mix'] for image_writers in writers if image_writers.get('mix')]
+        self.icounts = defaultdict(int)
+
+class TopBlockParser:
+    """Collect the bb rows and per-PC icounts of the blocks of images from top-block lines, and the counts of all the
+    records of the blocks of the images that have mix writers."""
+
+    def __init__(self, keys, images):
+        self.keys = keys
+        self.images = images
+        self.image_index = IntervalIndex([(image.low, image.high + 1, image) for image in images])
+        # roi keys of the current block are stored straight into its row, at the column of the
+        # first occurrence of the key and copied to its duplicates when the row is written.
+        self.columns = record_columns(keys)
+        self.duplicates = [(i, keys.index(key)) for i, key in enumerate(keys) if keys.index(key) != i]
+        self.image = None
+        self.bb_row = None
+        self.execution = None
+
+    def image_of(self, address):
+        """Return the image containing address, or None."""
+        images = self.image_index.containing(address)
+        return images[0] if images else None
+
+    def flush(self):
+        """Write the row of the current block, if any."""
+        bb_row = self.bb_row
+        if bb_row:
+            bb_row[2] = '{:x}'.format(bb_row[2]) if bb_row[2] != '' else ''
+            for i, j in self.duplicates:
+                bb_row[3 + i] = bb_row[3 + j]
+            for writers in self.image.writers:
+                writers['bb'].writerow(bb_row)
+            for mix in self.image.mixes:
+                mix.end_block(int(bb_row[0], 16))
+        self.bb_row = None
+
+    def write_icounts(self):
+        """Write the insn table of each image."""
+        for image in self.images:
+            for writers in image.writers:
+                writers['insn'].writeheader()
+                for key, val in image.icounts.items():
+                    writers['insn'].writerow(['{:x}'.format(key), val])
+
+    def feed(self, lines, start=0):
+        """Parse lines from index start and return the index of the first comment line, or len(lines)."""
+        columns = self.columns
+        image = self.image
+        rebase, icounts, mixes = (image.rebase, image.icounts, image.mixes) if image else (0, None, [])
+        width = len(self.keys)
+        bb_row, execution = self.bb_row, self.execution
+
+        # Every line is dispatched on its first token instead of trying each regex in turn, and
+        # the regexes above remain the reference for lines that do not have the usual shape.
+        for i in range(start, len(lines)):
+            line = lines[i]
+            parts = line.split(None, 2)
+            if not parts:
+                continue
+            token = parts[0]
+            # XDIS lines are checked against '^XDIS\s+([0-9a-f]+):' without the regex
+            if token == b'XDIS' and line[0] == 88 and bb_row and len(parts) > 1 \
+                    and (xdis := parts[1].partition(b':'))[1] and xdis[0] and not xdis[0].translate(None, hex_digits):
+                addr = int(xdis[0], 16) + rebase
+                icounts[addr] += execution
+                bb_row[2] = addr
+            elif mixes and bb_row and len(parts) > 1 and parts[1].isdigit() and line[0] not in whitespace and line[0] != 35 and token != b'BLOCK:':
+                # Every record of the block goes to the mix, and those of keys to the row as well
+                val = int(parts[1])
+                if (j := columns.get(token)) is not None:
+                    bb_row[3 + j] = val
+                key = token.lstrip(b'*')
+                for mix in mixes:
+                    mix.add(key, val)
+            elif (j := columns.get(token)) is not None and line[0] not in whitespace:
+                if not bb_row:
+                    continue
+                if len(parts) > 1 and parts[1].isdigit():
+                    bb_row[3 + j] = int(parts[1])
+                elif (val := parse_record(line)) is not None:
+                    bb_row[3 + j] = val
+            elif token == b'BLOCK:' and line[0] == 66 and (block := parse_block(line)):
+                self.bb_row = bb_row
+                self.flush()
+                entry, execution = block
+                if (image := self.image_of(entry)) is None: # only collect interested data
+                    bb_row = None
+                else:
+                    self.image = image
+                    rebase, icounts, mixes = image.rebase, image.icounts, image.mixes
+                    bb_row = ['{:x}'.format(entry + rebase), execution, ''] + [''] * width
+            elif line[0] == 35: # '#'
+                self.bb_row, self.execution = bb_row, execution
+                return i
+
+        self.bb_row, self.execution = bb_row, execution
+        return len(lines)
+
+class SdeParser:
+    """Section state machine over the lines of a SDE mix file, which writes the bb/insn/global CSVs of the binary, and
+    those of each thread to the writers returned by thread_writers(tid) and the bb/insn CSVs of each image to those
+    returned by image_writers(name) if they are given. With mix_writer, the counts of all the records go to it and to
+    the 'mix' writer of each thread and image as well."""
+
+    def __init__(self, keys, binary, bb_writer, insn_writer, global_writer, thread_writers=None, image_writers=None, mix_writer=None):
+        self.keys = keys
+        self.bb_writer = bb_writer
+        self.insn_writer = insn_writer
+        self.global_writer = global_writer
+        self.mix_writer = mix_writer
+        # Global count of every record, if the mix is collected
+        self.global_mix = {} if mix_writer is not None else None
+        self.thread_writers = thread_writers
+        # (tid, section) of the thread section being parsed, and of the ones seen
+        self.thread = None
+        self.thread_sections = set()
+        self.image_writers = image_writers
+        # (path, low, high) of each image, and the description of each image (see profile_io.image_fields)
+        self.image_addrs = []
+        self.image_rows = []
+        self.columns = record_columns(keys)
+        self.metrics = defaultdict(int)
+        self.top_blocks = None
+        self.section = None
+        self.find_image_addr_beg = self.find_image_addr_end = self.find_global_count_beg = self.find_global_count_end = self.find_top_block_beg = self.find_top_block_end = None
+        self.image_addr_low = self.image_addr_high = None
+        self.image_first_load_addr = get_image_first_load_addr(os.path.abspath(binary))
+        assert self.image_first_load_addr is not None, 'not found first load address of image'
+        self.image_text_size = get_image_text_size(os.path.abspath(binary))
+        self.image_name = os.path.basename(binary)
+        self.binary = os.path.abspath(binary)
+
+    def feed(self, lines):
+        i = 0
+        while i < len(lines):
+            if self.section == 'top_block':
+                i = self.top_blocks.feed(lines, i)
+                if i == len(lines):
+                    break
+            line = lines[i]
+            i += 1
+            if not line or line[0] in whitespace:
+                continue
+            # Section markers only appear on comment lines
+            if line[0] == 35: # '#'
+                self.update_section(line)
+            if self.section == 'global':
+                parts = line.split(None, 2)
+                if (j := self.columns.get(parts[0])) is not None:
+                    if len(parts) > 1 and parts[1].isdigit():
+                        self.metrics[self.keys[j]] = int(parts[1])
+                    elif (val := parse_record(line)) is not None:
+                        self.metrics[self.keys[j]] = val
+                if self.global_mix is not None and len(parts) > 1 and parts[1].isdigit() and line[0] != 35:
+                    self.global_mix[parts[0].lstrip(b'*')] = int(parts[1])
+            elif self.section == 'image':
+                if match := imag_addr_regex.match(line.decode()):
+                    self.image_addrs.append((match.group(1), int(match.group(2), 16), int(match.group(3), 16)))
+                    if self.image_name in match.group(1):
+                        self.image_addr_low = int(match.group(2), 16)
+                        self.image_addr_high = int(match.group(3), 16)
+
+    def resolve_images(self):
+        """Describe each image: a unique name, and the file to rebase and symbolize it with, which is the binary for
+        its image, else the file of its name in the directory of the binary, where the libraries of a run symbolized on
+        another machine are copied, or else the file at its path, if it has the size of the image. An image without a
+        file is assumed to be linked at 0, as shared libraries are."""
+        self.image_rows = []
+        names = set()
+        for path, low, high in self.image_addrs:
+            name = os.path.basename(path)
+            if name in names:
+                name += '.{:x}'.format(low)
+            names.add(name)
+            if (low, high) == (self.image_addr_low, self.image_addr_high):
+                image_file = self.binary
+            else:
+                candidates = [os.path.join(os.path.dirname(self.binary), os.path.basename(path)), path]
+                image_file = next((candidate for candidate in candidates if is_image_file(candidate, high - low + 1)), '')
+            first_load_addr = (get_image_first_load_addr(image_file) or 0) if image_file else 0
+            self.image_rows.append({'name': name, 'path': path, 'low': '{:x}'.format(low), 'high': '{:x}'.format(high),
+                                    'first_load_addr': '{:x}'.format(first_load_addr), 'file': image_file})
+
+    def images_of(self, writers, all_images=False):
+        """Return the images whose blocks are written to the tables of writers: the image of the binary, and if
+        all_images, every image to its own tables of image_writers too."""
+        assert self.image_addr_low is not None, 'not found low addr of image'
+        assert self.image_addr_high is not None, 'not found high addr of image'
+        binary_range = (self.image_addr_low, self.image_addr_high)
+        if not all_images:
+            return [Image(*binary_range, self.image_first_load_addr, [writers])]
+        images = []
+        for row in self.image_rows:
+            low, high = int(row['low'], 16), int(row['high'], 16)
+            image_writers = [self.image_writers(row['name'])]
+            if (low, high) == binary_range:
+                image_writers.insert(0, writers)
+            images.append(Image(low, high, int(row['first_load_addr'], 16), image_writers))
+        return images
+
+    def update_thread_section(self, line):
+        """Open or close the section of a thread at the marker line, and return whether it is one."""
+        if self.thread:
+            tid, name = self.thread
+            if b'END_%s_STATS' % name.upper().encode() not in line:
+                return False
+            writers = self.thread_writers(tid)
+            if name == 'top_block':
+                # Unlike the global one, the row of the last block of the section is written
+                self.top_blocks.flush()
+                self.top_blocks.write_icounts()
+            else:
+                writers['global'].writeheader()
+                thread_metrics = self.metrics.copy()
+                thread_metrics['text_size'] = self.image_text_size
+                writers['global'].writerow([thread_metrics.get(key, '') for key in writers['global'].header])
+                if writers.get('mix'):
+                    writers['mix'].global_counts = self.global_mix.copy()
+            self.thread = None
+            return True
+        if not (matches := thread_marker_regex.search(line)):
+            return False
+        tid, name = matches.group(2).decode(), matches.group(1).decode().lower()
+        # Only the first section of each thread is kept, as in find_sections()
+        if self.thread_writers and (tid, name) not in self.thread_sections:
+            self.thread_sections.add((tid, name))
+            self.thread = (tid, name)
+            writers = self.thread_writers(tid)
+            if name == 'top_block':
+                # The blocks of a thread are only those of the binary
+                writers['bb'].writeheader()
+                self.top_blocks = TopBlockParser(self.keys, self.images_of(writers))
+            else:
+                self.metrics.clear()
+                if self.global_mix is not None:
+                    self.global_mix.clear()
+        return True
+
+    def update_section(self, line):
+        if self.update_thread_section(line):
+            pass
+        elif b'EMIT_IMAGE_ADDRESSES' in line:
+            self.find_image_addr_beg = True
+        elif b'END_IMAGE_ADDRESSES' in line:
+            self.find_image_addr_end = True
+        elif b'EMIT_GLOBAL_TOP_BLOCK_STATS' in line:
+            self.find_top_block_beg = True
+            if self.image_writers:
+                self.resolve_images()
+            images = self.images_of({'bb': self.bb_writer, 'insn': self.insn_writer, 'mix': self.mix_writer}, self.image_writers is not None)
+            for image in images:
+                for writers in image.writers:
+                    writers['bb'].writeheader() # row is written when a new bb is found
+            self.top_blocks = TopBlockParser(self.keys, images)
+        # SDE emits this twice, one for thread, one for global
+        elif b'END_TOP_BLOCK_STATS' in line and self.find_top_block_beg and not self.find_top_block_end:
+            self.find_top_block_end = True
+            assert self.find_top_block_beg, 'not found top block begin yet'
+            self.top_blocks.write_icounts()
+        elif b'global-dynamic-counts' in line:
+            self.find_global_count_beg = True
+            assert self.find_top_block_end, 'not found top block end yet'
+            self.global_writer.writeheader()
+            self.metrics.clear()
+            if self.global_mix is not None:
+                self.global_mix.clear()
+        elif b'END_GLOBAL_DYNAMIC_STATS' in line:
+            self.find_global_count_end = True
+            assert self.find_global_count_beg, 'not found global count begin yet'
+            global_metrics = self.metrics.copy()
+            global_metrics['text_size'] = self.image_text_size
+            self.global_writer.writerow([global_metrics.get(key, '') for key in self.global_writer.header])
+            if self.mix_writer is not None:
+                self.mix_writer.global_counts = self.global_mix.copy()
+
+        if self.thread:
+            # The dynamic counts of a thread are parsed as the global ones
+            self.section = 'top_block' if self.thread[1] == 'top_block' else 'global'
+        elif self.find_image_addr_beg and not self.find_image_addr_end:
+            self.section = 'image'
+        elif self.find_top_block_beg and not self.find_top_block_end:
+            self.section = 'top_block'
+        elif self.find_global_count_beg and not self.find_global_count_end:
+            self.section = 'global'
+        else:
+            self.section = None
+
+def find_marker_lines(data):
+    """Return the sorted offsets (begin, end) of the comment lines of data that may mark a section."""
+    lines = set()
+    for keyword in marker_keywords:
+        pos = 0
+        while (hit := data.find(keyword, pos)) >= 0:
+            beg = data.rfind(b'\n', 0, hit) + 1
+            pos = data.find(b'\n', hit) + 1 or len(data)
+            if data[beg:beg + 1] == b'#':
+                lines.add((beg, pos))
+    return sorted(lines)
+
+def find_sections(data, markers):
+    """Return the offsets [begin, end) of the image-address, global top-block, global count and per-thread sections,
+    from the marker line opening each section to the end of the marker line closing it."""
+    sections = {'image': None, 'top_block': None, 'global': None, 'threads': {}}
+    opened = {}
+    for beg, end in markers:
+        line = data[beg:end]
+        if matches := thread_marker_regex.search(line):
+            opened['thread'] = (matches.group(2).decode(), matches.group(1).decode().lower(), beg)
+        elif b'EMIT_IMAGE_ADDRESSES' in line:
+            opened.setdefault('image', beg)
+        elif b'EMIT_GLOBAL_TOP_BLOCK_STATS' in line:
+            opened.setdefault('top_block', beg)
+        elif b'global-dynamic-counts' in line and sections['top_block']:
+            opened.setdefault('global', beg)
+
+        for name, closing in [('image', b'END_IMAGE_ADDRESSES'), ('top_block', b'END_TOP_BLOCK_STATS'), ('global', b'END_GLOBAL_DYNAMIC_STATS')]:
+            if closing in line and name in opened and not sections[name]:
+                sections[name] = [opened[name], end]
+        if 'thread' in opened:
+            tid, name, opening = opened['thread']
+            if b'END_%s_STATS' % name.upper().encode() in line:
+                sections['threads'].setdefault(tid, {}).setdefault(name, [opening, end])
+                del opened['thread']
+    return sections
+
+def load_index(sde_file, data):
+    """Return the section index of sde_file, from its sidecar if it is up to date, otherwise by scanning data."""
+    stat = os.stat(sde_file)
+    index_file = sde_file + '.idx'
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == index_version and index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    markers = find_marker_lines(data)
+    index = {'version': index_version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'sections': find_sections(data, markers), 'markers': markers}
+    # Written aside and renamed, so that a concurrent run never reads a partial sidecar, and skipped when the
+    # directory is not writable
+    tmp = f'{index_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+            f.write('\n')
+        os.replace(tmp, index_file)
+    except OSError:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    return index
+
+def find_block_line(data, offset, end):
+    """Return the offset of the first BLOCK line beginning in [offset, end), or end."""
+    while (hit := data.find(b'\nBLOCK:', offset, end)) >= 0 and hit + 1 < end:
+        offset = hit + 1
+        if parse_block(data[offset:data.find(b'\n', offset, end) + 1 or end]):
+            return offset
+    return end
+
+def feed_range(data, parser, beg, end):
+    for lines in iter_lines(data, beg, end):
+        parser.feed(lines)
+
+def parse_top_block_chunk(sde_file, beg, end, keys, image_ranges, flush, formats, full_mix=False, columns=False):
+    """Parse the top-block lines in [beg, end) of sde_file for the images of image_ranges (low, high, first load
+    address), and return the payload of the bb rows, as typed columns too if columns, the icounts and the payload of
+    the mix if full_mix of each image."""
+    images = [Image(low, high, first_load_addr, [{'bb': TableWriter(['entry', 'execution', 'exit'] + keys, io.StringIO() if 'csv' in formats else None, columns),
+                                                  'mix': profile_io.MixWriter() if full_mix else None}])
+              for low, high, first_load_addr in image_ranges]
+    top_blocks = TopBlockParser(keys, images)
+    with map_file(sde_file) as data:
+        for lines in iter_lines(data, beg, end):
+            i = 0
+            while (i := top_blocks.feed(lines, i)) < len(lines):
+                i += 1 # the chunk holds no section marker, skip the comment line
+    if flush:
+        top_blocks.flush()
+    return [(image.writers[0]['bb'].payload(), image.icounts, image.mixes[0].payload() if full_mix else None) for image in images]
+
+def parse_top_blocks_in_parallel(data, sde_file, parser, beg, end, jobs, formats):
+    """Parse the top-block section [beg, end) in chunks split at BLOCK lines, merging the results in file order into
+    the top blocks of parser."""
+    chunks = jobs * 4
+    bounds = [beg]
+    for k in range(1, chunks):
+        bound = find_block_line(data, max(bounds[-1], beg + (end - beg) * k // chunks), end)
+        if bound != bounds[-1]:
+            bounds.append(bound)
+    if bounds[-1] != end:
+        bounds.append(end)
+
+    top_blocks = parser.top_blocks
+    image_ranges = [(image.low, image.high, image.first_load_addr) for image in top_blocks.images]
+    # the row of the last block of the global section is left unwritten as in the serial path, and the one of a
+    # thread section is written when the section closes
+    full_mix = any(image.mixes for image in top_blocks.images)
+    columns = top_blocks.images[0].writers[0]['bb'].columns is not None
+    args = [(sde_file, b, e, parser.keys, image_ranges, e != end or parser.thread is not None, formats, full_mix, columns)
+            for b, e in zip(bounds, bounds[1:])]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for results in executor.map(parse_top_block_chunk, *zip(*args)):
+            for image, (rows, icounts, mix) in zip(top_blocks.images, results):
+                for writers in image.writers:
+                    writers['bb'].merge(rows)
+                for image_mix in image.mixes:
+                    image_mix.merge(mix)
+                for pc, execution in icounts.items():
+                    image.icounts[pc] += execution
+
+def convert_sde_perf_to_csv(sde_file, binary, jobs=1, formats=('csv',), items=None, threads=False, all_images=False, full_mix=False, columns=False):
+    """Write the profile of sde_file with the extra interesting items to the files of formats, the profile of each of
+    its threads to those of profile_io.thread_file() if threads, the bb and insn tables of each of its images to
+    those of profile_io.image_file() if all_images, and the counts of all the records of the blocks to
+    profile_io.mix_file() of each of them if full_mix, and return the TableWriter of each table, whose table() holds
+    the profile if npz is in formats or columns (which only costs the memory of the columns when writing CSV)."""
+    if full_mix:
+        profile_io.require_numpy()
+    keys = roi + (items or [])
+    bb_header = ['entry', 'execution', 'exit'] + keys
     insn_header = ['pc', 'execution']
-    global_header = roi + ['text_size']
-
-    with open(sde_file, 'r') as prof, open(sde_file+'.bb.csv', 'w') as bb_csv, open(sde_file+'.insn.csv', 'w') as insn_csv, open(sde_file+'.global.csv', 'w') as global_csv:
-        bb_writer = csv.DictWriter(bb_csv, fieldnames=bb_header)
-        insn_writer = csv.DictWriter(insn_csv, fieldnames=insn_header)
-        global_writer = csv.DictWriter(global_csv, fieldnames=global_header)
-
-        metrics = defaultdict(int)
-        icounts = defaultdict(int)
-        find_image_addr_beg = find_image_addr_end = find_global_count_beg = find_global_count_end = find_top_block_beg = find_top_block_end = None
-        image_addr_low = image_addr_high = None
-        image_first_load_addr = get_image_first_load_addr(os.path.abspath(binary))
-        assert image_first_load_addr is not None, 'not found first load address of image'
-        image_text_size = get_image_text_size(os.path.abspath(binary))
-
-        for line in prof:
-            if 'EMIT_IMAGE_ADDRESSES' in line:
-                find_image_addr_beg = True
-            elif 'END_IMAGE_ADDRESSES' in line:
-                find_image_addr_end = True
-            elif 'EMIT_GLOBAL_TOP_BLOCK_STATS' in line:
-                assert image_addr_low is not None, 'not found low addr of image'
-                assert image_addr_high is not None, 'not found high addr of image'
-                find_top_block_beg = True
-                bb_writer.writeheader() # row is written when a new bb is found
-            # SDE emits this twice, one for thread, one for global
-            elif 'END_TOP_BLOCK_STATS' in line and find_top_block_beg and not find_top_block_end:
-                find_top_block_end = True
-                assert find_top_block_beg, 'not found top block begin yet'
-                insn_writer.writeheader()
-                for key, val in icounts.items():
-                    row = dict(zip(insn_header, [key, val]))
-                    insn_writer.writerow(row)
-            elif 'global-dynamic-counts' in line:
-                find_global_count_beg = True
-                assert find_top_block_end, 'not found top block end yet'
-                global_writer.writeheader()
-                metrics.clear()
-            elif 'END_GLOBAL_DYNAMIC_STATS' in line:
-                find_global_count_end = True
-                assert find_global_count_beg, 'not found global count begin yet'
-                global_metrics = metrics.copy()
-                global_metrics['text_size'] = image_text_size
-                global_writer.writerow(global_metrics)
-
-            if find_image_addr_beg and not find_image_addr_end:
-                if match := imag_addr_regex.match(line):
-                    if os.path.basename(binary) in match.group(1):
-                        image_addr_low = int(match.group(2), 16)
-                        image_addr_high = int(match.group(3), 16)
-            elif find_top_block_beg and not find_top_block_end:
-                update_bb_insn_info(line, metrics, icounts, image_addr_low, image_addr_high, image_first_load_addr, bb_writer)
-            elif find_global_count_beg and not find_global_count_end:
-                update_global_info(line, metrics)
+    global_header = keys + ['text_size']
+
+    headers = dict(zip(profile_io.tables, [bb_header, insn_header, global_header]))
+
+    with ExitStack() as stack:
+        def open_writers(prefix, tables=profile_io.tables):
+            csv_files = {table: stack.enter_context(open(profile_io.csv_file(prefix, table), 'w')) if 'csv' in formats else None
+                         for table in tables}
+            table_writers = {table: TableWriter(headers[table], csv_files[table], 'npz' in formats or columns) for table in tables}
+            if full_mix:
+                table_writers['mix'] = profile_io.MixWriter()
+            return table_writers
+        writers = open_writers(sde_file)
+        # The tables of a thread are opened when its first section is found
+        thread_writers = {}
+        def writers_of_thread(tid):
+            if tid not in thread_writers:
+                thread_writers[tid] = open_writers(profile_io.thread_file(sde_file, tid))
+            return thread_writers[tid]
+        # The images have no global table, since the global counts are those of the whole program
+        image_writers = {}
+        def writers_of_image(name):
+            if name not in image_writers:
+                image_writers[name] = open_writers(profile_io.image_file(sde_file, name), ['bb', 'insn'])
+            return image_writers[name]
+        parser = SdeParser(keys, binary, writers['bb'], writers['insn'], writers['global'], writers_of_thread if threads else None,
+                           writers_of_image if all_images else None, writers.get('mix'))
+
+        if profile_io.is_compressed(sde_file):
+            # A compressed file can only be read through, so every line is fed
+            for lines in iter_compressed_lines(sde_file):
+                parser.feed(lines)
+        else:
+            # Feed the marker lines, and the lines between them only when they are in a section of
+            # interest, parsing the top-block section in a process pool if asked to.
+            data = stack.enter_context(map_file(sde_file))
+            markers = load_index(sde_file, data)['markers']
+            prev = 0
+            for beg, end in markers + [(len(data), len(data))]:
+                if parser.section == 'top_block' and jobs > 1:
+                    parse_top_blocks_in_parallel(data, sde_file, parser, prev, beg, jobs, formats)
+                elif parser.section:
+                    feed_range(data, parser, prev, beg)
+                feed_range(data, parser, beg, end)
+                prev = end
+
+    if all_images:
+        with open(profile_io.images_file(sde_file), 'w') as images_csv:
+            images_writer = csv.DictWriter(images_csv, fieldnames=profile_io.image_fields)
+            images_writer.writeheader()
+            images_writer.writerows(parser.image_rows)
+    for prefix, prefix_writers in [(sde_file, writers)] + [(profile_io.thread_file(sde_file, tid), thread_writers[tid]) for tid in thread_writers] + \
+                                  [(profile_io.image_file(sde_file, name), image_writers[name]) for name in image_writers]:
+        if full_mix:
+            profile_io.save_mix(prefix, prefix_writers.pop('mix'))
+        if 'npz' in formats:
+            profile_io.save_npz(prefix, prefix_writers)
+        elif os.path.isfile(profile_io.npz_file(prefix)):
+            # the loader prefers npz, which would be stale now
+            os.remove(profile_io.npz_file(prefix))
+    return writers
+
+def read_global_counts(sde_file, keys=None):
+    """Return the global dynamic counts of keys (all of roi by default) in sde_file, reading only its global section,
+    or None if there is no such section."""
+    keys = keys or roi
+    columns = record_columns(keys)
+    with ExitStack() as stack:
+        if profile_io.is_compressed(sde_file):
+            section_lines = global_section_lines(iter_compressed_lines(sde_file))
+        else:
+            data = stack.enter_context(map_file(sde_file))
+            if not (section := load_index(sde_file, data)['sections']['global']):
+                return None
+            section_lines = iter_lines(data, *section)
+        counts = None
+        for lines in section_lines:
+            if counts is None:
+                counts = {}
+            for line in lines:
+                parts = line.split(None, 2)
+                if parts and line[0] not in whitespace and (j := columns.get(parts[0])) is not None:
+                    if len(parts) > 1 and parts[1].isdigit():
+                        counts[keys[j]] = int(parts[1])
+                    elif (val := parse_record(line)) is not None:
+                        counts[keys[j]] = val
+    return counts
+
+def global_section_lines(chunks):
+    """Yield the lines of the global count section among the lists of lines of chunks, as find_sections() finds it."""
+    top_block = None
+    for lines in chunks:
+        section = []
+        for line in lines:
+            if line[:1] == b'#':
+                if b'EMIT_GLOBAL_TOP_BLOCK_STATS' in line and top_block is None:
+                    top_block = 'open'
+                elif b'END_TOP_BLOCK_STATS' in line and top_block == 'open':
+                    top_block = 'closed'
+                elif b'global-dynamic-counts' in line and top_block == 'closed':
+                    top_block = 'global'
+            if top_block == 'global':
+                section.append(line)
+                if b'END_GLOBAL_DYNAMIC_STATS' in line and line[:1] == b'#':
+                    yield section
+                    return
+        if section:
+            yield section
+
+def convert_sde_global_to_csv(sde_file, binary, items=None):
+    keys = roi + (items or [])
+    with open(profile_io.csv_file(sde_file, 'global'), 'w') as global_csv:
+        global_writer = csv.DictWriter(global_csv, fieldnames=keys + ['text_size'])
+        if (global_metrics := read_global_counts(sde_file, keys)) is not None:
+            global_writer.writeheader()
+            global_metrics['text_size'] = get_image_text_size(os.path.abspath(binary))
+            global_writer.writerow(global_metrics)
 
 
 if __name__ == '__main__':
@@ -174,8 +709,20 @@ if __name__ == '__main__':
     parser.add_argument('sde_file', help='SDE file for perf')
     parser.add_argument('binary', help='binary for perf')
     parser.add_argument('--items', help='extra interesting items in perf data')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to parse the top blocks of the SDE file with (not of a compressed one, which is read through)')
+    parser.add_argument('--global-only', action='store_true', help='only write *.global.csv, reading just the global section of the SDE file')
+    parser.add_argument('--format', default='csv', help='comma-separated output formats: csv for *.bb/insn/global.csv, npz for the columnar *.npz (requires numpy)')
+    parser.add_argument('--all-images', action='store_true', help='also write the bb and insn tables of every image (the binary, shared libraries, ...), rebased to the addresses of its file, to *.image.<NAME>.bb/insn.csv (or *.image.<NAME>.npz), listed in *.images.csv')
+    parser.add_argument('--full-mix', action='store_true', help='also write the counts of all the records (categories, iforms, ISA extensions, opcodes, ...) of each block and of the global section, beyond --items, as a sparse matrix to *.mix.npz (requires numpy), for mix_rollup.py')
+    parser.add_argument('--threads', action='store_true', help='also write the tables of each thread, from its own sections, to *.tid<TID>.bb/insn/global.csv (or *.tid<TID>.npz)')
     args = parser.parse_args()
     items = [s.strip() for s in args.items.split(',')] if args.items else None
-    if items:
-        roi += items
-    convert_sde_perf_to_csv(args.sde_file, args.binary)
+    formats = [s.strip() for s in args.format.split(',')]
+    for f in formats:
+        assert f in ['csv', 'npz'], f'unsupported format {f}'
+    if args.global_only:
+        convert_sde_global_to_csv(args.sde_file, args.binary, items)
+    else:
+        if args.jobs > 1 and profile_io.is_compressed(args.sde_file):
+            print(f'warning: --jobs is ignored for the compressed {args.sde_file}, which is read through', file=sys.stderr)
+        convert_sde_perf_to_csv(args.sde_file, args.binary, args.jobs, formats, items, args.threads, args.all_images, args.full_mix)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import argparse, math, re, sys
+import profile_io
+from profile_io import np
+
+# A BBV file of SDE -bbprofile (or of the SimPoint tools) has a line per interval of a fixed number of instructions:
+#   T:45:1024 :189:99 ...
+# where each :<id>:<count> is the number of instructions executed in block id during the interval, and may map the
+# ids to the addresses of the blocks on lines like:
+#   Block id: 45 0x4011a4:0x4011df static instructions: 14 ...
+block_id_regex = re.compile(r'Block id:\s*([0-9]+)\s+(?:0x)?([0-9a-fA-F]+)')
+
+class Bbv:
+    """The basic block vectors of the intervals of a run, as a sparse matrix of instruction counts in CSR form:
+    the blocks of interval i are indices[indptr[i]:indptr[i+1]], which index block_ids, with their counts in data."""
+
+    def __init__(self, indptr, indices, data, block_ids, entries):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.block_ids = block_ids
+        # Address of the entry of each block, or None if the file does not map it
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def rows(self):
+        """Return the interval of each nonzero."""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def sizes(self):
+        """Return the number of instructions of each interval."""
+        return np.bincount(self.rows(), weights=self.data, minlength=len(self))
+
+    def mix(self, interval=None):
+        """Return the share of the instructions of each block in interval, or in the whole run, as a dense vector."""
+        beg, end = (0, len(self.data)) if interval is None else (self.indptr[interval], self.indptr[interval + 1])
+        mix = np.bincount(self.indices[beg:end], weights=self.data[beg:end], minlength=len(self.block_ids))
+        return mix / max(mix.sum(), 1)
+
+def read_bbv(path):
+    """Read the BBV file path, compressed or not."""
+    profile_io.require_numpy()
+    lengths, pairs, addresses = [], [], {}
+    with profile_io.open_text(path) as f:
+        for line in f:
+            if line.startswith('T'):
+                # ":<id>:<count> :<id>:<count> ..." to the ids and counts interleaved
+                pairs.append(np.array(line[1:].replace(':', ' ').split(), dtype=np.int64))
+                lengths.append(len(pairs[-1]) // 2)
+            elif matches := block_id_regex.match(line):
+                addresses[int(matches.group(1))] = int(matches.group(2), 16)
+    pairs = np.concatenate(pairs) if pairs else np.zeros(0, dtype=np.int64)
+    block_ids, indices = np.unique(pairs[0::2], return_inverse=True)
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return Bbv(indptr, indices.reshape(-1), pairs[1::2], block_ids, [addresses.get(block_id) for block_id in block_ids.tolist()])
+
+def project(bbv, dims, rng):
+    """Return the vectors of the intervals, each normalized to a sum of 1, projected to dims dimensions by a random
+    matrix of uniform values in [-1, 1]."""
+    projection = rng.uniform(-1, 1, (len(bbv.block_ids), dims))
+    rows = bbv.rows()
+    weights = bbv.data / np.maximum(bbv.sizes(), 1)[rows]
+    return np.stack([np.bincount(rows, weights=weights * projection[bbv.indices, dim], minlength=len(bbv)) for dim in range(dims)], axis=1)
+
+def squared_distances(points, centers):
+    return np.maximum((points ** 2).sum(1)[:, None] - 2 * points @ centers.T + (centers ** 2).sum(1)[None, :], 0)
+
+def kmeans(points, k, rng, iterations=100):
+    """Cluster points into k clusters, seeded by k-means++, and return the centers, the label of each point and the
+    sum of the squared distances of the points to their centers."""
+    n = len(points)
+    centers = [points[rng.integers(n)]]
+    nearest = ((points - centers[0]) ** 2).sum(1)
+    for _ in range(1, k):
+        total = nearest.sum()
+        center = points[rng.choice(n, p=nearest / total) if total > 0 else rng.integers(n)]
+        centers.append(center)
+        nearest = np.minimum(nearest, ((points - center) ** 2).sum(1))
+    centers = np.array(centers)
+    for _ in range(iterations):
+        labels = squared_distances(points, centers).argmin(1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, points)
+        # An empty cluster keeps its center
+        new_centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    labels = squared_distances(points, centers).argmin(1)
+    return centers, labels, ((points - centers[labels]) ** 2).sum()
+
+def bic(points, labels, k, distortion):
+    """Return the Bayesian information criterion of the clustering, for spherical Gaussian clusters of a shared
+    variance, as SimPoint scores it."""
+    n, dims = points.shape
+    if n <= k:
+        return 0.0
+    variance = max(distortion / (dims * (n - k)), 1e-300)
+    counts = np.bincount(labels, minlength=k)
+    counts = counts[counts > 0]
+    likelihood = (counts * np.log(counts) - counts * math.log(n) - counts * dims / 2 * math.log(2 * math.pi * variance) - dims * (counts - 1) / 2).sum()
+    return likelihood - k * (dims + 1) / 2 * math.log(n)
+
+def choose_simpoints(points, sizes, max_k, rng, seeds=5, bic_threshold=0.9):
+    """Cluster points for k in 1..max_k, keeping the best of seeds runs of each k, and pick the smallest k whose BIC
+    reaches bic_threshold of the range of the BICs. Return the representative interval of each cluster, the one
+    closest to its center, with the share of the instructions of the cluster, and the chosen k with the BIC of each k."""
+    clusterings = []
+    for k in range(1, min(max_k, len(points)) + 1):
+        centers, labels, distortion = min((kmeans(points, k, rng) for _ in range(seeds)), key=lambda clustering: clustering[2])
+        clusterings.append((centers, labels, bic(points, labels, k, distortion)))
+    bics = [score for _, _, score in clusterings]
+    target = min(bics) + bic_threshold * (max(bics) - min(bics))
+    k = next(k for k, score in enumerate(bics, 1) if score >= target)
+    centers, labels, _ = clusterings[k - 1]
+
+    distances = ((points - centers[labels]) ** 2).sum(1)
+    simpoints = []
+    for cluster in range(k):
+        members = np.flatnonzero(labels == cluster)
+        if len(members):
+            simpoints.append((int(members[distances[members].argmin()]), sizes[members].sum() / sizes.sum()))
+    return sorted(simpoints), k, bics
+
+def estimated_mix(bbv, simpoints):
+    """Return the block mix of the whole run estimated by the simpoints weighted by their clusters."""
+    return sum(weight * bbv.mix(interval) for interval, weight in simpoints)
+
+def bbv_error(bbv, simpoints):
+    """Return the distance (half the L1 norm, in [0, 1]) between the block mix of the whole run and the estimated one."""
+    return np.abs(bbv.mix() - estimated_mix(bbv, simpoints)).sum() / 2
+
+def block_rates(bbv, sim_file, metrics):
+    """Return the count of each of metrics per instruction of each block of bbv, by the bb table of sim_file, with
+    the blocks unknown to it at 0."""
+    header, columns = profile_io.load_columns(sim_file, 'bb')
+    rates = np.zeros((len(bbv.entries), len(metrics)))
+    if not header or not len(columns['entry']):
+        return rates
+    order = np.argsort(columns['entry'], kind='stable')
+    entries = columns['entry'][order]
+    totals = columns['total'][order]
+    bbv_entries = np.array(bbv.entries, dtype=np.uint64)
+    positions = np.minimum(np.searchsorted(entries, bbv_entries), len(entries) - 1)
+    known = (entries[positions] == bbv_entries) & (totals[positions] > 0)
+    for i, metric in enumerate(metrics):
+        if metric in columns:
+            rates[known, i] = columns[metric][order][positions[known]] / totals[positions[known]]
+    return rates
+
+def global_errors(bbv, simpoints, sim_file, metrics):
+    """Return (metric, global count, count estimated from the simpoints, from the whole BBV) of each of metrics, the
+    estimates scaling the per-instruction rates of the blocks of the bb table of sim_file to the global icount."""
+    with profile_io.open_table(sim_file, 'global') as reader:
+        global_row = next(iter(reader), {})
+    global_total = int(global_row.get('total') or 0)
+    rates = block_rates(bbv, sim_file, metrics) * global_total
+    estimated, whole = estimated_mix(bbv, simpoints) @ rates, bbv.mix() @ rates
+    return [(metric, int(global_row.get(metric) or 0), estimated[i], whole[i]) for i, metric in enumerate(metrics)]
+
+def write_simpoints(prefix, simpoints):
+    """Write <prefix>.simpoints and <prefix>.weights in the format of the SimPoint tools."""
+    with open(prefix + '.simpoints', 'w') as simpoints_file, open(prefix + '.weights', 'w') as weights_file:
+        for cluster, (interval, weight) in enumerate(simpoints):
+            print(f'{interval} {cluster}', file=simpoints_file)
+            print(f'{weight:.6f} {cluster}', file=weights_file)
+
+def relative_error(estimate, actual):
+    return '{:+.2f}%'.format((estimate - actual) / actual * 100) if actual else '-'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pick the representative intervals of a run (SimPoint-style) from its basic block vectors: random projection and k-means of the intervals, with the weight of each, and how well they reproduce the whole run.')
+    parser.add_argument('bbv', help='BBV file of SDE -bbprofile (or .gz, .zst, .xz)')
+    parser.add_argument('--sim-file', help='SDE file of the same run, whose bb and global tables (*.bb.csv, *.global.csv or *.npz) the estimates are checked against, when the BBV file maps its blocks to addresses')
+    parser.add_argument('--metrics', default='total,mem-read,mem-write,category-COND_BR,category-UNCOND_BR', help='comma-separated global counts to check')
+    parser.add_argument('--max-k', type=int, default=30, help='maximum number of clusters')
+    parser.add_argument('--dims', type=int, default=15, help='number of dimensions of the random projection')
+    parser.add_argument('--seeds', type=int, default=5, help='number of k-means runs of each k')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random projection and of k-means')
+    parser.add_argument('-o', '--output', help='prefix of the *.simpoints and *.weights files (default: the BBV file)')
+    args = parser.parse_args()
+
+    profile_io.require_numpy()
+    rng = np.random.default_rng(args.seed)
+    bbv = read_bbv(args.bbv)
+    assert len(bbv), f'no interval in {args.bbv}'
+    sizes = bbv.sizes()
+    simpoints, k, bics = choose_simpoints(project(bbv, args.dims, rng), sizes, args.max_k, rng, args.seeds)
+    write_simpoints(args.output or args.bbv, simpoints)
+
+    out = sys.stdout
+    print(f'intervals: {format(len(bbv), ",")}, blocks: {format(len(bbv.block_ids), ",")}, instructions: {format(int(sizes.sum()), ",")}', file=out)
+    print(f'k: {k} (BIC of k=1..{len(bics)}: {" ".join(f"{score:.0f}" for score in bics)})', file=out)
+    for cluster, (interval, weight) in enumerate(simpoints):
+        print(f'  {cluster:>4} interval {interval:>8} weight {weight:.4f}', file=out)
+    print(f'BBV distance of the weighted simpoints to the whole run: {bbv_error(bbv, simpoints):.4f}', file=out)
+    print(f'simulated instructions: {format(int(sizes[[interval for interval, _ in simpoints]].sum()), ",")} ({len(simpoints) / len(bbv):.2%} of the intervals)', file=out)
+    if args.sim_file:
+        if None in bbv.entries:
+            print('the BBV file does not map all its blocks to addresses, so the global counts are not checked', file=out)
+        else:
+            print(f'{"metric":<24} {"global":>16} {"simpoints":>16} {"error":>8} {"whole BBV":>16} {"error":>8}', file=out)
+            for metric, actual, estimated, whole in global_errors(bbv, simpoints, args.sim_file, args.metrics.split(',')):
+                print(f'{metric:<24} {format(actual, ","):>16} {format(round(estimated), ","):>16} {relative_error(estimated, actual):>8} '
+                      f'{format(round(whole), ","):>16} {relative_error(whole, actual):>8}', file=out)
@@ -0,0 +1,51 @@
+import os, shutil
+import profile_io
+
+# Files are staged (by copy_files.py, and from the cache of disasm.py) as complete copies, compressed copies or links.
+
+# ioctl of Linux to make dst share the extents of src (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src, and return whether the file system allows it."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+    if cloned:
+        shutil.copymode(src, dst)
+    else:
+        os.remove(dst)
+    return cloned
+
+def hardlink(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        return False
+    return True
+
+def stage_file(src, dst, compress=None, link=True):
+    """Copy src to dst, compressed by compress if given, else as a reflink or a hard link of src if link and the
+    file system allows it, else as a byte copy. dst is replaced only once it is complete."""
+    # The suffix of dst is kept, since it selects the compression
+    tmp = os.path.join(os.path.dirname(dst), '.tmp.' + os.path.basename(dst))
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if compress:
+        with open(src, 'rb') as src_file, profile_io.open_compressed(tmp, 'wb') as dst_file:
+            shutil.copyfileobj(src_file, dst_file, 1 << 24)
+    elif not (link and (reflink(src, tmp) or hardlink(src, tmp))):
+        shutil.copy(src, tmp)
+    # Renaming a hard link over another link of the same file leaves both
+    if os.path.exists(dst) and os.path.samefile(tmp, dst):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, dst)
@@ -0,0 +1,989 @@
+#!/usr/bin/env python3
+import argparse, bisect, mmap, sys, zlib
+from collections import namedtuple
+
+# Resolve addresses of an ELF binary to function names and source lines in-process, the way
+# `addr2line -f -e binary` of GNU Binutils does: a function name comes from the DWARF debug info
+# or the nearest preceding symbol of the section, and a source line from the DWARF line table,
+# printed as `file:line`, `file:?` (no line) or `??:0` (not in any section of the binary).
+# addr2line names a function without a linkage name (e.g. an inlined C++ function) after the
+# nearest symbol at its first lookup only, and after itself from then on, so its output depends on
+# the order of the addresses; here every address is named as addr2line names it alone.
+
+PT_LOAD = 1
+SHT_SYMTAB, SHT_NOBITS, SHT_DYNSYM = 2, 8, 11
+SHF_ALLOC, SHF_COMPRESSED = 0x2, 0x800
+STT_NOTYPE, STT_OBJECT, STT_FUNC, STT_SECTION, STT_FILE, STT_TLS, STT_GNU_IFUNC = 0, 1, 2, 3, 4, 6, 10
+STB_LOCAL = 0
+STV_HIDDEN = 2
+ELFCOMPRESS_ZLIB = 1
+
+Segment = namedtuple('Segment', 'type vaddr memsz')
+Section = namedtuple('Section', 'index name type flags addr offset size link')
+Symbol = namedtuple('Symbol', 'name value size type bind other shndx')
+
+# Version of the results of Symbolizer.lookup(), to bump when they change, so that the symbols cached by symcache.py
+# from an older version are not reused
+version = 2
+
+class Elf:
+    """Headers, sections and symbols of an ELF binary."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+        assert data[:4] == b'\x7fELF', f'{path} is not an ELF file'
+        self.is64 = data[4] == 2
+        self.endian = 'little' if data[5] == 1 else 'big'
+        fields = self.unpack(16, [2, 2, 4] + [8 if self.is64 else 4] * 3 + [4, 2, 2, 2, 2, 2, 2])
+        phoff, shoff, phentsize, phnum, shentsize, shnum, shstrndx = fields[4], fields[5], *fields[8:]
+
+        self.segments = []
+        for i in range(phnum):
+            if self.is64:
+                p_type, _, _, p_vaddr, _, _, p_memsz, _ = self.unpack(phoff + i * phentsize, [4, 4, 8, 8, 8, 8, 8, 8])
+            else:
+                p_type, _, p_vaddr, _, _, p_memsz, _, _ = self.unpack(phoff + i * phentsize, [4] * 8)
+            self.segments.append(Segment(p_type, p_vaddr, p_memsz))
+
+        headers = []
+        sizes = [4, 4, 8, 8, 8, 8, 4, 4, 8, 8] if self.is64 else [4] * 10
+        if shoff:
+            first = self.unpack(shoff, sizes)
+            # Extended section numbering
+            shnum = shnum or first[5]
+            shstrndx = first[7] if shstrndx == 0xffff else shstrndx
+            headers = [self.unpack(shoff + i * shentsize, sizes) for i in range(shnum)]
+        names = headers[shstrndx][4] if headers else 0
+        self.sections = [Section(i, self.cstring(names + h[0]), h[1], h[2], h[3], h[4], h[5], h[6])
+                         for i, h in enumerate(headers)]
+        self.by_name = {}
+        for section in self.sections:
+            self.by_name.setdefault(section.name, section)
+
+    def unpack(self, offset, sizes):
+        values = []
+        for size in sizes:
+            values.append(int.from_bytes(self.data[offset:offset+size], self.endian))
+            offset += size
+        return values
+
+    def cstring(self, offset):
+        return self.data[offset:self.data.find(b'\0', offset)].decode('utf-8', 'replace')
+
+    def close(self):
+        self.data.close()
+
+    def first_load_addr(self):
+        for segment in self.segments:
+            if segment.type == PT_LOAD:
+                return segment.vaddr
+        return None
+
+    def load_size(self):
+        """Return the size of the address range the loadable segments are mapped over."""
+        loads = [segment for segment in self.segments if segment.type == PT_LOAD]
+        return max(s.vaddr + s.memsz for s in loads) - min(s.vaddr for s in loads) if loads else 0
+
+    def section_size(self, name):
+        section = self.by_name.get(name)
+        return section.size if section else None
+
+    def build_id(self):
+        """Return the GNU build-id of the binary as a hex string, or None."""
+        data = self.section_data('.note.gnu.build-id')
+        if not data:
+            return None
+        namesz, descsz = int.from_bytes(data[0:4], self.endian), int.from_bytes(data[4:8], self.endian)
+        desc = 12 + (namesz + 3) // 4 * 4
+        return data[desc:desc+descsz].hex()
+
+    def section_data(self, name):
+        """Return the content of the section name, decompressed, or None if there is no such section."""
+        section = self.by_name.get(name) or self.by_name.get('.z' + name[1:])
+        if section is None or section.type == SHT_NOBITS:
+            return None
+        data = self.data[section.offset:section.offset+section.size]
+        if section.flags & SHF_COMPRESSED:
+            header_size = 24 if self.is64 else 12
+            if int.from_bytes(data[:4], self.endian) != ELFCOMPRESS_ZLIB:
+                return None
+            return zlib.decompress(data[header_size:])
+        if section.name.startswith('.zdebug') and data[:4] == b'ZLIB':
+            return zlib.decompress(data[12:])
+        return data
+
+    def symbols(self):
+        """Return the symbols of .symtab, or of .dynsym if there is none, in their order."""
+        table = next((s for s in self.sections if s.type == SHT_SYMTAB), None) or \
+            next((s for s in self.sections if s.type == SHT_DYNSYM), None)
+        if table is None:
+            return []
+        strtab = self.sections[table.link].offset
+        entsize = 24 if self.is64 else 16
+        symbols = []
+        for offset in range(table.offset + entsize, table.offset + table.size, entsize):
+            if self.is64:
+                name, info, other, shndx, value, size = self.unpack(offset, [4, 1, 1, 2, 8, 8])
+            else:
+                name, value, size, info, other, shndx = self.unpack(offset, [4, 4, 4, 1, 1, 2])
+            symbols.append(Symbol(self.cstring(strtab + name), value, size, info & 0xf, info >> 4, other, shndx))
+        return symbols
+
+class IntervalIndex:
+    """Find the intervals [low, high) containing an address with a bisect over the sorted lows."""
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.lows = [low for low, _, _ in self.intervals]
+        self.reach = []
+        reach = 0
+        for _, high, _ in self.intervals:
+            reach = max(reach, high)
+            self.reach.append(reach)
+
+    def containing(self, address):
+        """Return the payloads of the intervals containing address."""
+        payloads = []
+        i = bisect.bisect_right(self.lows, address) - 1
+        while i >= 0 and self.reach[i] > address:
+            low, high, payload = self.intervals[i]
+            if address < high:
+                payloads.append(payload)
+            i -= 1
+        return payloads
+
+# DWARF constants
+DW_TAG_entry_point, DW_TAG_inlined_subroutine, DW_TAG_subprogram = 0x03, 0x1d, 0x2e
+DW_AT_name, DW_AT_stmt_list, DW_AT_low_pc, DW_AT_high_pc, DW_AT_language, DW_AT_comp_dir = 0x03, 0x10, 0x11, 0x12, 0x13, 0x1b
+DW_AT_abstract_origin, DW_AT_specification, DW_AT_ranges, DW_AT_linkage_name = 0x31, 0x47, 0x55, 0x6e
+DW_AT_str_offsets_base, DW_AT_addr_base, DW_AT_rnglists_base = 0x72, 0x73, 0x74
+DW_AT_MIPS_linkage_name, DW_AT_GNU_ranges_base, DW_AT_GNU_addr_base = 0x2007, 0x2132, 0x2133
+DW_FORM_addr, DW_FORM_block2, DW_FORM_block4, DW_FORM_data2, DW_FORM_data4, DW_FORM_data8 = 0x01, 0x03, 0x04, 0x05, 0x06, 0x07
+DW_FORM_string, DW_FORM_block, DW_FORM_block1, DW_FORM_data1, DW_FORM_flag, DW_FORM_sdata = 0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0d
+DW_FORM_strp, DW_FORM_udata, DW_FORM_ref_addr, DW_FORM_ref1, DW_FORM_ref2, DW_FORM_ref4 = 0x0e, 0x0f, 0x10, 0x11, 0x12, 0x13
+DW_FORM_ref8, DW_FORM_ref_udata, DW_FORM_indirect, DW_FORM_sec_offset, DW_FORM_exprloc = 0x14, 0x15, 0x16, 0x17, 0x18
+DW_FORM_flag_present, DW_FORM_strx, DW_FORM_addrx, DW_FORM_ref_sup4, DW_FORM_strp_sup = 0x19, 0x1a, 0x1b, 0x1c, 0x1d
+DW_FORM_data16, DW_FORM_line_strp, DW_FORM_ref_sig8, DW_FORM_implicit_const, DW_FORM_loclistx = 0x1e, 0x1f, 0x20, 0x21, 0x22
+DW_FORM_rnglistx, DW_FORM_ref_sup8, DW_FORM_strx1, DW_FORM_strx2, DW_FORM_strx3, DW_FORM_strx4 = 0x23, 0x24, 0x25, 0x26, 0x27, 0x28
+DW_FORM_addrx1, DW_FORM_addrx2, DW_FORM_addrx3, DW_FORM_addrx4 = 0x29, 0x2a, 0x2b, 0x2c
+DW_FORM_GNU_addr_index, DW_FORM_GNU_str_index, DW_FORM_GNU_ref_alt, DW_FORM_GNU_strp_alt = 0x1f01, 0x1f02, 0x1f20, 0x1f21
+DW_LNCT_path, DW_LNCT_directory_index = 1, 2
+
+function_tags = {DW_TAG_subprogram, DW_TAG_entry_point, DW_TAG_inlined_subroutine}
+string_forms = {DW_FORM_string, DW_FORM_strp, DW_FORM_line_strp, DW_FORM_strx, DW_FORM_strx1, DW_FORM_strx2, DW_FORM_strx3,
+                DW_FORM_strx4, DW_FORM_GNU_str_index, DW_FORM_strp_sup, DW_FORM_GNU_strp_alt}
+strx_forms = {DW_FORM_strx, DW_FORM_strx1, DW_FORM_strx2, DW_FORM_strx3, DW_FORM_strx4, DW_FORM_GNU_str_index}
+addrx_forms = {DW_FORM_addrx, DW_FORM_addrx1, DW_FORM_addrx2, DW_FORM_addrx3, DW_FORM_addrx4, DW_FORM_GNU_addr_index}
+ref_forms = {DW_FORM_ref_addr, DW_FORM_ref1, DW_FORM_ref2, DW_FORM_ref4, DW_FORM_ref8, DW_FORM_ref_udata}
+fixed_sizes = {DW_FORM_data1: 1, DW_FORM_ref1: 1, DW_FORM_flag: 1, DW_FORM_strx1: 1, DW_FORM_addrx1: 1,
+               DW_FORM_data2: 2, DW_FORM_ref2: 2, DW_FORM_strx2: 2, DW_FORM_addrx2: 2, DW_FORM_strx3: 3, DW_FORM_addrx3: 3,
+               DW_FORM_data4: 4, DW_FORM_ref4: 4, DW_FORM_ref_sup4: 4, DW_FORM_strx4: 4, DW_FORM_addrx4: 4,
+               DW_FORM_data8: 8, DW_FORM_ref8: 8, DW_FORM_ref_sig8: 8, DW_FORM_ref_sup8: 8, DW_FORM_data16: 16,
+               DW_FORM_flag_present: 0, DW_FORM_implicit_const: 0}
+offset_forms = {DW_FORM_strp, DW_FORM_line_strp, DW_FORM_sec_offset, DW_FORM_strp_sup, DW_FORM_GNU_ref_alt, DW_FORM_GNU_strp_alt}
+leb_forms = {DW_FORM_udata, DW_FORM_ref_udata, DW_FORM_strx, DW_FORM_addrx, DW_FORM_loclistx, DW_FORM_rnglistx,
+             DW_FORM_GNU_addr_index, DW_FORM_GNU_str_index}
+# Languages whose DW_AT_name is the linkage name
+unmangled_languages = {0x1, 0x2, 0x5, 0x6, 0x7, 0x9, 0xc, 0xf, 0x12, 0x1d, 0x8001}
+
+def read_uleb(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def read_sleb(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return result - (1 << shift) if byte & 0x40 else result, pos
+
+def read_cstring(data, pos):
+    end = data.index(b'\0', pos)
+    return data[pos:end].decode('utf-8', 'replace'), end + 1
+
+class Function:
+    """A subprogram, entry point or inlined subroutine DIE with its address ranges."""
+
+    def __init__(self):
+        self.name = None
+        self.is_linkage = False
+        self.ranges = []
+
+class Unit:
+    """A compilation unit of .debug_info, whose functions and line table are read on first use."""
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.lang = 0
+        self.comp_dir = None
+        self.stmt_list = None
+        self.base_address = 0
+        self.str_offsets_base = 0
+        self.addr_base = 0
+        self.rnglists_base = None
+        self.ranges = []
+        self.functions = None
+        self.lines = None
+
+class LineTable:
+    """The sequences of rows (address, file, line, discriminator) of a line number program."""
+
+    def __init__(self, sequences):
+        # Sort the sequences, dropping the nested ones and trimming the overlapping ones
+        sequences.sort(key=lambda seq: (seq[0][0], -seq[-1][0], -len(seq)))
+        self.lows, self.sequences = [], []
+        for seq in sequences:
+            low = seq[0][0]
+            if self.sequences and low < self.sequences[-1][-1][0]:
+                if seq[-1][0] <= self.sequences[-1][-1][0]:
+                    continue
+                low = self.sequences[-1][-1][0]
+            self.lows.append(low)
+            self.sequences.append(seq)
+        self.addresses = [[row[0] for row in seq] for seq in self.sequences]
+
+    def lookup(self, address):
+        i = bisect.bisect_right(self.lows, address) - 1
+        if i < 0 or address >= self.sequences[i][-1][0]:
+            return None
+        addresses = self.addresses[i]
+        j = bisect.bisect_right(addresses, address) - 1
+        # The last row of a sequence is its end
+        if j < 0 or j == len(addresses) - 1:
+            return None
+        return self.sequences[i][j]
+
+class Dwarf:
+    """The functions and line tables of the DWARF debug info of an ELF binary."""
+
+    def __init__(self, elf):
+        self.endian = elf.endian
+        self.info = elf.section_data('.debug_info')
+        self.abbrev = elf.section_data('.debug_abbrev')
+        self.line = elf.section_data('.debug_line')
+        self.str = elf.section_data('.debug_str')
+        self.line_str = elf.section_data('.debug_line_str')
+        self.ranges = elf.section_data('.debug_ranges')
+        self.rnglists = elf.section_data('.debug_rnglists')
+        self.addr = elf.section_data('.debug_addr')
+        self.str_offsets = elf.section_data('.debug_str_offsets')
+        self.abbrevs = {}
+        self.abstract_names = {}
+        self.units = []
+        pos = 0
+        while self.info and pos < len(self.info):
+            unit = self.read_unit_header(pos)
+            # Like addr2line, skip the skeleton units of split DWARF
+            if unit.version and unit.unit_type in (1, 3):
+                self.read_unit_die(unit)
+                self.units.append(unit)
+            pos = unit.end
+        self.unit_offsets = [unit.offset for unit in self.units]
+        self.unit_index = IntervalIndex([(low, high, i) for i, unit in enumerate(self.units) for low, high in unit.ranges])
+        self.sequence_index = None
+
+    def int(self, data, pos, size):
+        return int.from_bytes(data[pos:pos+size], self.endian)
+
+    def read_unit_header(self, pos):
+        unit = Unit(pos)
+        length = self.int(self.info, pos, 4)
+        unit.offset_size = 4
+        pos += 4
+        if length == 0xffffffff:
+            length = self.int(self.info, pos, 8)
+            unit.offset_size = 8
+            pos += 8
+        unit.end = pos + length
+        unit.version = self.int(self.info, pos, 2)
+        pos += 2
+        unit.unit_type = 1
+        if unit.version >= 5:
+            unit.unit_type = self.info[pos]
+            unit.address_size = self.info[pos+1]
+            abbrev_offset = self.int(self.info, pos + 2, unit.offset_size)
+            pos += 2 + unit.offset_size
+            if unit.unit_type in (4, 5):
+                pos += 8
+            elif unit.unit_type in (2, 6):
+                pos += 8 + unit.offset_size
+        elif 2 <= unit.version <= 4:
+            abbrev_offset = self.int(self.info, pos, unit.offset_size)
+            unit.address_size = self.info[pos + unit.offset_size]
+            pos += unit.offset_size + 1
+        else:
+            unit.version = None
+            return unit
+        unit.die_offset = pos
+        key = (abbrev_offset, unit.address_size, unit.offset_size, unit.version)
+        if key not in self.abbrevs:
+            self.abbrevs[key] = self.read_abbrevs(abbrev_offset, unit)
+        unit.abbrevs = self.abbrevs[key]
+        return unit
+
+    def read_abbrevs(self, pos, unit):
+        """Return the tag, attribute specs and fixed size (or None) of the DIEs by abbrev code."""
+        abbrevs = {}
+        data = self.abbrev
+        while True:
+            code, pos = read_uleb(data, pos)
+            if code == 0:
+                return abbrevs
+            tag, pos = read_uleb(data, pos)
+            pos += 1 # has children
+            specs = []
+            size = 0
+            while True:
+                name, pos = read_uleb(data, pos)
+                form, pos = read_uleb(data, pos)
+                const = None
+                if form == DW_FORM_implicit_const:
+                    const, pos = read_sleb(data, pos)
+                if name == 0 and form == 0:
+                    break
+                specs.append((name, form, const))
+                form_size = self.form_size(form, unit)
+                size = None if size is None or form_size is None else size + form_size
+            abbrevs[code] = (tag, specs, size)
+
+    def form_size(self, form, unit):
+        if form in fixed_sizes:
+            return fixed_sizes[form]
+        if form in offset_forms:
+            return unit.offset_size
+        if form == DW_FORM_addr:
+            return unit.address_size
+        if form == DW_FORM_ref_addr:
+            return unit.address_size if unit.version == 2 else unit.offset_size
+        return None
+
+    def read_form(self, data, pos, form, unit, const=None):
+        """Return the raw value of an attribute of form at pos of data, and the position after it."""
+        if form == DW_FORM_implicit_const:
+            return const, pos
+        size = self.form_size(form, unit)
+        if size is not None:
+            return self.int(data, pos, size), pos + size
+        if form in leb_forms:
+            return read_uleb(data, pos)
+        if form == DW_FORM_sdata:
+            return read_sleb(data, pos)
+        if form == DW_FORM_string:
+            return read_cstring(data, pos)
+        if form in (DW_FORM_block, DW_FORM_exprloc):
+            size, pos = read_uleb(data, pos)
+            return None, pos + size
+        if form in (DW_FORM_block1, DW_FORM_block2, DW_FORM_block4):
+            size_size = {DW_FORM_block1: 1, DW_FORM_block2: 2, DW_FORM_block4: 4}[form]
+            return None, pos + size_size + self.int(data, pos, size_size)
+        if form == DW_FORM_indirect:
+            form, pos = read_uleb(data, pos)
+            return self.read_form(data, pos, form, unit)
+        raise ValueError(f'unsupported DWARF form {form:#x}')
+
+    def string(self, form, value, unit):
+        """Return the string of a string form attribute, or None if it is in another file."""
+        if form == DW_FORM_string:
+            return value
+        if form in strx_forms:
+            if self.str_offsets is None:
+                return None
+            value = self.int(self.str_offsets, unit.str_offsets_base + value * unit.offset_size, unit.offset_size)
+            form = DW_FORM_strp
+        section = self.str if form == DW_FORM_strp else self.line_str if form == DW_FORM_line_strp else None
+        return read_cstring(section, value)[0] if section is not None else None
+
+    def address(self, form, value, unit):
+        if form in addrx_forms:
+            return self.int(self.addr, unit.addr_base + value * unit.address_size, unit.address_size)
+        return value
+
+    def read_die(self, unit, pos):
+        """Return the tag and attributes (name, form, value) of the DIE at pos, and the position after it."""
+        code, pos = read_uleb(self.info, pos)
+        if code == 0:
+            return None, [], pos
+        tag, specs, _ = unit.abbrevs[code]
+        attrs = []
+        for name, form, const in specs:
+            if form == DW_FORM_indirect:
+                form, pos = read_uleb(self.info, pos)
+            value, pos = self.read_form(self.info, pos, form, unit, const)
+            attrs.append((name, form, value))
+        return tag, attrs, pos
+
+    def read_unit_die(self, unit):
+        _, attrs, _ = self.read_die(unit, unit.die_offset)
+        for name, form, value in attrs:
+            if name == DW_AT_str_offsets_base:
+                unit.str_offsets_base = value
+            elif name in (DW_AT_addr_base, DW_AT_GNU_addr_base):
+                unit.addr_base = value
+            elif name in (DW_AT_rnglists_base, DW_AT_GNU_ranges_base):
+                unit.rnglists_base = value
+        low_pc = high_pc = 0
+        relative = False
+        for name, form, value in attrs:
+            if name == DW_AT_language:
+                unit.lang = value
+            elif name == DW_AT_comp_dir and form in string_forms:
+                comp_dir = self.string(form, value, unit)
+                # Drop the <machine>.: prefix of Irix compilers
+                colon = comp_dir.find(':') if comp_dir else -1
+                if colon > 0 and comp_dir[colon-1] == '.' and comp_dir[colon+1:colon+2] == '/':
+                    comp_dir = comp_dir[colon+1:]
+                unit.comp_dir = comp_dir
+            elif name == DW_AT_stmt_list:
+                unit.stmt_list = value
+            elif name == DW_AT_low_pc:
+                low_pc = unit.base_address = self.address(form, value, unit)
+            elif name == DW_AT_high_pc:
+                high_pc = self.address(form, value, unit)
+                relative = form != DW_FORM_addr and form not in addrx_forms
+        for name, form, value in attrs:
+            if name == DW_AT_ranges:
+                unit.ranges += self.read_ranges(unit, form, value)
+        if relative:
+            high_pc += low_pc
+        if high_pc and low_pc != high_pc:
+            unit.ranges.append((low_pc, high_pc))
+
+    def read_ranges(self, unit, form, value):
+        """Return the ranges of a DW_AT_ranges attribute."""
+        ranges = []
+        base = unit.base_address
+        size = unit.address_size
+        if unit.version < 5:
+            data = self.ranges
+            if data is None:
+                return ranges
+            pos = value + (unit.rnglists_base or 0)
+            max_address = (1 << (8 * size)) - 1
+            while pos + 2 * size <= len(data):
+                low, high = self.int(data, pos, size), self.int(data, pos + size, size)
+                pos += 2 * size
+                if low == 0 and high == 0:
+                    break
+                if low == max_address:
+                    base = high
+                elif low != high:
+                    ranges.append((base + low, base + high))
+            return ranges
+
+        data = self.rnglists
+        if data is None:
+            return ranges
+        if form == DW_FORM_rnglistx:
+            base_offset = unit.rnglists_base or 0
+            pos = base_offset + self.int(data, base_offset + value * unit.offset_size, unit.offset_size)
+        else:
+            pos = value
+        address = lambda index: self.int(self.addr, unit.addr_base + index * size, size)
+        while pos < len(data):
+            kind = data[pos]
+            pos += 1
+            if kind == 0: # DW_RLE_end_of_list
+                break
+            elif kind == 1: # DW_RLE_base_addressx
+                index, pos = read_uleb(data, pos)
+                base = address(index)
+                continue
+            elif kind == 2: # DW_RLE_startx_endx
+                start, pos = read_uleb(data, pos)
+                end, pos = read_uleb(data, pos)
+                low, high = address(start), address(end)
+            elif kind == 3: # DW_RLE_startx_length
+                start, pos = read_uleb(data, pos)
+                length, pos = read_uleb(data, pos)
+                low = address(start)
+                high = low + length
+            elif kind == 4: # DW_RLE_offset_pair
+                start, pos = read_uleb(data, pos)
+                end, pos = read_uleb(data, pos)
+                low, high = base + start, base + end
+            elif kind == 5: # DW_RLE_base_address
+                base = self.int(data, pos, size)
+                pos += size
+                continue
+            elif kind == 6: # DW_RLE_start_end
+                low, high = self.int(data, pos, size), self.int(data, pos + size, size)
+                pos += 2 * size
+            elif kind == 7: # DW_RLE_start_length
+                low = self.int(data, pos, size)
+                length, pos = read_uleb(data, pos + size)
+                high = low + length
+            else:
+                break
+            if low != high:
+                ranges.append((low, high))
+        return ranges
+
+    def unit_at(self, offset):
+        return self.units[bisect.bisect_right(self.unit_offsets, offset) - 1]
+
+    def abstract_name(self, unit, form, value, depth=0):
+        """Return the name of the DIE referenced by a DW_AT_abstract_origin or DW_AT_specification attribute,
+        and whether it is a linkage name."""
+        if form == DW_FORM_ref_addr:
+            offset = value
+            unit = self.unit_at(offset)
+        elif form in ref_forms:
+            offset = unit.offset + value
+        else:
+            return None, False
+        if offset in self.abstract_names:
+            return self.abstract_names[offset]
+        name, is_linkage = None, False
+        _, attrs, _ = self.read_die(unit, offset)
+        for attr, attr_form, attr_value in attrs:
+            if attr == DW_AT_name:
+                if name is None and attr_form in string_forms:
+                    name = self.string(attr_form, attr_value, unit)
+                    is_linkage = is_linkage or unit.lang in unmangled_languages
+            elif attr == DW_AT_specification:
+                if attr_form in ref_forms and depth < 100:
+                    name, linkage = self.abstract_name(unit, attr_form, attr_value, depth + 1)
+                    is_linkage = is_linkage or linkage
+            elif attr in (DW_AT_linkage_name, DW_AT_MIPS_linkage_name):
+                if attr_form in string_forms:
+                    name = self.string(attr_form, attr_value, unit)
+                    is_linkage = True
+        self.abstract_names[offset] = name, is_linkage
+        return name, is_linkage
+
+    def read_functions(self, unit):
+        """Index the functions of unit by their address ranges."""
+        functions = []
+        data = self.info
+        pos = unit.die_offset
+        while pos < unit.end:
+            start = pos
+            code, pos = read_uleb(data, pos)
+            if code == 0:
+                continue
+            tag, specs, size = unit.abbrevs[code]
+            if tag not in function_tags:
+                if size is not None:
+                    pos += size
+                else:
+                    for _, form, const in specs:
+                        if form == DW_FORM_indirect:
+                            form, pos = read_uleb(data, pos)
+                        _, pos = self.read_form(data, pos, form, unit, const)
+                continue
+
+            _, attrs, pos = self.read_die(unit, start)
+            function = Function()
+            low_pc = high_pc = 0
+            relative = False
+            for name, form, value in attrs:
+                if name in (DW_AT_abstract_origin, DW_AT_specification):
+                    function.name, linkage = self.abstract_name(unit, form, value)
+                    function.is_linkage = function.is_linkage or linkage
+                elif name == DW_AT_name:
+                    if function.name is None and form in string_forms:
+                        function.name = self.string(form, value, unit)
+                        function.is_linkage = function.is_linkage or unit.lang in unmangled_languages
+                elif name in (DW_AT_linkage_name, DW_AT_MIPS_linkage_name):
+                    if form in string_forms:
+                        function.name = self.string(form, value, unit)
+                        function.is_linkage = True
+                elif name == DW_AT_low_pc:
+                    low_pc = self.address(form, value, unit)
+                elif name == DW_AT_high_pc:
+                    high_pc = self.address(form, value, unit)
+                    relative = form != DW_FORM_addr and form not in addrx_forms
+                elif name == DW_AT_ranges:
+                    function.ranges += self.read_ranges(unit, form, value)
+            if relative:
+                high_pc += low_pc
+            if high_pc and low_pc != high_pc:
+                function.ranges.append((low_pc, high_pc))
+            if function.ranges:
+                functions.append(function)
+        unit.functions = functions
+        unit.function_index = IntervalIndex([(low, high, i) for i, function in enumerate(functions) for low, high in function.ranges])
+
+    def find_function(self, unit, address):
+        """Return the innermost function of unit containing address, preferring the later DIE among equals."""
+        if unit.functions is None:
+            self.read_functions(unit)
+        best, best_length = None, None
+        for i in unit.function_index.containing(address):
+            for low, high in unit.functions[i].ranges:
+                if low <= address < high and (best is None or high - low < best_length or (high - low == best_length and i > best)):
+                    best, best_length = i, high - low
+        return unit.functions[best] if best is not None else None
+
+    def read_line_table(self, unit):
+        data = self.line
+        pos = unit.stmt_list
+        offset_size = 4
+        length = self.int(data, pos, 4)
+        pos += 4
+        if length == 0xffffffff:
+            offset_size = 8
+            length = self.int(data, pos, 8)
+            pos += 8
+        end = pos + length
+        version = self.int(data, pos, 2)
+        pos += 2
+        if version >= 5:
+            pos += 2 # address_size, segment_selector_size
+        header_length = self.int(data, pos, offset_size)
+        pos += offset_size
+        program = pos + header_length
+        min_inst_length = data[pos]
+        pos += 1
+        if version >= 4:
+            pos += 1 # maximum_operations_per_instruction
+        # data[pos] is default_is_stmt, which addr2line does not use either
+        line_base = data[pos+1] - 256 if data[pos+1] > 127 else data[pos+1]
+        line_range = data[pos+2]
+        opcode_base = data[pos+3]
+        opcode_lengths = [0] + list(data[pos+4:pos+3+opcode_base])
+        pos += 3 + opcode_base
+
+        dirs, files = [], []
+        if version >= 5:
+            line_unit = Unit(unit.offset)
+            line_unit.__dict__.update(unit.__dict__)
+            line_unit.offset_size = offset_size
+            for entries in [dirs, files]:
+                formats = []
+                count = data[pos]
+                pos += 1
+                for _ in range(count):
+                    content, pos = read_uleb(data, pos)
+                    form, pos = read_uleb(data, pos)
+                    formats.append((content, form))
+                count, pos = read_uleb(data, pos)
+                for _ in range(count):
+                    path, dir_index = None, 0
+                    for content, form in formats:
+                        value, pos = self.read_form(data, pos, form, line_unit)
+                        if content == DW_LNCT_path and form in string_forms:
+                            path = self.string(form, value, line_unit)
+                        elif content == DW_LNCT_directory_index:
+                            dir_index = value
+                    entries.append(path if entries is dirs else (path, dir_index))
+        else:
+            while data[pos]:
+                path, pos = read_cstring(data, pos)
+                dirs.append(path)
+            pos += 1
+            while data[pos]:
+                path, pos = read_cstring(data, pos)
+                dir_index, pos = read_uleb(data, pos)
+                _, pos = read_uleb(data, pos)
+                _, pos = read_uleb(data, pos)
+                files.append((path, dir_index))
+
+        filenames = {}
+        def filename(index):
+            if index not in filenames:
+                filenames[index] = self.concat_filename(unit, version, dirs, files, index)
+            return filenames[index]
+
+        # Run the line number program, keeping the last row of the rows at the same address. Like
+        # addr2line, a sequence starts with the file 0 in DWARF 5 rather than 1.
+        sequences = []
+        rows = []
+        pos = program
+        special = lambda opcode: ((opcode - opcode_base) // line_range * min_inst_length, line_base + (opcode - opcode_base) % line_range)
+        first_file = 0 if version >= 5 else 1
+        address, file, line, discriminator = 0, first_file, 1, 0
+        def add_row(end_sequence):
+            row = (address, filename(file), line, discriminator, end_sequence)
+            if rows and rows[-1][0] == address and rows[-1][4] == end_sequence:
+                rows[-1] = row
+            else:
+                rows.append(row)
+        while pos < end:
+            opcode = data[pos]
+            pos += 1
+            if opcode >= opcode_base:
+                address_advance, line_advance = special(opcode)
+                address += address_advance
+                line += line_advance
+                add_row(False)
+                discriminator = 0
+            elif opcode == 0:
+                length, pos = read_uleb(data, pos)
+                next_pos = pos + length
+                extended = data[pos]
+                pos += 1
+                if extended == 1: # DW_LNE_end_sequence
+                    add_row(True)
+                    rows.sort(key=lambda row: row[0])
+                    sequences.append(rows)
+                    rows = []
+                    address, file, line, discriminator = 0, first_file, 1, 0
+                elif extended == 2: # DW_LNE_set_address
+                    address = self.int(data, pos, length - 1)
+                elif extended == 3: # DW_LNE_define_file
+                    path, pos = read_cstring(data, pos)
+                    dir_index, pos = read_uleb(data, pos)
+                    files.append((path, dir_index))
+                    filenames.clear()
+                elif extended == 4: # DW_LNE_set_discriminator
+                    discriminator, pos = read_uleb(data, pos)
+                pos = next_pos
+            elif opcode == 1: # DW_LNS_copy
+                add_row(False)
+                discriminator = 0
+            elif opcode == 2: # DW_LNS_advance_pc
+                advance, pos = read_uleb(data, pos)
+                address += advance * min_inst_length
+            elif opcode == 3: # DW_LNS_advance_line
+                advance, pos = read_sleb(data, pos)
+                line += advance
+            elif opcode == 4: # DW_LNS_set_file
+                file, pos = read_uleb(data, pos)
+            elif opcode == 8: # DW_LNS_const_add_pc
+                address += special(255)[0]
+            elif opcode == 9: # DW_LNS_fixed_advance_pc
+                address += self.int(data, pos, 2)
+                pos += 2
+            else:
+                for _ in range(opcode_lengths[opcode]):
+                    _, pos = read_uleb(data, pos)
+        unit.lines = LineTable(sequences)
+
+    def concat_filename(self, unit, version, dirs, files, index):
+        """Return the path of the file index of a line table, prefixed with its directory and the compilation directory."""
+        if version < 5:
+            if index == 0:
+                return '<unknown>'
+            index -= 1
+        if index >= len(files) or files[index][0] is None:
+            return '<unknown>'
+        path, dir_index = files[index]
+        if path.startswith('/'):
+            return path
+        subdir = None
+        if dir_index and dir_index <= len(dirs):
+            subdir = dirs[dir_index] if version >= 5 and dir_index < len(dirs) else dirs[dir_index - 1] if version < 5 else None
+        directory = None
+        if not subdir or not subdir.startswith('/'):
+            directory = unit.comp_dir
+        if not directory:
+            directory, subdir = subdir, None
+        if not directory:
+            return path
+        return f'{directory}/{subdir}/{path}' if subdir else f'{directory}/{path}'
+
+    def find_nearest_line(self, address):
+        """Return the innermost function, and the row (address, file, line, discriminator, end) or None, of the
+        first unit with either for address, or None."""
+        candidates = sorted(self.unit_index.containing(address)) + [i for i, unit in enumerate(self.units) if not unit.ranges]
+        if nearest := self.find_nearest_line_in(candidates, address):
+            return nearest
+        # Like addr2line, a unit also covers the sequences of its line table
+        if self.sequence_index is None:
+            sequences = []
+            for i, unit in enumerate(self.units):
+                if unit.stmt_list is not None and self.line is not None:
+                    if unit.lines is None:
+                        self.read_line_table(unit)
+                    sequences += [(seq[0][0], seq[-1][0], i) for seq in unit.lines.sequences]
+            self.sequence_index = IntervalIndex(sequences)
+        return self.find_nearest_line_in(sorted(set(self.sequence_index.containing(address)) - set(candidates)), address)
+
+    def find_nearest_line_in(self, candidates, address):
+        for i in candidates:
+            unit = self.units[i]
+            if unit.stmt_list is None or self.line is None:
+                continue
+            if unit.lines is None:
+                self.read_line_table(unit)
+            function = self.find_function(unit, address)
+            row = unit.lines.lookup(address)
+            if function or row:
+                return function, row
+        return None
+
+class Symbolizer:
+    """Resolve addresses of a binary to the function names and source lines printed by `addr2line -f`."""
+
+    def __init__(self, binary):
+        self.elf = Elf(binary)
+        self.section_index = IntervalIndex([(s.addr, s.addr + s.size, s.index) for s in self.elf.sections if s.flags & SHF_ALLOC and s.size])
+        self.dwarf = Dwarf(self.elf) if self.elf.section_data('.debug_info') else None
+        self.index_symbols()
+        # The breakpoints, and the name and line of each breakpoint looked up, of interval_table()
+        self.points = None
+        self.point_symbols = {}
+
+    def close(self):
+        self.elf.close()
+
+    def index_symbols(self):
+        """Index the code symbols of each section by value, with the file symbol each one is attributed to."""
+        candidates = {}
+        file = None
+        state = 'nothing_seen'
+        for order, symbol in enumerate(self.elf.symbols()):
+            if symbol.type == STT_FILE:
+                file = symbol.name
+                if state == 'symbol_seen':
+                    state = 'file_after_symbol_seen'
+                continue
+            if state == 'nothing_seen':
+                state = 'symbol_seen'
+            if symbol.type in (STT_SECTION, STT_OBJECT, STT_TLS):
+                continue
+            # Skip the markers of the annobin plugin
+            if symbol.size == 0 and symbol.bind == STB_LOCAL and symbol.type == STT_NOTYPE and symbol.other & 0x3 == STV_HIDDEN:
+                continue
+            filename = file if file is not None and (symbol.bind == STB_LOCAL or state != 'file_after_symbol_seen') else None
+            candidates.setdefault(symbol.shndx, []).append((symbol.value, order, symbol, filename))
+        self.symbols = {}
+        for shndx, symbols in candidates.items():
+            symbols.sort(key=lambda candidate: candidate[:2])
+            self.symbols[shndx] = ([value for value, _, _, _ in symbols], symbols)
+
+    def find_symbol(self, section, address):
+        """Return the nearest code symbol at or before address in section, and its file name."""
+        if section.index not in self.symbols:
+            return None, None
+        values, symbols = self.symbols[section.index]
+        end = bisect.bisect_right(values, address)
+        # Like addr2line, ignore the symbols before the start of their section (e.g. __ehdr_start)
+        if end == 0 or values[end-1] < section.addr:
+            return None, None
+        begin = bisect.bisect_left(values, values[end-1])
+        best = None
+        for _, _, symbol, filename in symbols[begin:end]:
+            if best is None or self.better_fit(best[0], symbol, address):
+                best = symbol, filename
+        return best
+
+    @staticmethod
+    def better_fit(best, symbol, address):
+        """Return whether symbol fits address better than best, both starting at the same address."""
+        best_size, size = best.size or 1, symbol.size or 1
+        if best.value + best_size < address:
+            return symbol.value + size >= address
+        best_is_func = best.type in (STT_FUNC, STT_GNU_IFUNC)
+        is_func = symbol.type in (STT_FUNC, STT_GNU_IFUNC)
+        if best_is_func != is_func:
+            return is_func
+        if (best.type == STT_NOTYPE) != (symbol.type == STT_NOTYPE):
+            return best.type == STT_NOTYPE
+        return size < best_size
+
+    def find_nearest_line(self, section, address):
+        """Return the function name, file name, line and discriminator of address in section, or None."""
+        filename, line, discriminator = None, 0, 0
+        found = False
+        function = None
+        if self.dwarf:
+            nearest = self.dwarf.find_nearest_line(address)
+            if nearest:
+                found = True
+                function, row = nearest
+                if row:
+                    _, filename, line, discriminator, _ = row
+        if function and function.is_linkage:
+            return function.name, filename, line, discriminator
+        symbol, symbol_file = self.find_symbol(section, address)
+        name = None
+        if symbol:
+            name = symbol.name
+            filename = symbol_file if filename is None else filename
+            found = True
+        if function and symbol is None:
+            name = function.name
+        return (name, filename, line, discriminator) if found else None
+
+    def lookup(self, addresses):
+        """Return the function names and the source lines of addresses, ints or hex strings, as printed by addr2line."""
+        names, lines = [], []
+        for address in addresses:
+            if isinstance(address, str):
+                address = int(address, 16)
+            nearest = None
+            # Try the sections in their order like addr2line
+            for index in sorted(self.section_index.containing(address)):
+                if nearest := self.find_nearest_line(self.elf.sections[index], address):
+                    break
+            if nearest is None:
+                names.append('??')
+                lines.append('??:0')
+                continue
+            name, filename, line, discriminator = nearest
+            names.append(name or '??')
+            if line == 0:
+                line = '?'
+            elif discriminator:
+                line = f'{line} (discriminator {discriminator})'
+            lines.append(f'{"??" if filename is None else filename}:{line}')
+        return names, lines
+
+
+    def breakpoints(self):
+        """Return the sorted addresses where the result of lookup() may change: the bounds of the sections,
+        units, functions, line rows and symbols."""
+        points = set()
+        for low, high, _ in self.section_index.intervals:
+            points.update((low, high))
+        for values, symbols in self.symbols.values():
+            for value, _, symbol, _ in symbols:
+                size = symbol.size or 1
+                points.update((value, value + size, value + size + 1))
+        if self.dwarf:
+            for unit in self.dwarf.units:
+                points.update(address for interval in unit.ranges for address in interval)
+                if unit.stmt_list is None or self.dwarf.line is None:
+                    continue
+                if unit.lines is None:
+                    self.dwarf.read_line_table(unit)
+                points.update(unit.lines.lows)
+                for addresses in unit.lines.addresses:
+                    points.update(addresses)
+                if unit.functions is None:
+                    self.dwarf.read_functions(unit)
+                for function in unit.functions:
+                    points.update(address for interval in function.ranges for address in interval)
+        return sorted(points)
+
+    def interval_table(self, low, high):
+        """Return the starts of the intervals covering [low, high) over which the function name and the source
+        line are constant, and the names and lines of the intervals, for a bisect of the addresses in [low, high)."""
+        if self.points is None:
+            self.points = self.breakpoints()
+        points = self.points
+        starts = [low] + points[bisect.bisect_right(points, low):bisect.bisect_left(points, high)]
+        # The starts looked up by the previous calls are not looked up again
+        if new_starts := [start for start in starts if start not in self.point_symbols]:
+            self.point_symbols.update(zip(new_starts, zip(*self.lookup(new_starts))))
+        names, lines = zip(*[self.point_symbols[start] for start in starts])
+        # Merge the neighbour intervals with the same name and line
+        keep = [i for i in range(len(starts)) if i == 0 or (names[i], lines[i]) != (names[i-1], lines[i-1])]
+        return [starts[i] for i in keep], [names[i] for i in keep], [lines[i] for i in keep]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the function name and source line of addresses of a binary like `addr2line -f -e binary`.')
+    parser.add_argument('binary', help='binary with the addresses')
+    parser.add_argument('address', nargs='*', help='hex addresses (read from stdin if not given)')
+    args = parser.parse_args()
+    addresses = args.address or sys.stdin.read().split()
+    symbolizer = Symbolizer(args.binary)
+    for name, line in zip(*symbolizer.lookup(addresses)):
+        print(name)
+        print(line)
+    symbolizer.close()
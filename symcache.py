@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import argparse, hashlib, os, shutil, sqlite3, time
+import symbolizer
+from symbolizer import Elf
+
+# Least recently used symbols beyond this number are evicted
+default_max_entries = 1 << 22
+
+def file_key(path):
+    """Return the SHA-256 of the content of path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return 'sha256:' + digest.hexdigest()
+
+def binary_key(binary):
+    """Return the build-id of binary, or the SHA-256 of its content if it has none."""
+    elf = Elf(binary)
+    build_id = elf.build_id()
+    elf.close()
+    return 'build-id:' + build_id if build_id else file_key(binary)
+
+def resolver_key(addr2line=None):
+    """Return the identity of the resolver of the symbols, the version of the built-in symbolizer or the content of
+    addr2line (which may be a wrapper script), since two resolvers may name the same address differently."""
+    if addr2line is None:
+        return f'symbolizer:{symbolizer.version}'
+    return 'addr2line:' + file_key(shutil.which(addr2line) or addr2line)
+
+class SymbolCache:
+    """On-disk cache of the function name and source line of the addresses of binaries, shared between processes.
+    The symbols are keyed by the binary and by the resolver that gave them, so resolvers never mix."""
+
+    def __init__(self, cache_dir, max_entries=default_max_entries):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'symbols.sqlite'), timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS symbols (binary TEXT, address INTEGER, name TEXT, line TEXT, used REAL, '
+                        'PRIMARY KEY (binary, address)) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS symbols_used ON symbols (used)')
+        self.db.commit()
+        self.max_entries = max_entries
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, binary, addresses, resolve, addr2line=None):
+        """Return the function names and the source lines of the hex addresses of binary, calling
+        resolve(addresses) -> (names, lines) only for the ones not in the cache, resolve being the built-in
+        symbolizer or addr2line if it is given."""
+        if (binary, addr2line) not in self.keys:
+            self.keys[binary, addr2line] = binary_key(binary) + ' ' + resolver_key(addr2line)
+        key = self.keys[binary, addr2line]
+        values = [int(address, 16) for address in addresses]
+
+        found = {}
+        distinct = list(dict.fromkeys(values))
+        # Stay below the default limit of SQLite on the number of variables
+        for i in range(0, len(distinct), 900):
+            part = distinct[i:i+900]
+            found.update((address, (name, line)) for address, name, line in self.db.execute(
+                'SELECT address, name, line FROM symbols WHERE binary = ? AND address IN ({})'.format(','.join('?' * len(part))),
+                [key] + part))
+        missing = [address for address in distinct if address not in found]
+        missing_set = set(missing)
+        self.hits += len(distinct) - len(missing)
+        self.misses += len(missing)
+
+        now = time.time()
+        with self.db:
+            if missing:
+                names, lines = resolve(['{:x}'.format(address) for address in missing])
+                resolved = list(zip(missing, names, lines))
+                found.update((address, (name, line)) for address, name, line in resolved)
+                self.db.executemany('INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?, ?)',
+                                    [(key, address, name, line, now) for address, name, line in resolved])
+            self.db.executemany('UPDATE symbols SET used = ? WHERE binary = ? AND address = ?',
+                                [(now, key, address) for address in distinct if address not in missing_set])
+            self.evict()
+
+        symbols = [found[address] for address in values]
+        return [name for name, _ in symbols], [line for _, line in symbols]
+
+    def evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM symbols').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute('DELETE FROM symbols WHERE (binary, address) IN (SELECT binary, address FROM symbols ORDER BY used LIMIT ?)',
+                            (count - self.max_entries,))
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f'symbol cache: {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit)'
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show or clear the symbol cache used by bb2fline.py --cache-dir.')
+    parser.add_argument('cache_dir', help='directory of the symbol cache')
+    parser.add_argument('--clear', action='store_true', help='remove all the cached symbols')
+    args = parser.parse_args()
+    cache = SymbolCache(args.cache_dir)
+    if args.clear:
+        with cache.db:
+            cache.db.execute('DELETE FROM symbols')
+    for key, count in cache.db.execute('SELECT binary, COUNT(*) FROM symbols GROUP BY binary'):
+        print(f'{key}: {count} addresses')
+    cache.close()
@@ -1,25 +1,292 @@
 #!/usr/bin/env python3
-import os, argparse, glob, subprocess, shutil, filecmp, json, sys
+import os, argparse, csv, glob, gzip, lzma, importlib.util, re, subprocess, shutil, filecmp, json, sys
 from subprocess import PIPE
 from collections import defaultdict
 
 src_test_dir = './test_files'
 tmp_test_dir = '.test_files'
 
+def compare_files(ref, exp, script):
+    log = dict()
+    log['ref'], log['exp'] = ref, exp
+    same = filecmp.cmp(ref, exp)
+    log['result'] = 'pass' if same else 'fail'
+    log['testing script'] = script
+    json.dump(log, sys.stdout, indent=2)
+    print('\n', flush=True)
+    if not same:
+        subprocess.run(['git', 'diff', '--no-index', ref, exp])
+        sys.exit(-1)
+
 def compare_and_report(files, script):
     for file in files:
-        log = dict()
-        ref = f'{src_test_dir}/{file}'
-        exp = f'{tmp_test_dir}/{file}'
-        log['ref'], log['exp'] = ref, exp
-        same = filecmp.cmp(ref, exp)
-        log['result'] = 'pass' if same else 'fail'
-        log['testing script'] = script
-        json.dump(log, sys.stdout, indent=2)
-        print('\n', flush=True)
-        if not same:
-            subprocess.run(['git', 'diff', '--no-index', ref, exp])
-            sys.exit(-1)
+        compare_files(f'{src_test_dir}/{file}', f'{tmp_test_dir}/{file}', script)
+
+def check_api(sim_file, exe, disasm):
+    """Run sde2csv, bb2fline and annotater in-process, bb2fline on the bb table sde2csv returns, and check the files
+    they write and the tables they return."""
+    import annotater, bb2fline, profile_io, sde2csv
+    writers = sde2csv.convert_sde_perf_to_csv(sim_file, exe, items=['PUSH', 'POP'], columns=True)
+    fs_metrics, lines_metrics = bb2fline.bb_to_fline(f'{sim_file}.bb.csv', exe, table=writers['bb'].table())
+    global_icount, icounts = annotater.annotate(disasm, f'{sim_file}.insn.csv')
+    compare_and_report(['a.err.bb.csv', 'a.err.insn.csv', 'a.err.global.csv', 'a.err.f.csv', 'a.err.line.csv', 'a.err.annotated'], 'in-process calls')
+
+    with open(f'{sim_file}.api', 'w') as f:
+        for table, writer in writers.items():
+            header, columns = writer.table()
+            print(','.join(header), file=f)
+            for values in zip(*[list(columns[name]) for name in header]):
+                print(','.join('{:x}'.format(val) if name in profile_io.address_columns else str(val) for name, val in zip(header, values)), file=f)
+        for first, keys_metrics in [('name', fs_metrics), ('source_line', lines_metrics)]:
+            for key, key_metrics in keys_metrics.items():
+                print(','.join([key] + [str(key_metrics[name]) for name in key_metrics]), file=f)
+        print(global_icount, file=f)
+        for pc, execution in icounts.items():
+            print('{:x},{}'.format(pc, execution), file=f)
+    # The same tables read from the files, with the missing values as 0
+    with open(f'{sim_file}.files', 'w') as f:
+        for table in profile_io.tables:
+            with open(profile_io.csv_file(sim_file, table), 'r') as table_file:
+                for row in table_file:
+                    print(','.join(cell or '0' for cell in row.rstrip('\n').split(',')), file=f)
+        for table in ['f', 'line']:
+            with open(f'{sim_file}.{table}.csv', 'r') as table_file:
+                f.writelines(list(table_file)[1:])
+        with open(profile_io.csv_file(sim_file, 'global'), 'r') as table_file:
+            print(next(csv.DictReader(table_file))['total'], file=f)
+        with open(profile_io.csv_file(sim_file, 'insn'), 'r') as table_file:
+            for row in csv.DictReader(table_file):
+                print('{},{}'.format(row['pc'], row['execution'] or 0), file=f)
+    compare_files(f'{sim_file}.files', f'{sim_file}.api', 'in-process tables')
+
+def check_images():
+    """Profile every image of images.err, whose libsq.so.1 is recorded at the path of a stripped copy of the same size
+    and whose libc.so.6 has the size of no file, and check the tables and symbols of each image."""
+    for name in ['images.err', 'libsq.so.1']:
+        shutil.copy(f'{src_test_dir}/{name}', tmp_test_dir)
+    os.makedirs(f'{tmp_test_dir}/decoy', exist_ok=True)
+    shutil.copy(f'{src_test_dir}/libsq.so.1.stripped', f'{tmp_test_dir}/decoy/libsq.so.1')
+    sim_file, exe = f'{tmp_test_dir}/images.err', f'{tmp_test_dir}/a.out'
+    subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP', '--all-images'], check=True)
+    subprocess.run(['./bb2fline.py', f'{sim_file}.bb.csv', exe, '--all-images'], check=True)
+    # The files of the images are absolute paths, compared relative to the test directory
+    with open(f'{sim_file}.images.csv', 'r') as f:
+        rows = list(csv.DictReader(f))
+    with open(f'{sim_file}.images.csv', 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows([dict(row, file=os.path.relpath(row['file']) if row['file'] else '') for row in rows])
+    files = ['images.err.images.csv', 'images.err.f.csv']
+    files += [f'images.err.image.{name}.{table}.csv' for name in ['a.out', 'libsq.so.1', 'libc.so.6'] for table in ['bb', 'insn']]
+    files += [f'images.err.image.{name}.{table}.csv' for name in ['a.out', 'libsq.so.1'] for table in ['f', 'line']]
+    compare_and_report(files, 'sde2csv.py --all-images')
+
+def check_threads():
+    """Write the tables of each thread of threads.err, a run of two threads, and check them and the report of the
+    threads, from the CSV files and from the npz when numpy is available."""
+    shutil.copy(f'{src_test_dir}/threads.err', tmp_test_dir)
+    sim_file, exe = f'{tmp_test_dir}/threads.err', f'{tmp_test_dir}/a.out'
+    formats = 'csv,npz' if importlib.util.find_spec('numpy') else 'csv'
+    subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP', '--threads', f'--format={formats}'], check=True)
+    compare_and_report([f'threads.err.tid{tid}.{table}.csv' for tid in [0, 1] for table in ['bb', 'insn', 'global']], 'sde2csv.py --threads')
+    for profile in [f'{sim_file}.bb.csv'] + ([f'{sim_file}.npz'] if 'npz' in formats else []):
+        with open(f'{sim_file}.hot', 'w') as f:
+            subprocess.run(['./hot_blocks.py', profile, '--threads', '-k', '2'], stdout=f, check=True)
+        compare_and_report(['threads.err.hot'], f'hot_blocks.py --threads on {os.path.basename(profile)}')
+
+def check_profile_store(sim_file):
+    """Ingest the outputs of sim_file for three builds, the second with main and _start edited, _fini gone and a new
+    function, and check the history of the last two builds and the diffs of the functions and the globals."""
+    db, f_csv = f'{tmp_test_dir}/profiles.sqlite', f'{sim_file}.f.csv'
+    os.makedirs(f'{tmp_test_dir}/store/w', exist_ok=True)
+    with open(f'{tmp_test_dir}/store/mapping.csv', 'w') as f:
+        f.write('name,sim_files\nw,a.err\n')
+    with open(f'{f_csv}.edited', 'r') as f:
+        edited = [line for line in f if not line.startswith('_fini,')]
+    edited.append('new_fn' + ',1' * (edited[0].count(',')) + '\n')
+    for label, rows in [('base', None), ('edited', edited), ('next', None)]:
+        for table in ['global', 'insn', 'f']:
+            shutil.copy(f'{sim_file}.{table}.csv', f'{tmp_test_dir}/store/w')
+        if rows:
+            with open(f'{tmp_test_dir}/store/w/a.err.f.csv', 'w') as f:
+                f.writelines(rows)
+        subprocess.run(['./profile_store.py', db, 'ingest', f'{tmp_test_dir}/store', f'--csv={tmp_test_dir}/store/mapping.csv', f'--label={label}'], check=True)
+    with open(f'{sim_file}.history.csv', 'w') as f:
+        subprocess.run(['./profile_store.py', db, 'history', 'mem-read', '--function=main', '--last=2'], stdout=f, check=True)
+    compare_and_report(['a.err.history.csv'], 'profile_store.py history --last')
+    with open(f'{sim_file}.store.diff.csv', 'w') as f:
+        subprocess.run(['./profile_store.py', db, 'diff', 'base', 'edited', '--items=mem-read,mem-write'], stdout=f, check=True)
+        subprocess.run(['./profile_store.py', db, 'diff', 'base', 'next', '--items=total', '--table=globals'], stdout=f, check=True)
+    compare_and_report(['a.err.store.diff.csv'], 'profile_store.py diff')
+
+def check_simpoint():
+    """Pick the simpoints of a.bbv, three phases of 7, 4 and 3 intervals, when numpy is available."""
+    if not importlib.util.find_spec('numpy'):
+        return
+    shutil.copy(f'{src_test_dir}/a.bbv', tmp_test_dir)
+    subprocess.run(['./simpoint.py', f'{tmp_test_dir}/a.bbv', '--max-k=5'], stdout=PIPE, check=True)
+    compare_and_report(['a.bbv.simpoints', 'a.bbv.weights'], 'simpoint.py')
+
+def check_name_match():
+    """Diff clones.ref.f.csv and clones.exp.f.csv with the names matched: clone suffixes folded, parameters changed,
+    and numbered local symbols kept apart."""
+    if not shutil.which('c++filt'):
+        return
+    ref, exp = f'{src_test_dir}/clones.ref.f.csv', f'{src_test_dir}/clones.exp.f.csv'
+    # The second run with the cache reads the matches from it
+    for options in [[], [f'--cache-dir={tmp_test_dir}/name_cache']] * 2:
+        subprocess.run(['./diff_csv_for_f.py', ref, exp, '--items=total,mem-read', '--normalize', '-o', f'{tmp_test_dir}/clones.f.diff.json'] + options, check=True)
+        compare_and_report(['clones.f.diff.json'], 'diff_csv_for_f.py --normalize ' + ' '.join(options))
+    with open(f'{tmp_test_dir}/clones.matches', 'w') as f:
+        subprocess.run(['./name_match.py', ref, exp], stdout=f, check=True)
+    compare_and_report(['clones.matches'], 'name_match.py')
+
+def check_suite_diff(sim_file):
+    """Diff two suites of workloads with diff_csv_for_f_wrapper.py over two processes: the sim files of a workload
+    paired by position whatever their names, the workloads in the order of the ref mapping, one of them only in ref."""
+    f_csv = f'{sim_file}.f.csv'
+    suite = f'{tmp_test_dir}/suite'
+    layout = {'ref': {'w2': [('a.err', f_csv)], 'w1': [('a.err', f_csv), ('b.err', f'{f_csv}.edited')], 'w3': [('a.err', f_csv)]},
+              'exp': {'w1': [('x.err', f'{f_csv}.edited'), ('y.err', f_csv)], 'w2': [('a.err', f_csv)]}}
+    for side, workloads in layout.items():
+        with open(f'{suite}.{side}.csv', 'w') as mapping:
+            mapping.write('name,sim_files\n')
+            for name, sim_files in workloads.items():
+                os.makedirs(f'{suite}/{side}/{name}', exist_ok=True)
+                for sim_file_name, f_file in sim_files:
+                    shutil.copy(f_file, f'{suite}/{side}/{name}/{sim_file_name}.f.csv')
+                mapping.write(f'{name},"{",".join(sim_file_name for sim_file_name, _ in sim_files)}"\n')
+    stderr = subprocess.run(['./diff_csv_for_f_wrapper.py', f'{suite}/ref', f'{suite}/exp', f'--ref_csv={suite}.ref.csv', f'--exp_csv={suite}.exp.csv',
+                             '--items=mem-read,mem-write', '-j', '2', '-o', f'{tmp_test_dir}/suite.diff.json'], stderr=PIPE, text=True, check=True).stderr
+    assert stderr == 'w3: not in exp, skipped\n', stderr
+    compare_and_report(['suite.diff.json'], 'diff_csv_for_f_wrapper.py')
+    with open(f'{tmp_test_dir}/suite.diff.json', 'r') as f:
+        text = f.read()
+    assert text == json.dumps(json.loads(text), indent=2) + '\n', 'diff_csv_for_f_wrapper.py output is not that of json.dump'
+
+def check_copy_files(sim_file, exe):
+    """Copy two workloads of the same binary, one of them with a sim file already compressed, by byte copies, with
+    --link and with --compress=gz, and check the copies, the links and the mapping written."""
+    import profile_io, staging
+    with open(f'{tmp_test_dir}/copy.csv', 'w') as f:
+        f.write(f'name,exe,sim_files\nw1,{exe},{sim_file}\nw2,{exe},{sim_file}.gz\n')
+    with open(exe, 'rb') as f, open(f'{exe}.probe', 'wb') as probe:
+        probe.write(f.read())
+    reflinks = staging.reflink(f'{exe}.probe', f'{exe}.probe.clone')
+    # A reflink is a copy, and no file is left when the file system cannot make one
+    assert filecmp.cmp(exe, f'{exe}.probe.clone', shallow=False) if reflinks else not os.path.lexists(f'{exe}.probe.clone'), 'reflink'
+    for options, suffix in [([], ''), (['--link'], ''), (['--compress=gz'], '.gz')]:
+        dst = f'{tmp_test_dir}/copies' + ''.join(options)
+        subprocess.run(['./copy_files.py', dst, f'--csv={tmp_test_dir}/copy.csv', '-o', f'{dst}.csv'] + options, check=True)
+        with open(f'{dst}.csv', 'r') as f:
+            assert f.read() == f'name,exe,sim_files\nw1,a.out,a.err{suffix}\nw2,a.out,a.err.gz\n', f'copy_files.py {options}: mapping'
+        assert filecmp.cmp(exe, f'{dst}/w1/a.out', shallow=False), f'copy_files.py {options}: a.out'
+        # A hard link is made only with --link, and only when there is no reflink
+        assert os.path.samefile(exe, f'{dst}/w1/a.out') == ('--link' in options and not reflinks), f'copy_files.py {options}: link of the source'
+        # The second copy of the same content is a link of the first one
+        assert filecmp.cmp(f'{dst}/w1/a.out', f'{dst}/w2/a.out', shallow=False) and (reflinks or os.path.samefile(f'{dst}/w1/a.out', f'{dst}/w2/a.out')), \
+            f'copy_files.py {options}: dedupe'
+        assert filecmp.cmp(f'{sim_file}.gz', f'{dst}/w2/a.err.gz', shallow=False), f'copy_files.py {options}: compressed sim file'
+        with profile_io.open_compressed(f'{dst}/w1/a.err{suffix}') as f, open(sim_file, 'rb') as sim:
+            assert f.read() == sim.read(), f'copy_files.py {options}: a.err{suffix}'
+
+def check_disasm(sim_file, exe):
+    """Disassemble a.out with disasm.py by a stand-in for objdump, with its index, without and with the cache, where
+    a copy of a.out elsewhere hits the entry of a.out, and annotate the hot functions with and without the index."""
+    shutil.copy(f'{src_test_dir}/objdump', tmp_test_dir)
+    out_dir = f'{tmp_test_dir}/disasm'
+    os.makedirs(f'{out_dir}/other', exist_ok=True)
+    shutil.copy(exe, f'{out_dir}/other')
+    for binary, disasm, cache_dir in [(exe, 'a.out.disasm', []), (exe, 'cached.disasm', [f'--cache-dir={out_dir}/cache']),
+                                      (f'{out_dir}/other/a.out', 'other.disasm', [f'--cache-dir={out_dir}/cache'])]:
+        subprocess.run(['./disasm.py', binary, '-o', f'{out_dir}/{disasm}', f'--objdump={tmp_test_dir}/objdump', '--index'] + cache_dir, check=True)
+        compare_files(f'{src_test_dir}/a.out.disasm', f'{out_dir}/{disasm}', 'disasm.py ' + ' '.join(cache_dir))
+        compare_files(f'{src_test_dir}/a.out.disasm.index.csv', f'{out_dir}/{disasm}.index.csv', 'disasm.py --index ' + ' '.join(cache_dir))
+    with open(f'{tmp_test_dir}/objdump.log', 'r') as f:
+        assert f.read() == 'a.out\n' * 2, 'disasm.py --cache-dir ran objdump again'
+
+    # The functions above 0.5% of the total (main only), sought to by the index, then read through without it
+    for indexed in [True, False]:
+        if not indexed:
+            os.remove(f'{out_dir}/a.out.disasm.index.csv')
+        subprocess.run(['./annotater.py', f'{out_dir}/a.out.disasm', f'{sim_file}.insn.csv', '--hot-threshold=0.5'], check=True)
+        shutil.move(f'{sim_file}.annotated', f'{sim_file}.hot.annotated')
+        compare_and_report(['a.err.hot.annotated'], 'annotater.py --hot-threshold' + (' with the index' if indexed else ''))
+
+def run_pipeline(stages, **options):
+    """Run stages in a pipeline whose stamps are in the pipeline directory, and return the stages that failed or were
+    blocked, and the status of each stage that started."""
+    import contextlib, io, pipeline
+    p = pipeline.Pipeline(f'{tmp_test_dir}/pipeline/stamps.json', **options)
+    for stage in stages:
+        p.add(stage)
+    with contextlib.redirect_stderr(io.StringIO()) as log:
+        failed = p.run()
+    return failed, dict(re.findall(r'\] (\S+): (done|up to date|failed) in', log.getvalue()))
+
+def check_pipeline():
+    """Check that a pipeline runs again only the stages downstream of a changed input, blocks the stages downstream
+    of a failure, and runs the stages over the memory budget one at a time, largest first."""
+    from pipeline import Stage
+    work = f'{tmp_test_dir}/pipeline'
+    os.makedirs(work, exist_ok=True)
+    for name in ['a', 'b']:
+        with open(f'{work}/{name}', 'w') as f:
+            f.write(name + '\n')
+    stages = [Stage('x', ['cat', f'{work}/a'], [f'{work}/a'], [f'{work}/x'], stdout=f'{work}/x'),
+              Stage('y', ['cat', f'{work}/b'], [f'{work}/b'], [f'{work}/y'], stdout=f'{work}/y'),
+              Stage('z', ['cat', f'{work}/x', f'{work}/y'], [f'{work}/x', f'{work}/y'], [f'{work}/z'], stdout=f'{work}/z'),
+              Stage('w', ['cat', f'{work}/x'], [f'{work}/x'], [f'{work}/w'], stdout=f'{work}/w')]
+    assert run_pipeline(stages) == ([], dict.fromkeys('xyzw', 'done')), 'pipeline: first run'
+    assert run_pipeline(stages) == ([], dict.fromkeys('xyzw', 'up to date')), 'pipeline: run again'
+    with open(f'{work}/b', 'a') as f:
+        f.write('edited\n')
+    assert run_pipeline(stages) == ([], {'x': 'up to date', 'y': 'done', 'z': 'done', 'w': 'up to date'}), 'pipeline: edited input'
+    with open(f'{work}/z', 'r') as f:
+        assert f.read() == 'a\nb\nedited\n', 'pipeline: output of the edited input'
+
+    # A failed stage is not stamped, so it runs (and fails) again
+    failing = stages + [Stage('v', ['false'], [f'{work}/y'], [f'{work}/v']), Stage('u', ['cat', f'{work}/v'], [f'{work}/v'], [f'{work}/u'], stdout=f'{work}/u')]
+    for _ in range(2):
+        assert run_pipeline(failing) == (['v', 'u'], {**dict.fromkeys('xyzw', 'up to date'), 'v': 'failed'}), 'pipeline: failure'
+
+    # Each stage needs more than half the budget, so they run one at a time, whatever the number of workers
+    for size in [1000, 2000]:
+        with open(f'{work}/weight{size}', 'w') as f:
+            f.write('.' * size)
+    log = f'{work}/memory.log'
+    heavy = [Stage(f'heavy{size}', ['sh', '-c', f'echo start {size} >> {log}; sleep 0.2; echo end {size} >> {log}'], [f'{work}/weight{size}'], [],
+                   weight=[f'{work}/weight{size}']) for size in [1000, 2000]]
+    assert run_pipeline(heavy, max_workers=2, force=True, memory=2500, memory_ratio=1.0)[0] == [], 'pipeline: memory budget'
+    with open(log, 'r') as f:
+        assert f.read() == 'start 2000\nend 2000\nstart 1000\nend 1000\n', 'pipeline: memory budget'
+
+def check_inlined():
+    """Compare the function and source line of each instruction of an optimized binary with inlined functions, as
+    bb2fline.py gives them with and without a symbol cache, with those of addr2line given each address alone."""
+    if not all(shutil.which(tool) for tool in ['g++', 'objdump', 'addr2line']):
+        return
+    import bb2fline, symcache
+    from profile_io import np
+    exe = f'{tmp_test_dir}/inline.out'
+    subprocess.run(['g++', '-g', '-O2', f'{src_test_dir}/inline.cc', '-o', exe], check=True)
+    disasm = subprocess.run(['objdump', '-d', exe], stdout=PIPE, text=True, check=True).stdout
+    pcs = sorted({int(pc, 16) for pc in re.findall(r'^ +([0-9a-f]+):\t', disasm, re.M)})
+    with open(f'{exe}.addr2line', 'w') as f:
+        for pc in pcs:
+            name, source_line = subprocess.run(['addr2line', '-f', '-e', exe, f'{pc:x}'], stdout=PIPE, text=True, check=True).stdout.splitlines()
+            print(f'{pc:x} {name} {source_line}', file=f)
+    # The cache is filled in reverse order, which must not change the names either
+    for cache_dir, order in [(None, pcs), (f'{tmp_test_dir}/symcache', pcs[::-1])]:
+        cache = symcache.SymbolCache(cache_dir) if cache_dir else None
+        name_ids, names, line_ids, source_lines = bb2fline.insn_fline_ids(np.array(order, dtype=np.uint64) if np is not None else order, exe, None, cache)
+        fline = {pc: (names[name_id], source_lines[line_id]) for pc, name_id, line_id in zip(order, list(name_ids), list(line_ids))}
+        if cache:
+            cache.close()
+        with open(f'{exe}.bb2fline', 'w') as f:
+            for pc in pcs:
+                print(f'{pc:x} {fline[pc][0]} {fline[pc][1]}', file=f)
+        compare_files(f'{exe}.addr2line', f'{exe}.bb2fline', 'bb2fline.py on inlined code' + (' with --cache-dir' if cache else ''))
 
 def generate(sde, update):
     test_dir = src_test_dir if update else tmp_test_dir
@@ -61,9 +328,82 @@ def generate(sde, update):
     if not update:
         compare_and_report(['a.err.bb.csv', 'a.err.insn.csv', 'a.err.global.csv'], 'sde2csv.py')
         compare_and_report(['a.err.json'], 'csv2json.py')
+        # --compact drops the whitespace only, and --compress writes the same JSON, to the same bytes on each run
+        tables = [f'{sim_file}.{table}.csv' for table in ['bb', 'insn', 'global']]
+        subprocess.run(['./csv2json.py', '--compact'] + tables, check=True)
+        shutil.move(json_file, f'{sim_file}.compact.json')
+        compare_and_report(['a.err.compact.json'], 'csv2json.py --compact')
+        with open(f'{src_test_dir}/a.err.json', 'r') as f, open(f'{sim_file}.compact.json', 'r') as compact:
+            assert json.load(f) == json.load(compact), 'csv2json.py --compact changed the JSON'
+        for compress in ['gz', 'xz']:
+            runs = []
+            for _ in range(2):
+                subprocess.run(['./csv2json.py', f'--compress={compress}'] + tables, check=True)
+                with open(f'{json_file}.{compress}', 'rb') as f:
+                    runs.append(f.read())
+            with open(f'{json_file}.{compress}.json', 'wb') as f:
+                f.write(gzip.decompress(runs[0]) if compress == 'gz' else lzma.decompress(runs[0]))
+            compare_files(f'{src_test_dir}/a.err.json', f'{json_file}.{compress}.json', f'csv2json.py --compress={compress}')
+            assert runs[0] == runs[1], f'csv2json.py --compress={compress} is not byte-stable'
+            assert compress != 'gz' or runs[0][4:8] == bytes(4), 'mtime in the gzip header'
         compare_and_report(['a.err.annotated'], 'annotater.py')
         compare_and_report(['a.err.f.csv', 'a.err.line.csv'], 'bb2fline.py')
         compare_and_report(['a.err.f.diff.csv'], 'diff_csv_for_f')
+        # No item of --items in both files
+        subprocess.run(['./diff_csv_for_f.py', f_csv, f'{f_csv}.edited', '--items=no-such-item', '-o', f'{sim_file}.f.diff.empty.json'], check=True)
+        compare_and_report(['a.err.f.diff.empty.json'], 'diff_csv_for_f without common items')
+
+        subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP', '--jobs=2'], check=True)
+        compare_and_report(['a.err.bb.csv', 'a.err.insn.csv', 'a.err.global.csv'], 'sde2csv.py --jobs=2')
+        subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP', '--global-only'], check=True)
+        compare_and_report(['a.err.global.csv'], 'sde2csv.py --global-only')
+        # A compressed sim file gives the same tables, --jobs being ignored with a warning
+        with open(sim_file, 'rb') as f, gzip.GzipFile(f'{sim_file}.gz', 'wb', mtime=0) as gz:
+            shutil.copyfileobj(f, gz)
+        stderr = subprocess.run(['./sde2csv.py', f'{sim_file}.gz', exe, '--items=PUSH,POP', '--jobs=2'], stderr=PIPE, text=True, check=True).stderr
+        assert '--jobs is ignored' in stderr, stderr
+        for table in ['bb', 'insn', 'global']:
+            compare_files(f'{src_test_dir}/a.err.{table}.csv', f'{sim_file}.gz.{table}.csv', 'sde2csv.py on a.err.gz')
+        # A corrupt section index is rebuilt, and one that cannot be written (a directory here) is kept in memory
+        with open(f'{sim_file}.idx', 'w') as f:
+            f.write('{"version"')
+        subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP'], check=True)
+        compare_and_report(['a.err.bb.csv', 'a.err.insn.csv', 'a.err.global.csv'], 'sde2csv.py with a corrupt index')
+        os.remove(f'{sim_file}.idx')
+        os.mkdir(f'{sim_file}.idx')
+        subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP'], check=True)
+        compare_and_report(['a.err.bb.csv', 'a.err.insn.csv', 'a.err.global.csv'], 'sde2csv.py with an unwritable index')
+        assert not glob.glob(f'{sim_file}.idx.*'), 'temporary index left'
+        os.rmdir(f'{sim_file}.idx')
+
+        # The npz format must read back as the CSV files do, explicit zero counts (elements_fp_single_1) included
+        if importlib.util.find_spec('numpy'):
+            subprocess.run(['./sde2csv.py', sim_file, exe, '--items=PUSH,POP,elements_fp_single_1', '--format=csv,npz'], check=True)
+            subprocess.run(['./csv2json.py'] + glob.glob(f'{sim_file}.*.csv'), check=True)
+            shutil.move(json_file, f'{json_file}.csv')
+            subprocess.run(['./csv2json.py', f'{sim_file}.npz'], check=True)
+            compare_files(f'{json_file}.csv', json_file, 'csv2json.py from npz')
+
+        # The report from the npz must be the one from the CSV files, estimated counts (beyond -k) included
+        for profile in [f'{sim_file}.bb.csv', f'{sim_file}.insn.csv'] + ([f'{sim_file}.npz'] if os.path.isfile(f'{sim_file}.npz') else []):
+            for table in ['bb', 'insn']:
+                if not profile.endswith('.npz') and not profile.endswith(f'.{table}.csv'):
+                    continue
+                with open(f'{sim_file}.{table}.hot', 'w') as f:
+                    subprocess.run(['./hot_blocks.py', profile, f'--table={table}', '-k', '3'], stdout=f, check=True)
+                compare_and_report([f'a.err.{table}.hot'], f'hot_blocks.py --table={table} on {os.path.basename(profile)}')
+
+        check_api(sim_file, exe, disasm)
+        check_profile_store(sim_file)
+        check_images()
+        check_threads()
+        check_simpoint()
+        check_name_match()
+        check_suite_diff(sim_file)
+        check_copy_files(sim_file, exe)
+        check_disasm(sim_file, exe)
+        check_pipeline()
+        check_inlined()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -0,0 +1,16 @@
+#include <stdio.h>
+#include <stdlib.h>
+static int sq(int x) { return x * x; }
+static inline int cube(int x) { return sq(x) * x; }
+__attribute__((noinline)) int work(int *a, int n) {
+  int s = 0;
+  for (int i = 0; i < n; i++) s += a[i] & 1 ? cube(a[i]) : sq(a[i]);
+  return s;
+}
+int main(int argc, char **argv) {
+  int n = argc > 1 ? atoi(argv[1]) : 100;
+  int *a = (int *)malloc(n * sizeof(int));
+  for (int i = 0; i < n; i++) a[i] = rand() % 100 + sq(i);
+  printf("%d %d\n", work(a, n), cube(n));
+  return 0;
+}